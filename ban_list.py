@@ -0,0 +1,108 @@
+# ban_list.py
+
+import logging
+import os
+import threading
+import redis
+from config import REDIS_HOST, REDIS_PORT, REDIS_DB
+from database import get_banned_user_ids, run_db, BAN_LIST_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+# Every process (the bot and each Dramatiq worker) keeps the banned_users set
+# in memory, so the admission check on each update is a set lookup. ban_user
+# and unban_user publish "ban:<id>" / "unban:<id>" on BAN_LIST_CHANNEL and the
+# subscriber thread applies the change. The bot also reloads the full set
+# every BAN_LIST_REFRESH_INTERVAL seconds in case a message was missed, and
+# restarts the subscriber thread if it died (it exits on a connection error).
+
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+
+_banned = frozenset()
+_loaded_pid = None
+_subscriber = None
+_version = 0          # bumped by every change received over pub/sub
+_loaded_version = -1  # _version when the last applied database read started
+_changes = {}         # user_id -> (version, banned) for pub/sub changes newer than _loaded_version
+_lock = threading.Lock()
+
+def _on_message(message):
+    global _banned, _version
+    try:
+        action, user_id = message['data'].decode('utf-8').split(':', 1)
+        user_id = int(user_id)
+    except (AttributeError, ValueError):
+        logger.warning(f"Ignoring malformed ban list message: {message['data']!r}")
+        return
+    if action not in ('ban', 'unban'):
+        logger.warning(f"Ignoring unknown ban list action: {action!r}")
+        return
+    with _lock:
+        _version += 1
+        _changes[user_id] = (_version, action == 'ban')
+        if action == 'ban':
+            _banned = _banned | {user_id}
+        else:
+            _banned = _banned - {user_id}
+    logger.info(f"Ban list updated: {action} {user_id}")
+
+def _subscribe():
+    global _subscriber
+    try:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{BAN_LIST_CHANNEL: _on_message})
+        _subscriber = pubsub.run_in_thread(sleep_time=1, daemon=True)
+    except Exception as e:
+        # The periodic reload still picks up changes and retries the subscription
+        _subscriber = None
+        logger.error(f"Could not subscribe to ban list updates: {e}")
+
+def _ensure_subscribed():
+    """Subscribe in this process, or again if the subscriber thread has died; returns the version to load at."""
+    global _loaded_pid
+    # Subscribe before reading the table so a ban issued in between is not missed
+    with _lock:
+        if _loaded_pid != os.getpid() or _subscriber is None or not _subscriber.is_alive():
+            if _loaded_pid == os.getpid():
+                logger.warning("Ban list subscriber is not running, subscribing again")
+            _subscribe()
+            _loaded_pid = os.getpid()
+        return _version
+
+def _apply(banned, version: int):
+    global _banned, _loaded_version
+    # Keep the previous set if the database could not be read
+    if banned is None:
+        return
+    with _lock:
+        if version < _loaded_version:
+            # A read that started later has already been applied
+            return
+        banned = set(banned)
+        # Changes received after the read started may be missing from it
+        for user_id, (changed_at, is_ban) in _changes.items():
+            if changed_at > version:
+                if is_ban:
+                    banned.add(user_id)
+                else:
+                    banned.discard(user_id)
+        for user_id in [user_id for user_id, (changed_at, _) in _changes.items() if changed_at <= version]:
+            del _changes[user_id]
+        _banned = frozenset(banned)
+        _loaded_version = version
+    logger.info(f"Loaded {len(_banned)} banned users")
+
+def load_ban_list():
+    """Load the banned user ids from Postgres and start listening for changes in this process."""
+    version = _ensure_subscribed()
+    _apply(get_banned_user_ids(), version)
+
+async def refresh_ban_list(context=None):
+    version = _ensure_subscribed()
+    _apply(await run_db(get_banned_user_ids), version)
+
+def is_banned(user_id: int) -> bool:
+    # Workers load lazily on first use; the bot loads at startup
+    if _loaded_pid != os.getpid():
+        load_ban_list()
+    return user_id in _banned
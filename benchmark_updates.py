@@ -0,0 +1,91 @@
+# benchmark_updates.py
+#
+# Compares sequential update handling (what the Application did before) with
+# ChatOrderedUpdateProcessor. Updates are dispatched the way the Application
+# does it, one task per update handed to the processor, and each handler only
+# sleeps for a simulated latency: most are quick, a few stand in for a Claude
+# call or an image generation poll. Nothing talks to Telegram.
+#
+#   python benchmark_updates.py --chats 50 --updates-per-chat 10 --concurrency 64
+
+import argparse
+import asyncio
+import random
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+from telegram.ext import SimpleUpdateProcessor
+from update_processing import ChatOrderedUpdateProcessor
+
+def make_updates(chats: int, updates_per_chat: int, slow_ratio: float, fast: float, slow: float, seed: int) -> list:
+    # Chats' updates arrive interleaved at random, each chat's in sequence order
+    rng = random.Random(seed)
+    arrivals = [chat_id for chat_id in range(chats) for _ in range(updates_per_chat)]
+    rng.shuffle(arrivals)
+    next_sequence = defaultdict(int)
+    updates = []
+    for chat_id in arrivals:
+        updates.append(SimpleNamespace(
+            effective_chat=SimpleNamespace(id=chat_id),
+            effective_user=SimpleNamespace(id=chat_id),
+            sequence=next_sequence[chat_id],
+            latency=slow if rng.random() < slow_ratio else fast
+        ))
+        next_sequence[chat_id] += 1
+    return updates
+
+async def run(processor, updates: list) -> dict:
+    handled = {}
+    latencies = []
+    out_of_order = 0
+
+    async def handler(update, received_at):
+        nonlocal out_of_order
+        await asyncio.sleep(update.latency)
+        previous = handled.get(update.effective_chat.id, -1)
+        if update.sequence != previous + 1:
+            out_of_order += 1
+        handled[update.effective_chat.id] = update.sequence
+        latencies.append(time.perf_counter() - received_at)
+
+    await processor.initialize()
+    started = time.perf_counter()
+    tasks = [asyncio.create_task(processor.process_update(update, handler(update, time.perf_counter()))) for update in updates]
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    await processor.shutdown()
+
+    latencies.sort()
+    return {
+        "elapsed": elapsed,
+        "throughput": len(updates) / elapsed,
+        "p50": latencies[len(latencies) // 2],
+        "p95": latencies[int(len(latencies) * 0.95) - 1],
+        "out_of_order": out_of_order,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Telegram update processing modes")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--updates-per-chat", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--slow-ratio", type=float, default=0.05, help="share of updates with the slow latency")
+    parser.add_argument("--fast", type=float, default=0.01, help="seconds a quick handler takes")
+    parser.add_argument("--slow", type=float, default=0.5, help="seconds a slow handler takes")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    updates = make_updates(args.chats, args.updates_per_chat, args.slow_ratio, args.fast, args.slow, args.seed)
+    modes = [
+        ("sequential", SimpleUpdateProcessor(1)),
+        (f"chat-ordered x{args.concurrency}", ChatOrderedUpdateProcessor(args.concurrency)),
+    ]
+    print(f"{len(updates)} updates from {args.chats} chats, {args.slow_ratio:.0%} slow ({args.slow}s), rest {args.fast}s")
+    print(f"{'mode':<22}{'elapsed':>10}{'updates/s':>12}{'p50':>9}{'p95':>9}{'out of order':>14}")
+    for name, processor in modes:
+        result = asyncio.run(run(processor, updates))
+        print(f"{name:<22}{result['elapsed']:>9.2f}s{result['throughput']:>12.1f}"
+              f"{result['p50']:>8.2f}s{result['p95']:>8.2f}s{result['out_of_order']:>14}")
+
+if __name__ == "__main__":
+    main()
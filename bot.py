@@ -1,5 +1,6 @@
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
-from config import TELEGRAM_BOT_TOKEN, REDIS_DB, REDIS_HOST, REDIS_PORT
+from telegram import Update
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters
+from config import TELEGRAM_BOT_TOKEN, REDIS_DB, REDIS_HOST, REDIS_PORT, CONVERSATION_FLUSH_INTERVAL, BAN_LIST_REFRESH_INTERVAL, CONCURRENT_UPDATES
 from handlers import (
     user_handlers,
     model_handlers,
@@ -16,13 +17,25 @@ from handlers import (
 from model_cache import periodic_cache_update
 from voice_cache import periodic_voice_cache_update
 from performance_metrics import save_performance_data
-from database import cleanup_old_generations
+from ban_list import refresh_ban_list
+from queue_system import check_queue_status
+from update_processing import ChatOrderedUpdateProcessor
+from telegram_rate_limiter import RedisRateLimiter
+from database import cleanup_old_generations_async, archive_old_conversations_async, flush_conversation_buffer
 from datetime import timedelta, time
 from dramatiq_handlers import generate_image_dramatiq, analyze_image_dramatiq, fluxnew_command, suno_generate_instrumental_dramatiq, suno_generate_music_dramatiq, setup_cust_mus_gen_handler
 import redis
 
 def create_application():
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Outbound calls share the Redis-backed rate limits with the Dramatiq workers
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN).rate_limiter(RedisRateLimiter())
+    if CONCURRENT_UPDATES > 1:
+        # A slow handler only holds up its own chat instead of every update behind it
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+    application = builder.build()
+
+    # Drop updates from banned users before any other handler sees them
+    application.add_handler(TypeHandler(Update, admin_handlers.reject_banned_users), group=-1)
 
     # Add handlers from user_handlers first
     application.add_handler(user_handlers.conv_handler)
@@ -31,6 +44,7 @@ def create_application():
     application.add_handler(CommandHandler("set_system_message", user_handlers.set_system_message))
     application.add_handler(CommandHandler("get_system_message", user_handlers.get_system_message))
     application.add_handler(CommandHandler("delete_session", user_handlers.delete_session_command))
+    application.add_handler(CommandHandler("queue_status", check_queue_status))
 
     # Add GPT handlers early (to catch voice_select callbacks)
     gpt_handlers.setup_gpt_handlers(application)
@@ -109,9 +123,12 @@ async def initialize_bot():
     application.job_queue.run_repeating(periodic_cache_update, interval=timedelta(days=1), first=10)
     application.job_queue.run_repeating(periodic_voice_cache_update, interval=timedelta(days=1), first=10)
     application.job_queue.run_repeating(save_performance_data, interval=timedelta(hours=1), first=10)
+    application.job_queue.run_repeating(flush_conversation_buffer, interval=CONVERSATION_FLUSH_INTERVAL, first=CONVERSATION_FLUSH_INTERVAL)
+    application.job_queue.run_repeating(refresh_ban_list, interval=BAN_LIST_REFRESH_INTERVAL, first=BAN_LIST_REFRESH_INTERVAL)
     application.job_queue.run_once(leonardo_handlers.update_leonardo_model_cache, when=0)
     application.job_queue.run_repeating(leonardo_handlers.update_leonardo_model_cache, interval=timedelta(days=1), first=timedelta(days=1))
-    application.job_queue.run_daily(lambda _: cleanup_old_generations(), time=time(hour=0, minute=0))
+    application.job_queue.run_daily(lambda _: cleanup_old_generations_async(), time=time(hour=0, minute=0))
+    application.job_queue.run_daily(lambda _: archive_old_conversations_async(), time=time(hour=0, minute=30))
 
     redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
     audio_id_pattern = "user:*:audio_id"
@@ -0,0 +1,77 @@
+# claude_context.py
+
+import logging
+from config import DEFAULT_SYSTEM_MESSAGE
+from utils import anthropic_client
+from performance_metrics import record_prompt_cache_usage
+from response_cache import cache_key, get_cached_response, store_response
+from context_budget import fit_history, with_summary
+
+logger = logging.getLogger(__name__)
+
+# Builds the system/messages arguments for a Claude call with prompt caching.
+# Cache breakpoints go on the system message and on the last turn of the stored
+# history, the parts that repeat verbatim between a user's requests, so the
+# provider can reuse them and only the newest message is processed in full.
+# Prefixes shorter than the model's minimum cacheable length are simply not
+# cached.
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+def _cached_message(message: dict) -> dict:
+    content = message["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    else:
+        content = [dict(block) for block in content]
+    content[-1]["cache_control"] = CACHE_CONTROL
+    return {**message, "content": content}
+
+def build_request(system_message: str, history: list, user_message: str) -> dict:
+    """Keyword arguments for messages.create/stream with the stable prefix marked for caching."""
+    messages = list(history)
+    if messages:
+        messages[-1] = _cached_message(messages[-1])
+    messages.append({"role": "user", "content": user_message})
+    return {
+        "system": [{"type": "text", "text": system_message, "cache_control": CACHE_CONTROL}],
+        "messages": messages
+    }
+
+async def stream_reply(reply, model: str, system_message: str, history: list, user_message: str, max_tokens: int = 1000, summary: str = None) -> str:
+    """Stream a Claude reply into a started StreamingReply and return the full text.
+
+    `summary` is the conversation's running summary of turns no longer in
+    `history`; it is appended to the system message. First turns with the
+    default system message are pure functions of the message, so they are
+    answered from the response cache when possible.
+    """
+    system_message = with_summary(system_message, summary)
+    history, _ = fit_history(model, history, system_message, {"role": "user", "content": user_message})
+    key = None
+    if not history and system_message == DEFAULT_SYSTEM_MESSAGE:
+        key = cache_key("claude_first_turn", model, system_message, user_message, {"max_tokens": max_tokens})
+        cached = await get_cached_response("claude_first_turn", key)
+        if cached is not None:
+            await reply.feed(cached)
+            return await reply.finish()
+
+    async with anthropic_client.beta.prompt_caching.messages.stream(
+        model=model,
+        max_tokens=max_tokens,
+        **build_request(system_message, history, user_message)
+    ) as stream:
+        async for text in stream.text_stream:
+            await reply.feed(text)
+        record_usage((await stream.get_final_message()).usage)
+    response = await reply.finish()
+    if key and reply.first_token_at is not None:
+        await store_response(key, model, response)
+    return response
+
+def record_usage(usage):
+    read = getattr(usage, "cache_read_input_tokens", None) or 0
+    written = getattr(usage, "cache_creation_input_tokens", None) or 0
+    uncached = getattr(usage, "input_tokens", None) or 0
+    record_prompt_cache_usage(read, written, uncached)
+    logger.debug(f"Prompt cache: {read} tokens read, {written} written, {uncached} uncached")
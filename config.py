@@ -22,6 +22,127 @@ POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", 5432))
 POSTGRES_DB = os.getenv("POSTGRES_DB", "your_db_name")
 POSTGRES_USER = os.getenv("POSTGRES_USER", "your_username")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "your_password")
+POSTGRES_POOL_MIN_SIZE = int(os.getenv("POSTGRES_POOL_MIN_SIZE", 1))
+POSTGRES_POOL_MAX_SIZE = int(os.getenv("POSTGRES_POOL_MAX_SIZE", 10))
+POSTGRES_POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT", 10))
+
+# user_generations is partitioned by day; old days are dropped, upcoming days are created ahead
+GENERATION_RETENTION_DAYS = int(os.getenv("GENERATION_RETENTION_DAYS", 30))
+GENERATION_PARTITIONS_AHEAD = int(os.getenv("GENERATION_PARTITIONS_AHEAD", 7))
+
+# conversations is partitioned by month; months older than this are moved to gzip files on disk
+CONVERSATION_ARCHIVE_AFTER_DAYS = int(os.getenv("CONVERSATION_ARCHIVE_AFTER_DAYS", 180))
+CONVERSATION_ARCHIVE_DIR = os.getenv("CONVERSATION_ARCHIVE_DIR", "archive/conversations")
+
+# Chat replies are buffered and written to Postgres in batches (size or time trigger, whichever comes first)
+CONVERSATION_FLUSH_SIZE = int(os.getenv("CONVERSATION_FLUSH_SIZE", 200))
+CONVERSATION_FLUSH_INTERVAL = float(os.getenv("CONVERSATION_FLUSH_INTERVAL", 5))
+
+# Seconds a process keeps a user's preferences row in memory (writes invalidate it immediately)
+PREFERENCES_CACHE_TTL = float(os.getenv("PREFERENCES_CACHE_TTL", 300))
+
+# Full reload of the in-memory ban list as a backstop for missed pub/sub messages
+BAN_LIST_REFRESH_INTERVAL = float(os.getenv("BAN_LIST_REFRESH_INTERVAL", 600))
+
+# Seconds a user's session hash lives after its last write
+SESSION_TTL = int(os.getenv("SESSION_TTL", 3600))
+
+# Claude API client: overall request timeout (seconds) and the shared HTTP connection pool size
+ANTHROPIC_TIMEOUT = float(os.getenv("ANTHROPIC_TIMEOUT", 60))
+ANTHROPIC_MAX_CONNECTIONS = int(os.getenv("ANTHROPIC_MAX_CONNECTIONS", 100))
+
+# Chat replies are streamed into Telegram by editing one message; seconds between edits
+# (groups have tighter edit limits, and the interval backs off up to the max on RetryAfter)
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "true").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.0))
+STREAM_GROUP_EDIT_INTERVAL = float(os.getenv("STREAM_GROUP_EDIT_INTERVAL", 3.0))
+STREAM_MAX_EDIT_INTERVAL = float(os.getenv("STREAM_MAX_EDIT_INTERVAL", 10.0))
+
+# Exact-match LLM response cache (Redis, LRU-bounded); per-model TTLs as "model=seconds,model=seconds"
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 10000))
+LLM_CACHE_DEFAULT_TTL = int(os.getenv("LLM_CACHE_DEFAULT_TTL", 24 * 60 * 60))
+LLM_CACHE_MODEL_TTLS = {
+    model.strip(): int(ttl)
+    for model, _, ttl in (item.partition("=") for item in os.getenv("LLM_CACHE_MODEL_TTLS", "").split(",") if item.strip())
+}
+
+# Token budget for the prompt sent to chat models (system message, history and new message);
+# per-model overrides as "model=tokens,model=tokens". Stored history is capped at the message counts below.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 4000))
+CONTEXT_MODEL_TOKEN_BUDGETS = {
+    model.strip(): int(tokens)
+    for model, _, tokens in (item.partition("=") for item in os.getenv("CONTEXT_MODEL_TOKEN_BUDGETS", "").split(",") if item.strip())
+}
+CHAT_HISTORY_MAX_MESSAGES = int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", 50))
+VOICE_HISTORY_MAX_MESSAGES = int(os.getenv("VOICE_HISTORY_MAX_MESSAGES", 20))
+
+# Telegram updates handled at once by the Application; updates from the same chat are still
+# handled one at a time, in order. 1 processes every update sequentially.
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 64))
+
+# How updates reach the bot: "polling" (getUpdates) or "webhook" (embedded aiohttp server).
+# In webhook mode WEBHOOK_URL is the public URL registered with Telegram (skipped when
+# WEBHOOK_REGISTER is off, e.g. for workers behind webhook_server.py's fan-out), and every request
+# must carry WEBHOOK_SECRET_TOKEN. Only ALLOWED_UPDATES types are requested and accepted.
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "true").lower() in ("1", "true", "yes")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+# Fan-out ingress (python webhook_server.py): worker webhook URLs, updates routed by chat
+WEBHOOK_FANOUT_TARGETS = [url.strip() for url in os.getenv("WEBHOOK_FANOUT_TARGETS", "").split(",") if url.strip()]
+ALLOWED_UPDATES = [kind.strip() for kind in os.getenv("ALLOWED_UPDATES", "message,callback_query").split(",") if kind.strip()]
+
+# Outbound Bot API limits, enforced across the bot and the Dramatiq workers through Redis token
+# buckets: requests per second overall, per private chat and per group (Telegram allows about
+# 30/s, 1/s and 20/min), the burst a chat may use, and how often a request is retried on RetryAfter
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", 20 / 60))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", 3))
+TELEGRAM_RETRY_AFTER_MAX_RETRIES = int(os.getenv("TELEGRAM_RETRY_AFTER_MAX_RETRIES", 3))
+
+# Progress messages of long jobs are refreshed by one scheduler every PROGRESS_TICK seconds. Each
+# message's interval starts at PROGRESS_MIN_INTERVAL and grows by PROGRESS_BACKOFF_FACTOR up to
+# PROGRESS_MAX_INTERVAL; progress pushed by a job resets it. Messages are dropped after PROGRESS_MAX_AGE.
+PROGRESS_TICK = float(os.getenv("PROGRESS_TICK", 1.0))
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", 3.0))
+PROGRESS_MAX_INTERVAL = float(os.getenv("PROGRESS_MAX_INTERVAL", 20.0))
+PROGRESS_BACKOFF_FACTOR = float(os.getenv("PROGRESS_BACKOFF_FACTOR", 1.5))
+PROGRESS_MAX_AGE = float(os.getenv("PROGRESS_MAX_AGE", 15 * 60))
+
+# In-process handler queues: number of worker shards per queue type. Tasks are sharded by
+# user id, so one user's requests run in order while different users run concurrently.
+QUICK_QUEUE_WORKERS = int(os.getenv("QUICK_QUEUE_WORKERS", 8))
+LONG_RUN_QUEUE_WORKERS = int(os.getenv("LONG_RUN_QUEUE_WORKERS", 4))
+# Within a shard users are served by deficit round-robin; a user's weight is how many tasks
+# they get per round. Admins get QUEUE_ADMIN_WEIGHT, other users 1 unless listed as "user_id=weight,..."
+QUEUE_ADMIN_WEIGHT = float(os.getenv("QUEUE_ADMIN_WEIGHT", 2))
+QUEUE_USER_WEIGHTS = {
+    int(user_id): float(weight)
+    for user_id, _, weight in (item.partition("=") for item in os.getenv("QUEUE_USER_WEIGHTS", "").split(",") if item.strip())
+}
+# A weight of 0 or less would never earn a turn
+if QUEUE_ADMIN_WEIGHT <= 0 or any(weight <= 0 for weight in QUEUE_USER_WEIGHTS.values()):
+    raise ValueError("QUEUE_ADMIN_WEIGHT and the weights in QUEUE_USER_WEIGHTS must be greater than 0.")
+# Admission control: tasks a shard holds before new work is refused (or a heavy user's newest task
+# is shed), pending tasks per user per queue type, and seconds a task may wait before it is
+# dropped as stale (0 = no limit)
+QUICK_QUEUE_MAX_DEPTH = int(os.getenv("QUICK_QUEUE_MAX_DEPTH", 50))
+LONG_RUN_QUEUE_MAX_DEPTH = int(os.getenv("LONG_RUN_QUEUE_MAX_DEPTH", 20))
+QUEUE_MAX_TASKS_PER_USER = int(os.getenv("QUEUE_MAX_TASKS_PER_USER", 5))
+QUICK_QUEUE_MAX_WAIT = float(os.getenv("QUICK_QUEUE_MAX_WAIT", 120))
+LONG_RUN_QUEUE_MAX_WAIT = float(os.getenv("LONG_RUN_QUEUE_MAX_WAIT", 0))
+
+# Once a stored history reaches SUMMARY_TRIGGER_MESSAGES, a background job folds all but the
+# last SUMMARY_KEEP_MESSAGES into a running summary written by SUMMARY_MODEL
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "claude-3-haiku-20240307")
+SUMMARY_TRIGGER_MESSAGES = int(os.getenv("SUMMARY_TRIGGER_MESSAGES", 16))
+SUMMARY_KEEP_MESSAGES = int(os.getenv("SUMMARY_KEEP_MESSAGES", 6))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", 500))
 
 # Check if the environment variables are set
 if not TELEGRAM_BOT_TOKEN or not ANTHROPIC_API_KEY:
@@ -0,0 +1,111 @@
+# context_budget.py
+
+import logging
+import os
+import anthropic
+from config import CONTEXT_TOKEN_BUDGET, CONTEXT_MODEL_TOKEN_BUDGETS
+from performance_metrics import record_context_tokens
+
+logger = logging.getLogger(__name__)
+
+# Fits conversation history into a per-model token budget instead of a fixed
+# number of turns. Tokens are counted locally with the tokenizer that ships
+# with the anthropic package (an estimate for current Claude and GPT models,
+# which is all a budget needs); if it can't be loaded, ~4 characters per token
+# is used. The newest turns are kept; the oldest turn that only partly fits is
+# truncated from the front and anything older is dropped.
+
+# Per-message framing (role markers etc.) and the flat estimate for non-text
+# blocks such as voice recordings
+MESSAGE_OVERHEAD_TOKENS = 4
+NON_TEXT_BLOCK_TOKENS = 500
+# A truncated turn shorter than this is dropped instead
+MIN_TRUNCATED_TOKENS = 64
+
+_tokenizer = None
+_tokenizer_loaded = False
+
+def _get_tokenizer():
+    global _tokenizer, _tokenizer_loaded
+    if not _tokenizer_loaded:
+        _tokenizer_loaded = True
+        try:
+            from tokenizers import Tokenizer
+            _tokenizer = Tokenizer.from_file(os.path.join(os.path.dirname(anthropic.__file__), "tokenizer.json"))
+        except Exception as e:
+            logger.warning(f"Local tokenizer unavailable, estimating tokens from length: {e}")
+    return _tokenizer
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    tokenizer = _get_tokenizer()
+    if tokenizer is None:
+        return len(text) // 4 + 1
+    return len(tokenizer.encode(text).ids)
+
+def message_tokens(message: dict) -> int:
+    content = message.get("content")
+    if isinstance(content, str):
+        return MESSAGE_OVERHEAD_TOKENS + count_tokens(content)
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    for block in content or []:
+        if block.get("type") == "text":
+            tokens += count_tokens(block.get("text", ""))
+        else:
+            tokens += NON_TEXT_BLOCK_TOKENS
+    return tokens
+
+def token_budget(model: str) -> int:
+    return CONTEXT_MODEL_TOKEN_BUDGETS.get(model, CONTEXT_TOKEN_BUDGET)
+
+def _truncate(message: dict, tokens: int):
+    # Keep the end of the turn, the part closest to the rest of the conversation
+    content = message.get("content")
+    if not isinstance(content, str) or tokens < MIN_TRUNCATED_TOKENS:
+        return None
+    text = content
+    while text and count_tokens(text) + MESSAGE_OVERHEAD_TOKENS + 1 > tokens:
+        text = text[len(text) // 4 or 1:]
+    if not text:
+        return None
+    return {**message, "content": f"…{text}"}
+
+SUMMARY_HEADER = "Summary of the earlier part of this conversation:"
+
+def summary_text(summary: str) -> str:
+    return f"{SUMMARY_HEADER}\n{summary}"
+
+def with_summary(system_message: str, summary) -> str:
+    """The system message with the conversation's running summary appended, if it has one."""
+    return f"{system_message}\n\n{summary_text(summary)}" if summary else system_message
+
+def fit_history(model: str, history: list, *fixed) -> tuple:
+    """The newest part of `history` that fits the model's budget next to the fixed parts.
+
+    `fixed` are the parts always sent (system message string, the new user
+    message dict). Returns (messages, total_tokens) where total_tokens covers
+    the fixed parts too; the total is recorded in the performance metrics.
+    """
+    used = sum(count_tokens(part) if isinstance(part, str) else message_tokens(part) for part in fixed)
+    remaining = token_budget(model) - used
+    kept = []
+    for message in reversed(history):
+        tokens = message_tokens(message)
+        if tokens > remaining:
+            truncated = _truncate(message, remaining)
+            if truncated is not None:
+                kept.append(truncated)
+                remaining -= message_tokens(truncated)
+            break
+        kept.append(message)
+        remaining -= tokens
+    kept.reverse()
+    # The history must start with a user turn
+    while kept and kept[0].get("role") != "user":
+        remaining += message_tokens(kept.pop(0))
+    total = token_budget(model) - remaining
+    record_context_tokens(total)
+    if len(kept) < len(history):
+        logger.debug(f"Context for {model}: kept {len(kept)} of {len(history)} messages, {total} tokens")
+    return kept, total
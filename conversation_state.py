@@ -0,0 +1,132 @@
+# conversation_state.py
+
+import json
+import logging
+from typing import Optional
+import redis
+import redis.asyncio as aioredis
+from config import (REDIS_HOST, REDIS_PORT, REDIS_DB, SESSION_TTL,
+                    CHAT_HISTORY_MAX_MESSAGES, VOICE_HISTORY_MAX_MESSAGES, SUMMARY_TRIGGER_MESSAGES)
+
+logger = logging.getLogger(__name__)
+
+# Recent conversation turns kept as a Redis list, one JSON message per element.
+# Appending pushes the new messages, trims the list to max_messages and
+# refreshes the TTL in one MULTI/EXEC pipeline, so a turn costs the same no
+# matter how long the conversation has been going and concurrent appends can't
+# overwrite each other. Reads are a single LRANGE of the tail.
+#
+# Once a conversation grows past SUMMARY_TRIGGER_MESSAGES a background job
+# (dramatiq_tasks.summary_tasks) folds the older turns into a running summary
+# stored next to the list under "{key}:summary" and removes them from the list.
+# The compaction is a script that only trims if the list still starts with the
+# turns that were summarized, so appends made meanwhile are never lost.
+
+SUMMARY_LOCK_TTL = 300
+
+COMPACT_SCRIPT = """
+if redis.call('LINDEX', KEYS[1], tonumber(ARGV[1]) - 1) ~= ARGV[2] then
+    return 0
+end
+redis.call('LTRIM', KEYS[1], ARGV[1], -1)
+redis.call('SET', KEYS[2], ARGV[3], 'EX', ARGV[4])
+return 1
+"""
+
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+async_redis_client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+compact_script = redis_client.register_script(COMPACT_SCRIPT)
+
+class ConversationState:
+    def __init__(self, key: str, max_messages: int = 10, ttl: int = 24 * 60 * 60):
+        self.key = key
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.summary_key = f"{key}:summary"
+        self.lock_key = f"{key}:summarizing"
+
+    def _append_pipeline(self, pipe, messages: tuple):
+        pipe.rpush(self.key, *(json.dumps(message) for message in messages))
+        pipe.ltrim(self.key, -self.max_messages, -1)
+        pipe.expire(self.key, self.ttl)
+        pipe.expire(self.summary_key, self.ttl)
+
+    def _length(self, results: list) -> int:
+        return min(results[0], self.max_messages)
+
+    def needs_summary(self, length: int) -> bool:
+        return length >= min(SUMMARY_TRIGGER_MESSAGES, self.max_messages)
+
+    @staticmethod
+    def _decode(raw: list) -> list:
+        return [json.loads(item) for item in raw]
+
+    def append(self, *messages: dict) -> int:
+        """Append messages and return the resulting length of the history."""
+        if not messages:
+            return redis_client.llen(self.key)
+        pipe = redis_client.pipeline(transaction=True)
+        self._append_pipeline(pipe, messages)
+        return self._length(pipe.execute())
+
+    def recent(self, count: Optional[int] = None) -> list:
+        """The last `count` messages (all kept messages by default), oldest first."""
+        return self._decode(redis_client.lrange(self.key, -(count or self.max_messages), -1))
+
+    def recent_with_summary(self) -> tuple:
+        """(summary or None, recent messages) in one round trip."""
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(self.summary_key)
+        pipe.lrange(self.key, -self.max_messages, -1)
+        summary, raw = pipe.execute()
+        return (summary.decode('utf-8') if summary else None), self._decode(raw)
+
+    def compact(self, count: int, last_message: dict, summary: str) -> bool:
+        """Replace the first `count` messages with `summary`, if they are still the first ones."""
+        return bool(compact_script(keys=[self.key, self.summary_key], args=[count, json.dumps(last_message), summary, self.ttl]))
+
+    def claim_summary(self) -> bool:
+        return bool(redis_client.set(self.lock_key, 1, nx=True, ex=SUMMARY_LOCK_TTL))
+
+    def release_summary(self):
+        redis_client.delete(self.lock_key)
+
+    def clear(self):
+        redis_client.delete(self.key, self.summary_key)
+
+    async def append_async(self, *messages: dict) -> int:
+        if not messages:
+            return await async_redis_client.llen(self.key)
+        pipe = async_redis_client.pipeline(transaction=True)
+        self._append_pipeline(pipe, messages)
+        return self._length(await pipe.execute())
+
+    async def recent_async(self, count: Optional[int] = None) -> list:
+        return self._decode(await async_redis_client.lrange(self.key, -(count or self.max_messages), -1))
+
+    async def recent_with_summary_async(self) -> tuple:
+        pipe = async_redis_client.pipeline(transaction=False)
+        pipe.get(self.summary_key)
+        pipe.lrange(self.key, -self.max_messages, -1)
+        summary, raw = await pipe.execute()
+        return (summary.decode('utf-8') if summary else None), self._decode(raw)
+
+    async def claim_summary_async(self) -> bool:
+        return bool(await async_redis_client.set(self.lock_key, 1, nx=True, ex=SUMMARY_LOCK_TTL))
+
+    async def clear_async(self):
+        await async_redis_client.delete(self.key, self.summary_key)
+
+def claude_conversation(user_id: int) -> ConversationState:
+    """History of the Claude text chat, expires with the user's session."""
+    return ConversationState(f"conversation:claude:{user_id}", max_messages=CHAT_HISTORY_MAX_MESSAGES, ttl=SESSION_TTL)
+
+def voice_conversation(user_id: int) -> ConversationState:
+    """History of the GPT-4o voice chat."""
+    return ConversationState(f"user:{user_id}:conversation", max_messages=VOICE_HISTORY_MAX_MESSAGES, ttl=24 * 60 * 60)
+
+# Conversation kinds by name, so background jobs can be pointed at one
+CONVERSATIONS = {
+    "claude": claude_conversation,
+    "voice": voice_conversation,
+}
@@ -3,16 +3,35 @@
 import sqlite3
 import logging
 import asyncio
+import csv
+import functools
+import gzip
+import io
+import os
+import re
+import threading
+import time
 import requests
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
 import redis
-import uuid
 import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from psycopg2 import sql
-from datetime import timedelta
+from datetime import date, timedelta
 from typing import List, Dict, Optional
 from config import (LEONARDO_API_BASE_URL, LEONARDO_AI_KEY, REDIS_HOST, REDIS_PORT, REDIS_DB,
-                    POSTGRES_HOST, POSTGRES_PORT, POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD)
+                    POSTGRES_HOST, POSTGRES_PORT, POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD,
+                    POSTGRES_POOL_MIN_SIZE, POSTGRES_POOL_MAX_SIZE, POSTGRES_POOL_TIMEOUT,
+                    GENERATION_RETENTION_DAYS, GENERATION_PARTITIONS_AHEAD,
+                    CONVERSATION_ARCHIVE_AFTER_DAYS, CONVERSATION_ARCHIVE_DIR,
+                    CONVERSATION_FLUSH_SIZE)
+from migrations import (ensure_schema, lock_partition_maintenance, first_of_month, list_partitions,
+                        create_generation_partition, create_conversation_partition, default_partition_periods,
+                        GENERATION_PARTITION_PREFIX, CONVERSATION_PARTITION_PREFIX, STATS_ROLLUP_SLOTS)
 import openai
 
 logger = logging.getLogger(__name__)
@@ -26,81 +45,190 @@ for key in redis_client.scan_iter(audio_id_pattern):
     redis_client.delete(key)
 
 # PostgreSQL setup
+#
+# Every process (the bot and each Dramatiq worker) keeps one bounded pool of
+# connections. Sync callers borrow a connection with get_postgres_connection();
+# async handlers go through the *_async wrappers below, which run the same sync
+# functions on a thread pool that is exactly as large as the connection pool, so
+# the event loop never blocks on a handshake or a query.
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """Connection that remembers which statements were PREPAREd on it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+_pool = None
+_pool_pid = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+_db_executor = None
+
+def _get_pool():
+    global _pool, _pool_pid, _pool_slots, _db_executor
+    # Re-create the pool after a fork, connections must never be shared between processes
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    POSTGRES_POOL_MIN_SIZE,
+                    POSTGRES_POOL_MAX_SIZE,
+                    host=POSTGRES_HOST,
+                    port=POSTGRES_PORT,
+                    dbname=POSTGRES_DB,
+                    user=POSTGRES_USER,
+                    password=POSTGRES_PASSWORD,
+                    connection_factory=PreparingConnection
+                )
+                _pool_slots = threading.BoundedSemaphore(POSTGRES_POOL_MAX_SIZE)
+                _db_executor = ThreadPoolExecutor(max_workers=POSTGRES_POOL_MAX_SIZE, thread_name_prefix="db")
+                _pool_pid = os.getpid()
+                logger.info(f"PostgreSQL connection pool created (min={POSTGRES_POOL_MIN_SIZE}, max={POSTGRES_POOL_MAX_SIZE})")
+    return _pool
+
+@contextmanager
 def get_postgres_connection():
-    return psycopg2.connect(
-        host=POSTGRES_HOST,
-        port=POSTGRES_PORT,
-        dbname=POSTGRES_DB,
-        user=POSTGRES_USER,
-        password=POSTGRES_PASSWORD
-    )
+    """Borrow a pooled connection, waiting for a free slot instead of failing when the pool is busy.
+
+    The transaction is committed when the block exits normally and rolled back on error,
+    so a connection always goes back to the pool idle.
+    """
+    pool = _get_pool()
+    slots = _pool_slots
+    if not slots.acquire(timeout=POSTGRES_POOL_TIMEOUT):
+        raise psycopg2.pool.PoolError(f"Timed out after {POSTGRES_POOL_TIMEOUT}s waiting for a database connection")
+    try:
+        conn = pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        slots.release()
+
+def close_db_pool():
+    global _pool, _db_executor
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+            _db_executor.shutdown(wait=False)
+            logger.info("PostgreSQL connection pool closed")
+        _pool = None
+        _db_executor = None
+
+def execute_prepared(cur, name: str, query: str, params: tuple = ()):
+    """Execute a hot-path query as a server-side prepared statement.
+
+    The statement is PREPAREd once per pooled connection and EXECUTEd afterwards,
+    so Postgres only parses and plans it the first time. `query` uses the usual
+    %s placeholders.
+    """
+    conn = cur.connection
+    if name not in conn.prepared_statements:
+        positions = iter(range(1, len(params) + 1))
+        statement = re.sub(r"%s", lambda _: f"${next(positions)}", query)
+        cur.execute(f"PREPARE {name} AS {statement}")
+        conn.prepared_statements.add(name)
+    if params:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database function on the database thread pool."""
+    _get_pool()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+def _awaitable(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    wrapper.__name__ = f"{func.__name__}_async"
+    wrapper.__qualname__ = wrapper.__name__
+    return wrapper
+
+def maintain_generation_partitions(cur):
+    """Create the partitions for the coming days and drop the ones past retention."""
+    lock_partition_maintenance(cur)
+    today = date.today()
+    for offset in range(GENERATION_PARTITIONS_AHEAD + 1):
+        create_generation_partition(cur, today + timedelta(days=offset))
+
+    cutoff = today - timedelta(days=GENERATION_RETENTION_DAYS)
+    # Days written while no partition existed for them landed in the default partition
+    for day in default_partition_periods(cur, "user_generations", 'day'):
+        if day >= cutoff:
+            create_generation_partition(cur, day)
+    cur.execute("DELETE FROM user_generations_default WHERE timestamp < %s", (cutoff,))
+    dropped = 0
+    for day, name in sorted(list_partitions(cur, "user_generations", GENERATION_PARTITION_PREFIX, '%Y%m%d').items()):
+        if day < cutoff:
+            cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(name)))
+            dropped += 1
+    return dropped
+
+def maintain_conversation_partitions(cur):
+    """Make sure this month's and next month's conversation partitions exist."""
+    lock_partition_maintenance(cur)
+    current_month = first_of_month(date.today())
+    create_conversation_partition(cur, current_month)
+    create_conversation_partition(cur, first_of_month(current_month, 1))
+    # Months written while no partition existed for them; archiving picks them up from there
+    for month in default_partition_periods(cur, "conversations", 'month'):
+        create_conversation_partition(cur, month)
+
+# Columns of user_preferences; anything else passed as a model_type is rejected
+PREFERENCE_COLUMNS = ('claude_model', 'flux_model', 'suno_model', 'image_model', 'openai_model',
+                      'leonardo_model', 'replicate_model', 'tts_voice', 'gpt_voice')
+PREFERENCES_INVALIDATION_CHANNEL = "user_preferences:invalidate"
+BAN_LIST_CHANNEL = "banned_users:changes"
+
+_schema_checked_pid = None
 
 def init_db():
+    """Bring the schema up to date. Once per process; when the schema is current this is a single SELECT."""
+    global _schema_checked_pid
+    if _schema_checked_pid == os.getpid():
+        return
     try:
         with get_postgres_connection() as conn:
-            with conn.cursor() as cur:
-                # Create user_generations table
-                cur.execute("""
-                CREATE TABLE IF NOT EXISTS user_generations
-                (id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                prompt TEXT,
-                generation_type VARCHAR(20),
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
-                """)
-
-                # Create user_preferences table
-                cur.execute("""
-                CREATE TABLE IF NOT EXISTS user_preferences (
-                    user_id BIGINT PRIMARY KEY,
-                    flux_model TEXT,
-                    suno_model TEXT,
-                    image_model TEXT,
-                    openai_model TEXT,
-                    leonardo_model TEXT,
-                    replicate_model TEXT
-                )
-                """)
-
-                # Create conversations table
-                cur.execute("""
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    user_message TEXT,
-                    bot_response TEXT,
-                    model_type VARCHAR(20),
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-                """)
-
-                # Create users table
-                cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id BIGINT PRIMARY KEY,
-                    total_messages INT DEFAULT 0,
-                    total_claude_messages INT DEFAULT 0,
-                    total_gpt_messages INT DEFAULT 0,
-                    last_interaction TIMESTAMP
-                )
-                """)
-            conn.commit()
-        logger.info("Database initialized successfully")
+            version = ensure_schema(conn)
+        _schema_checked_pid = os.getpid()
+        logger.info(f"Database schema at version {version}")
     except Exception as e:
         logger.error(f"Error initializing database: {e}")
         raise
 
+def maintain_partitions():
+    """Create upcoming partitions and drop expired generation partitions; run by the bot at startup."""
+    try:
+        with get_postgres_connection() as conn:
+            with conn.cursor() as cur:
+                maintain_generation_partitions(cur)
+                maintain_conversation_partitions(cur)
+        logger.info("Partitions maintained")
+    except Exception as e:
+        logger.error(f"Error maintaining partitions: {e}")
+
 def save_conversation(user_id: int, user_message: str, bot_response: str, model_type: str = 'claude'):
     try:
         with get_postgres_connection() as conn:
             with conn.cursor() as cur:
                 # Insert into conversations table
-                cur.execute(
+                execute_prepared(
+                    cur, "insert_conversation",
                     "INSERT INTO conversations (user_id, user_message, bot_response, model_type) VALUES (%s, %s, %s, %s)",
                     (user_id, user_message, bot_response, model_type)
                 )
                 # Update or insert into users table
-                cur.execute("""
+                execute_prepared(cur, "upsert_user_counts", """
                     INSERT INTO users (id, total_messages, total_claude_messages, total_gpt_messages, last_interaction) 
                     VALUES (%s, 1, CASE WHEN %s = 'claude' THEN 1 ELSE 0 END, CASE WHEN %s = 'gpt' THEN 1 ELSE 0 END, NOW())
                     ON CONFLICT (id) DO UPDATE SET 
@@ -108,44 +236,135 @@ def save_conversation(user_id: int, user_message: str, bot_response: str, model_
                     total_claude_messages = users.total_claude_messages + CASE WHEN %s = 'claude' THEN 1 ELSE 0 END,
                     total_gpt_messages = users.total_gpt_messages + CASE WHEN %s = 'gpt' THEN 1 ELSE 0 END,
                     last_interaction = NOW()
+                    RETURNING (xmax = 0)
                 """, (user_id, model_type, model_type, model_type, model_type))
+                new_user = cur.fetchone()[0]
+                execute_prepared(cur, "bump_stats_rollup", """
+                    UPDATE user_stats_rollup SET
+                    total_users = total_users + %s,
+                    total_messages = total_messages + 1,
+                    total_claude_messages = total_claude_messages + %s,
+                    total_gpt_messages = total_gpt_messages + %s
+                    WHERE slot = %s
+                """, (int(new_user), int(model_type == 'claude'), int(model_type == 'gpt'), user_id % STATS_ROLLUP_SLOTS))
             conn.commit()
+        _mark_active({user_id: time.time()})
         logger.info(f"Conversation saved and counts updated for user {user_id} using {model_type} model")
     except Exception as e:
         logger.error(f"Error saving conversation: {e}")
-def get_all_users() -> List[int]:
+def save_conversations_bulk(rows: List[tuple], counters: Dict[int, list]):
+    """Write a batch of (user_id, user_message, bot_response, model_type, buffered_at) rows
+    with COPY and apply the aggregated per-user counter deltas in one upsert.
+
+    buffered_at (and a counter's last-seen time) is time.monotonic() when the message was
+    buffered. Rows are stamped with the database clock, CURRENT_TIMESTAMP less their age,
+    like the column default would have, so they land in the same monthly partition.
+    """
+    now = time.monotonic()
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        (user_id, user_message, bot_response, model_type, now - buffered_at)
+        for user_id, user_message, bot_response, model_type, buffered_at in rows
+    )
+    buffer.seek(0)
+    with get_postgres_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS conversation_batch (
+                    user_id BIGINT, user_message TEXT, bot_response TEXT, model_type VARCHAR(20), age DOUBLE PRECISION
+                ) ON COMMIT DELETE ROWS
+            """)
+            cur.copy_expert("COPY conversation_batch FROM STDIN WITH (FORMAT csv)", buffer)
+            cur.execute("""
+                INSERT INTO conversations (user_id, user_message, bot_response, model_type, timestamp)
+                SELECT user_id, user_message, bot_response, model_type, CURRENT_TIMESTAMP - age * INTERVAL '1 second'
+                FROM conversation_batch
+            """)
+            # Sorted by user id so concurrent flushes lock the users rows in the same order
+            inserted = psycopg2.extras.execute_values(cur, """
+                INSERT INTO users (id, total_messages, total_claude_messages, total_gpt_messages, last_interaction)
+                VALUES %s
+                ON CONFLICT (id) DO UPDATE SET
+                total_messages = users.total_messages + EXCLUDED.total_messages,
+                total_claude_messages = users.total_claude_messages + EXCLUDED.total_claude_messages,
+                total_gpt_messages = users.total_gpt_messages + EXCLUDED.total_gpt_messages,
+                last_interaction = GREATEST(users.last_interaction, EXCLUDED.last_interaction)
+                RETURNING id, (xmax = 0)
+            """, [(user_id, *counters[user_id][:3], now - counters[user_id][3]) for user_id in sorted(counters)],
+                template="(%s, %s, %s, %s, CURRENT_TIMESTAMP - %s * INTERVAL '1 second')", fetch=True)
+
+            deltas = {}
+            for user_id, new_user in inserted:
+                total, claude, gpt, _ = counters[user_id]
+                delta = deltas.setdefault(user_id % STATS_ROLLUP_SLOTS, [0, 0, 0, 0])
+                delta[0] += int(new_user)
+                delta[1] += total
+                delta[2] += claude
+                delta[3] += gpt
+            psycopg2.extras.execute_values(cur, """
+                UPDATE user_stats_rollup SET
+                total_users = user_stats_rollup.total_users + delta.users,
+                total_messages = user_stats_rollup.total_messages + delta.total,
+                total_claude_messages = user_stats_rollup.total_claude_messages + delta.claude,
+                total_gpt_messages = user_stats_rollup.total_gpt_messages + delta.gpt
+                FROM (VALUES %s) AS delta (slot, users, total, claude, gpt)
+                WHERE user_stats_rollup.slot = delta.slot
+            """, [(slot, *deltas[slot]) for slot in sorted(deltas)])
+    wall_now = time.time()
+    _mark_active({user_id: wall_now - (now - counter[3]) for user_id, counter in counters.items()})
+
+# Bulk user scans page through users by primary key (keyset pagination): each
+# page is a short indexed query on a pooled connection, so a slow consumer such
+# as a broadcast never holds a connection or a transaction open between pages.
+USER_SCAN_BATCH_SIZE = 1000
+
+def get_user_ids_page(after_id: int, limit: int = USER_SCAN_BATCH_SIZE) -> List[int]:
     with get_postgres_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT id FROM users")
+            execute_prepared(cur, "select_user_ids_page",
+                             "SELECT id FROM users WHERE id > %s ORDER BY id LIMIT %s", (after_id, limit))
             return [row[0] for row in cur.fetchall()]
 
-def get_user_generations_today(user_id: int, generation_type: str) -> int:
+async def iter_all_users(batch_size: int = USER_SCAN_BATCH_SIZE):
+    """Yield every user id, fetching batch_size ids at a time."""
+    after_id = -1
+    while True:
+        page = await run_db(get_user_ids_page, after_id, batch_size)
+        for user_id in page:
+            yield user_id
+        if len(page) < batch_size:
+            return
+        after_id = page[-1]
+
+def get_user_generations_today(user_id: int, generation_type: str) -> Optional[int]:
+    """Today's generations of `generation_type` by the user, or None if the count could not be read."""
     try:
         with get_postgres_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM user_generations WHERE user_id = %s AND generation_type = %s AND timestamp::date = CURRENT_DATE", (user_id, generation_type))
+                execute_prepared(cur, "count_generations_today", "SELECT COUNT(*) FROM user_generations WHERE user_id = %s AND generation_type = %s AND timestamp >= CURRENT_DATE AND timestamp < CURRENT_DATE + 1", (user_id, generation_type))
                 count = cur.fetchone()[0]
                 return count
     except Exception as e:
         logger.error(f"Error getting user generations: {e}")
-        return 0
+        return None
 
 def save_user_generation(user_id: int, prompt: str, generation_type: str) -> None:
     try:
         with get_postgres_connection() as conn:
             with conn.cursor() as cur:
-                generation_id = str(uuid.uuid4())
-                cur.execute("INSERT INTO user_generations (user_id, prompt, generation_type, timestamp) VALUES (%s, %s, %s, CURRENT_TIMESTAMP)", (user_id, prompt, generation_type))
+                execute_prepared(cur, "insert_generation", "INSERT INTO user_generations (user_id, prompt, generation_type, timestamp) VALUES (%s, %s, %s, CURRENT_TIMESTAMP)", (user_id, prompt, generation_type))
             conn.commit()
         logger.info(f"Generation saved for user {user_id} of type {generation_type}")
     except Exception as e:
         logger.error(f"Error saving user generation: {e}")
 
 def get_user_model(user_id: int, model_type: str) -> str:
+    if model_type not in PREFERENCE_COLUMNS:
+        raise ValueError(f"Unknown preference column: {model_type}")
     try:
         with get_postgres_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute(f"SELECT {model_type} FROM user_preferences WHERE user_id = %s", (user_id,))
+                cur.execute(sql.SQL("SELECT {} FROM user_preferences WHERE user_id = %s").format(sql.Identifier(model_type)), (user_id,))
                 result = cur.fetchone()
                 if result:
                     return result[0]
@@ -154,19 +373,43 @@ def get_user_model(user_id: int, model_type: str) -> str:
         logger.error(f"Database error in get_user_model: {e}")
         return None
 
+def get_user_preferences_row(user_id: int) -> Optional[Dict[str, str]]:
+    """The whole user_preferences row as a dict ({} for users without one, None on error)."""
+    try:
+        with get_postgres_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("SELECT {} FROM user_preferences WHERE user_id = %s").format(
+                    sql.SQL(', ').join(map(sql.Identifier, PREFERENCE_COLUMNS))
+                ), (user_id,))
+                result = cur.fetchone()
+                if result:
+                    return dict(zip(PREFERENCE_COLUMNS, result))
+                return {}
+    except Exception as e:
+        logger.error(f"Database error in get_user_preferences_row: {e}")
+        return None
+
 def save_user_model(user_id: int, model_type: str, model_name: str) -> None:
+    if model_type not in PREFERENCE_COLUMNS:
+        raise ValueError(f"Unknown preference column: {model_type}")
     try:
         with get_postgres_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute(f"""
-                    INSERT INTO user_preferences (user_id, {model_type})
+                cur.execute(sql.SQL("""
+                    INSERT INTO user_preferences (user_id, {column})
                     VALUES (%s, %s)
-                    ON CONFLICT(user_id) DO UPDATE SET {model_type} = excluded.{model_type}
-                """, (user_id, model_name))
+                    ON CONFLICT(user_id) DO UPDATE SET {column} = excluded.{column}
+                """).format(column=sql.Identifier(model_type)), (user_id, model_name))
             conn.commit()
         logger.info(f"Model preference saved for user {user_id}: {model_type} = {model_name}")
     except Exception as e:
         logger.error(f"Database error in save_user_model: {e}")
+        return
+    try:
+        # Drop the cached preferences row in every process (see preferences_cache.py)
+        redis_client.publish(PREFERENCES_INVALIDATION_CHANNEL, user_id)
+    except Exception as e:
+        logger.error(f"Error publishing preferences invalidation for user {user_id}: {e}")
 
 def clear_user_conversations(user_id: int):
     try:
@@ -182,33 +425,69 @@ def clear_user_conversations(user_id: int):
         logger.error(f"Error clearing conversations for user {user_id}: {e}")
 
 
-# Redis operations
-def save_user_session(user_id: int, session_data: dict):
-    session_key = f"user:{user_id}:session"
-    redis_client.setex(session_key, timedelta(hours=1), json.dumps(session_data))
+# Users by last interaction time (unix seconds), trimmed to the widest window
+# reported; lets get_user_stats count active users without scanning users
+ACTIVE_USERS_KEY = "stats:active_users"
+ACTIVE_USERS_WINDOW = 7 * 24 * 3600
+
+def _mark_active(last_seen: Dict[int, float]):
+    try:
+        redis_client.zadd(ACTIVE_USERS_KEY, last_seen)
+    except Exception as e:
+        logger.error(f"Error recording active users: {e}")
+
+def _seed_active_users():
+    # One-off rebuild when the sorted set is missing (first deploy or a Redis flush)
+    if not redis_client.set(f"{ACTIVE_USERS_KEY}:seeded", 1, nx=True):
+        return
+    try:
+        with get_postgres_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT id, EXTRACT(EPOCH FROM last_interaction)
+                    FROM users
+                    WHERE last_interaction > NOW() - INTERVAL '7 days'
+                """)
+                last_seen = {user_id: float(seen) for user_id, seen in cur.fetchall()}
+    except Exception:
+        redis_client.delete(f"{ACTIVE_USERS_KEY}:seeded")
+        raise
+    if last_seen:
+        # NX keeps newer scores written since the select
+        redis_client.zadd(ACTIVE_USERS_KEY, last_seen, nx=True)
+    logger.info(f"Seeded {len(last_seen)} active users")
+
+def _count_active_users() -> Dict[str, int]:
+    _seed_active_users()
+    now = time.time()
+    pipe = redis_client.pipeline()
+    pipe.zremrangebyscore(ACTIVE_USERS_KEY, "-inf", now - ACTIVE_USERS_WINDOW)
+    pipe.zcount(ACTIVE_USERS_KEY, now - 24 * 3600, "+inf")
+    pipe.zcard(ACTIVE_USERS_KEY)
+    _, active_24h, active_7d = pipe.execute()
+    return {"active_users_24h": active_24h, "active_users_7d": active_7d}
 
 def get_user_stats() -> Dict[str, int]:
+    """Totals from the user_stats_rollup rows and active user counts from Redis; constant time in the number of users."""
     try:
         with get_postgres_connection() as conn:
             with conn.cursor() as cur:
-                query = """
-                SELECT 
-                    COUNT(DISTINCT id) as total_users,
-                    COALESCE(SUM(total_messages), 0) as total_messages,
-                    COALESCE(SUM(total_claude_messages), 0) as total_claude_messages,
-                    COALESCE(SUM(total_gpt_messages), 0) as total_gpt_messages,
-                    COUNT(DISTINCT CASE WHEN last_interaction > NOW() - INTERVAL '24 hours' THEN id END) as active_users_24h
-                FROM users
-                """
-                cur.execute(query)
+                execute_prepared(cur, "select_user_stats", """
+                SELECT
+                    COALESCE(SUM(total_users), 0)::BIGINT,
+                    COALESCE(SUM(total_messages), 0)::BIGINT,
+                    COALESCE(SUM(total_claude_messages), 0)::BIGINT,
+                    COALESCE(SUM(total_gpt_messages), 0)::BIGINT
+                FROM user_stats_rollup
+                """)
                 result = cur.fetchone()
-                stats = {
-                    "total_users": result[0],
-                    "total_messages": result[1],
-                    "total_claude_messages": result[2],
-                    "total_gpt_messages": result[3],
-                    "active_users_24h": result[4]
-                }
+        stats = {
+            "total_users": result[0],
+            "total_messages": result[1],
+            "total_claude_messages": result[2],
+            "total_gpt_messages": result[3],
+            **_count_active_users()
+        }
         logger.info(f"Retrieved user stats: {stats}")
         return stats
     except Exception as e:
@@ -218,8 +497,17 @@ def get_user_stats() -> Dict[str, int]:
             "total_messages": 0,
             "total_claude_messages": 0,
             "total_gpt_messages": 0,
-            "active_users_24h": 0
+            "active_users_24h": 0,
+            "active_users_7d": 0
         }
+
+def _publish_ban_change(action: str, user_id: int):
+    try:
+        # Applied by every process's in-memory ban list (see ban_list.py)
+        redis_client.publish(BAN_LIST_CHANNEL, f"{action}:{user_id}")
+    except Exception as e:
+        logger.error(f"Error publishing {action} for user {user_id}: {e}")
+
 def ban_user(user_id: int) -> bool:
     try:
         with get_postgres_connection() as conn:
@@ -227,6 +515,7 @@ def ban_user(user_id: int) -> bool:
                 cur.execute('INSERT INTO banned_users (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING', (user_id,))
                 affected = cur.rowcount
             conn.commit()
+        _publish_ban_change("ban", user_id)
         return affected > 0
     except Exception as e:
         logger.error(f"Error banning user: {e}")
@@ -239,72 +528,132 @@ def unban_user(user_id: int) -> bool:
                 cur.execute('DELETE FROM banned_users WHERE user_id = %s', (user_id,))
                 affected = cur.rowcount
             conn.commit()
+        _publish_ban_change("unban", user_id)
         return affected > 0
     except Exception as e:
         logger.error(f"Error unbanning user: {e}")
         return False
 
 def is_user_banned(user_id: int) -> bool:
-    with get_postgres_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute('SELECT 1 FROM banned_users WHERE user_id = %s', (user_id,))
-            return cur.fetchone() is not None
+    try:
+        with get_postgres_connection() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "is_user_banned", 'SELECT 1 FROM banned_users WHERE user_id = %s', (user_id,))
+                return cur.fetchone() is not None
+    except Exception as e:
+        logger.error(f"Error checking ban status for user {user_id}: {e}")
+        return False
+
+def get_banned_user_ids() -> Optional[List[int]]:
+    try:
+        with get_postgres_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT user_id FROM banned_users')
+                return [row[0] for row in cur.fetchall()]
+    except Exception as e:
+        logger.error(f"Error loading banned users: {e}")
+        return None
         
-def get_active_users(days: int = 7) -> List[Dict[str, any]]:
+def get_top_active_users(days: int = 7, limit: int = 10) -> List[Dict[str, any]]:
+    """The most active users by message count among those seen in the last `days` days."""
     try:
         with get_postgres_connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
-                    SELECT id, first_interaction, last_interaction, 
-                           total_messages, total_claude_messages, total_gpt_messages
+                    SELECT id, last_interaction, total_messages, total_claude_messages, total_gpt_messages
                     FROM users
                     WHERE last_interaction > NOW() - (%s || ' days')::INTERVAL
-                    ORDER BY last_interaction DESC
-                """, (str(days),))
-                active_users = [
+                    ORDER BY total_messages DESC
+                    LIMIT %s
+                """, (str(days), limit))
+                return [
                     {
                         "id": row[0],
-                        "first_interaction": row[1],
-                        "last_interaction": row[2],
-                        "total_messages": row[3],
-                        "total_claude_messages": row[4],
-                        "total_gpt_messages": row[5]
+                        "last_interaction": row[1],
+                        "total_messages": row[2],
+                        "total_claude_messages": row[3],
+                        "total_gpt_messages": row[4]
                     }
                     for row in cur.fetchall()
                 ]
-        logger.info(f"Retrieved {len(active_users)} active users in the last {days} days")
-        return active_users
     except Exception as e:
-        logger.error(f"Error retrieving active users: {e}")
-        return []    
+        logger.error(f"Error retrieving top active users: {e}")
+        return []
 
 def cleanup_old_generations():
     try:
         with get_postgres_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("DELETE FROM user_generations WHERE timestamp < CURRENT_DATE - INTERVAL '30 days'")
-                deleted_count = cur.rowcount
+                dropped_count = maintain_generation_partitions(cur)
                 conn.commit()
-                logger.info(f"Cleaned up {deleted_count} old generation records")
+                logger.info(f"Dropped {dropped_count} old generation partitions")
     except Exception as e:
         logger.error(f"Error cleaning up old generations: {e}")
 
-def get_user_session(user_id: int) -> dict:
-    session_key = f"user:{user_id}:session"
-    session_data = redis_client.get(session_key)
-    if session_data:
-        return json.loads(session_data)
-    return {}
+def _archive_conversation_partition(conn, name: str) -> str:
+    path = os.path.join(CONVERSATION_ARCHIVE_DIR, f"{name}.csv.gz")
+    tmp_path = f"{path}.tmp"
+    with conn.cursor() as cur:
+        # Stream the partition straight into the gzip file; nothing is buffered in memory
+        with open(tmp_path, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as archive:
+                cur.copy_expert(sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)").format(sql.Identifier(name)), archive)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, path)
+
+        # Only detach once the archive is safely on disk
+        lock_partition_maintenance(cur)
+        cur.execute(sql.SQL("ALTER TABLE conversations DETACH PARTITION {}").format(sql.Identifier(name)))
+        cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+    conn.commit()
+    return path
+
+def archive_old_conversations():
+    """Move conversation months older than CONVERSATION_ARCHIVE_AFTER_DAYS to compressed files."""
+    try:
+        with get_postgres_connection() as conn:
+            # Every bot process runs this job. A session lock held for the whole run keeps two of them
+            # from writing the same archive file; partitions are listed only once it is held, so one
+            # archived by another process while we waited is not touched again.
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_lock(hashtext('conversation_archive'))")
+            try:
+                with conn.cursor() as cur:
+                    maintain_conversation_partitions(cur)
+                    partitions = list_partitions(cur, "conversations", CONVERSATION_PARTITION_PREFIX, '%Y%m')
+                conn.commit()
 
-def update_user_session(user_id: int, new_data: dict):
-    session = get_user_session(user_id)
-    session.update(new_data)
-    save_user_session(user_id, session)
+                cutoff = date.today() - timedelta(days=CONVERSATION_ARCHIVE_AFTER_DAYS)
+                os.makedirs(CONVERSATION_ARCHIVE_DIR, exist_ok=True)
+                for month, name in sorted(partitions.items()):
+                    if first_of_month(month, 1) > cutoff:
+                        continue
+                    path = _archive_conversation_partition(conn, name)
+                    logger.info(f"Archived conversation partition {name} to {path}")
+            finally:
+                # Session locks outlive transactions; never hand the connection back to the pool holding it
+                if not conn.closed:
+                    conn.rollback()
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT pg_advisory_unlock(hashtext('conversation_archive'))")
+    except Exception as e:
+        logger.error(f"Error archiving old conversations: {e}")
 
-def delete_user_session(user_id: int):
-    session_key = f"user:{user_id}:session"
-    redis_client.delete(session_key)
-    logger.info(f"Deleted session for user {user_id}")
+def get_top_commands(limit: int = 10) -> List[tuple]:
+    try:
+        with get_postgres_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT command, count
+                    FROM command_usage
+                    ORDER BY count DESC
+                    LIMIT %s
+                """, (limit,))
+                return cur.fetchall()
+    except Exception as e:
+        logger.error(f"Error getting top commands: {e}")
+        return []
 
 # Functions for fetching models from external sources
 async def fetch_gpt_models():
@@ -408,4 +757,121 @@ def clear_gpt_conversation(user_id: int) -> bool:
         logger.error(f"Error clearing GPT conversation for user {user_id}: {e}")
         return False
 
+class ConversationWriteBuffer:
+    """Write-behind buffer for the chat path.
+
+    Conversation rows and users counter increments are collected on the event
+    loop and written with save_conversations_bulk once CONVERSATION_FLUSH_SIZE
+    rows are pending or the periodic flush job runs. Only the bot process uses
+    it; the Dramatiq actors keep calling save_conversation directly.
+    """
+
+    # Keep at most this many unflushed rows while Postgres is unreachable
+    MAX_PENDING_FACTOR = 10
+
+    def __init__(self, flush_size: int = CONVERSATION_FLUSH_SIZE):
+        self.flush_size = flush_size
+        self.rows = []
+        self.counters = {}
+        self._flush_lock = None
+        self._flush_task = None
+
+    def add(self, user_id: int, user_message: str, bot_response: str, model_type: str = 'claude'):
+        # Only the age matters: save_conversations_bulk stamps rows with the database clock
+        now = time.monotonic()
+        self.rows.append((user_id, user_message, bot_response, model_type, now))
+        counter = self.counters.setdefault(user_id, [0, 0, 0, now])
+        counter[0] += 1
+        counter[1] += model_type == 'claude'
+        counter[2] += model_type == 'gpt'
+        counter[3] = now
+        if len(self.rows) >= self.flush_size and not (self._flush_task and not self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    def lock(self) -> asyncio.Lock:
+        """Held while a flush writes; hold it to run a statement no flush may interleave with."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+
+    def discard_user(self, user_id: int):
+        # Pending rows of a user whose history is being cleared must not reappear after the DELETE.
+        # Call with lock() held so no flush has the user's rows in flight or requeues them.
+        self.rows = [row for row in self.rows if row[0] != user_id]
+        self.counters.pop(user_id, None)
+
+    async def flush(self):
+        async with self.lock():
+            if not self.rows and not self.counters:
+                return
+            rows, counters = self.rows, self.counters
+            self.rows, self.counters = [], {}
+            try:
+                await run_db(save_conversations_bulk, rows, counters)
+                logger.info(f"Flushed {len(rows)} buffered conversations for {len(counters)} users")
+            except Exception as e:
+                logger.error(f"Error flushing buffered conversations: {e}")
+                self._requeue(rows, counters)
+
+    def _requeue(self, rows: List[tuple], counters: Dict[int, list]):
+        self.rows = rows + self.rows
+        for user_id, (total, claude, gpt, last) in counters.items():
+            counter = self.counters.setdefault(user_id, [0, 0, 0, last])
+            counter[0] += total
+            counter[1] += claude
+            counter[2] += gpt
+            counter[3] = max(counter[3], last)
+        max_pending = self.flush_size * self.MAX_PENDING_FACTOR
+        if len(self.rows) > max_pending:
+            dropped = self.rows[:-max_pending]
+            logger.error(f"Dropping {len(dropped)} buffered conversations, database unavailable")
+            self.rows = self.rows[-max_pending:]
+            # Their counter deltas go too, or the users counts would include rows never written
+            for user_id, _, _, model_type, _ in dropped:
+                counter = self.counters.get(user_id)
+                if counter is None:
+                    continue
+                counter[0] -= 1
+                counter[1] -= model_type == 'claude'
+                counter[2] -= model_type == 'gpt'
+                if counter[0] <= 0:
+                    del self.counters[user_id]
+
+conversation_buffer = ConversationWriteBuffer()
+
+async def save_conversation_async(user_id: int, user_message: str, bot_response: str, model_type: str = 'claude'):
+    conversation_buffer.add(user_id, user_message, bot_response, model_type)
+
+async def flush_conversation_buffer(context=None):
+    await conversation_buffer.flush()
+
+async def clear_user_conversations_async(user_id: int):
+    # A flush in flight would insert the user's rows after the DELETE
+    async with conversation_buffer.lock():
+        conversation_buffer.discard_user(user_id)
+        await run_db(clear_user_conversations, user_id)
+
+async def get_user_conversations_async(user_id: int, limit: int = 5, model_type: Optional[str] = None) -> List[Dict[str, str]]:
+    # Make the user's latest replies visible before reading them back
+    await conversation_buffer.flush()
+    return await run_db(get_user_conversations, user_id, limit, model_type)
+
+# Awaitable versions for the async Telegram handlers. The sync functions above are
+# the facade used by the Dramatiq actors; both share the same per-process pool.
+get_user_generations_today_async = _awaitable(get_user_generations_today)
+save_user_generation_async = _awaitable(save_user_generation)
+get_user_model_async = _awaitable(get_user_model)
+save_user_model_async = _awaitable(save_user_model)
+get_user_stats_async = _awaitable(get_user_stats)
+ban_user_async = _awaitable(ban_user)
+unban_user_async = _awaitable(unban_user)
+is_user_banned_async = _awaitable(is_user_banned)
+get_top_active_users_async = _awaitable(get_top_active_users)
+cleanup_old_generations_async = _awaitable(cleanup_old_generations)
+archive_old_conversations_async = _awaitable(archive_old_conversations)
+get_top_commands_async = _awaitable(get_top_commands)
+get_gpt_conversation_async = _awaitable(get_gpt_conversation)
+save_gpt_conversation_async = _awaitable(save_gpt_conversation)
+clear_gpt_conversation_async = _awaitable(clear_gpt_conversation)
+
 init_db()
@@ -4,13 +4,15 @@ import logging
 from telegram import Update
 from telegram.ext import CommandHandler, MessageHandler, filters, ConversationHandler, ContextTypes
 from performance_metrics import record_command_usage
-from database import get_user_generations_today
+from quota import reserve_generation_async, refund_generation_async, get_generations_used_async
 from config import MAX_GENERATIONS_PER_DAY
 from dramatiq_tasks.image_tasks import generate_image_task, analyze_image_task
 from dramatiq_tasks.suno_tasks import generate_music_task, generate_custom_music_task
 import base64
 from dramatiq_tasks.flux_tasks import generate_flux_image_task
 from config import *
+from preferences_cache import get_user_preference_async
+from progress_service import progress_service
 
 TITLE, IS_INSTRUMENTAL, LYRICS, TAGS, CONFIRM = range(5)
 
@@ -54,19 +56,17 @@ async def generate_image_dramatiq(update: Update, context: ContextTypes.DEFAULT_
     user_id = update.effective_user.id
     user_name = update.effective_user.username
 
-    user_generations_today = get_user_generations_today(user_id, "image")
-    logger.info(f"User {user_id} has generated {user_generations_today} images today")
-    
-    max_generations = int(MAX_GENERATIONS_PER_DAY)
-    
-    if user_generations_today >= max_generations:
-        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {max_generations} image generations.")
-        return
-
     if not context.args:
         await update.message.reply_text("Please provide a prompt after the /generate_image_dramatiq command.")
         return
 
+    max_generations = int(MAX_GENERATIONS_PER_DAY)
+
+    reservation = await reserve_generation_async(user_id, "image", max_generations)
+    if not reservation:
+        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {max_generations} image generations.")
+        return
+
     prompt = ' '.join(context.args)
     logger.info(f"User {user_id} requested image generation via Dramatiq: '{prompt}'")
 
@@ -74,12 +74,13 @@ async def generate_image_dramatiq(update: Update, context: ContextTypes.DEFAULT_
 
     try:
         # Enqueue the task
-        generate_image_task.send(prompt, user_id, update.effective_chat.id)
+        generate_image_task.send(prompt, user_id, update.effective_chat.id, reservation)
 
         await progress_message.edit_text("Your image generation task has been queued. You'll be notified when it's ready.")
 
     except Exception as e:
         logger.error(f"Dramatiq image generation error for user {user_id}: {str(e)}")
+        await refund_generation_async(reservation)
         await progress_message.edit_text(f"An error occurred while queuing the image generation task: {str(e)}")
 
 async def generate_flux_dramatiq(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -87,19 +88,17 @@ async def generate_flux_dramatiq(update: Update, context: ContextTypes.DEFAULT_T
     user_id = update.effective_user.id
     user_name = update.effective_user.username
 
-    user_generations_today = get_user_generations_today(user_id, "flux")
-    logger.info(f"User {user_id} has generated {user_generations_today} Flux generations today")
-    
-    max_generations = int(MAX_GENERATIONS_PER_DAY)
-    
-    if user_generations_today >= max_generations:
-        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {max_generations} Flux generations.")
-        return
-
     if not context.args:
         await update.message.reply_text("Please provide a prompt after the /newflux command.")
         return
 
+    max_generations = int(MAX_GENERATIONS_PER_DAY)
+
+    reservation = await reserve_generation_async(user_id, "flux", max_generations)
+    if not reservation:
+        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {max_generations} Flux generations.")
+        return
+
     prompt = ' '.join(context.args)
     logger.info(f"User {user_id} requested Flux generation via Dramatiq: '{prompt}'")
 
@@ -107,12 +106,12 @@ async def generate_flux_dramatiq(update: Update, context: ContextTypes.DEFAULT_T
 
     try:
         # Enqueue the task
-        generate_flux_image_task.send(prompt, user_id, update.effective_chat.id)
-
-        await progress_message.edit_text("Your Flux generation task has been queued. You'll be notified when it's ready.")
+        generate_flux_image_task.send(prompt, FLUX_MODELS[DEFAULT_FLUX_MODEL], user_id, update.effective_chat.id, progress_message.message_id, reservation)
+        progress_service.start(progress_message, remote=True)
 
     except Exception as e:
         logger.error(f"Dramatiq Flux generation error for user {user_id}: {str(e)}")
+        await refund_generation_async(reservation)
         await progress_message.edit_text(f"An error occurred while queuing the Flux generation task: {str(e)}")
 
 async def suno_generate_music_dramatiq(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -120,19 +119,17 @@ async def suno_generate_music_dramatiq(update: Update, context: ContextTypes.DEF
     user_id = update.effective_user.id
     user_name = update.effective_user.username
 
-    user_generations_today = get_user_generations_today(user_id, "suno")
-    logger.info(f"User {user_id} has generated {user_generations_today} times today")
-    
-    max_generations = int(MAX_GENERATIONS_PER_DAY)
-    
-    if user_generations_today >= max_generations:
-        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {max_generations} music generations.")
-        return
-
     if not context.args:
         await update.message.reply_text("Please provide a prompt after the /gen_music command.")
         return
 
+    max_generations = int(MAX_GENERATIONS_PER_DAY)
+
+    reservation = await reserve_generation_async(user_id, "suno", max_generations)
+    if not reservation:
+        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {max_generations} music generations.")
+        return
+
     prompt = ' '.join(context.args)
     logger.info(f"User {user_id} requested Suno music generation via Dramatiq: '{prompt}'")
 
@@ -140,12 +137,13 @@ async def suno_generate_music_dramatiq(update: Update, context: ContextTypes.DEF
 
     try:
         # Enqueue the task
-        generate_music_task.send(prompt, user_id, update.effective_chat.id)
+        generate_music_task.send(prompt, user_id, update.effective_chat.id, reservation=reservation)
 
         await progress_message.edit_text("Your music generation task has been queued. You'll be notified when it's ready.")
 
     except Exception as e:
         logger.error(f"Dramatiq Suno music generation error for user {user_id}: {str(e)}")
+        await refund_generation_async(reservation)
         await progress_message.edit_text(f"An error occurred while queuing the music generation task: {str(e)}")
 
 async def suno_generate_instrumental_dramatiq(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -153,19 +151,17 @@ async def suno_generate_instrumental_dramatiq(update: Update, context: ContextTy
     user_id = update.effective_user.id
     user_name = update.effective_user.username
 
-    user_generations_today = get_user_generations_today(user_id, "suno")
-    logger.info(f"User {user_id} has generated {user_generations_today} times today")
-    
-    max_generations = int(MAX_GENERATIONS_PER_DAY)
-    
-    if user_generations_today >= max_generations:
-        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {max_generations} music generations.")
-        return
-
     if not context.args:
         await update.message.reply_text("Please provide a prompt after the /gen_inst command.")
         return
 
+    max_generations = int(MAX_GENERATIONS_PER_DAY)
+
+    reservation = await reserve_generation_async(user_id, "suno", max_generations)
+    if not reservation:
+        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {max_generations} music generations.")
+        return
+
     prompt = ' '.join(context.args)
     logger.info(f"User {user_id} requested Suno instrumental music generation via Dramatiq: '{prompt}'")
 
@@ -173,12 +169,13 @@ async def suno_generate_instrumental_dramatiq(update: Update, context: ContextTy
 
     try:
         # Enqueue the task with make_instrumental=True
-        generate_music_task.send(prompt, user_id, update.effective_chat.id, make_instrumental=True)
+        generate_music_task.send(prompt, user_id, update.effective_chat.id, make_instrumental=True, reservation=reservation)
 
         await progress_message.edit_text("Your instrumental music generation task has been queued. You'll be notified when it's ready.")
 
     except Exception as e:
         logger.error(f"Dramatiq Suno instrumental music generation error for user {user_id}: {str(e)}")
+        await refund_generation_async(reservation)
         await progress_message.edit_text(f"An error occurred while queuing the instrumental music generation task: {str(e)}")
 
 async def fluxnew_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -187,30 +184,31 @@ async def fluxnew_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_name = update.effective_user.username
     chat_id = update.effective_chat.id
 
-    user_generations_today = get_user_generations_today(user_id, "flux")
-    logger.info(f"User {user_id} has generated {user_generations_today} Flux images today")
-    if user_generations_today >= MAX_FLUX_GENERATIONS_PER_DAY:
-        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {MAX_FLUX_GENERATIONS_PER_DAY} Flux image generations.")
-        return
-
     if not context.args:
         await update.message.reply_text("Please provide a prompt after the /fluxnew command.")
         return
 
+    reservation = await reserve_generation_async(user_id, "flux", MAX_FLUX_GENERATIONS_PER_DAY)
+    if not reservation:
+        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {MAX_FLUX_GENERATIONS_PER_DAY} Flux image generations.")
+        return
+
     prompt = ' '.join(context.args)
     logger.info(f"User {user_id} requested Flux image generation: '{prompt[:50]}...'")
 
-    model_name = context.user_data.get('flux_model', DEFAULT_FLUX_MODEL)
+    model_name = await get_user_preference_async(update.effective_user.id, 'flux_model') or DEFAULT_FLUX_MODEL
     model_id = FLUX_MODELS[model_name]
 
     progress_message = await update.message.reply_text("🎨 Initializing Flux image generation...")
 
     try:
         # Enqueue the task
-        generate_flux_image_task.send(prompt, model_id, user_id, chat_id, progress_message.message_id)
+        generate_flux_image_task.send(prompt, model_id, user_id, chat_id, progress_message.message_id, reservation)
+        progress_service.start(progress_message, remote=True)
 
     except Exception as e:
         logger.error(f"Dramatiq Flux image generation error for user {user_id}: {str(e)}")
+        await refund_generation_async(reservation)
         await progress_message.edit_text(f"An error occurred while queuing the Flux image generation task: {str(e)}")
 
 TITLE, IS_INSTRUMENTAL, LYRICS, TAGS, CONFIRM = range(5)
@@ -220,7 +218,7 @@ async def cust_mus_gen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     user_id = update.effective_user.id
     user_name = update.effective_user.username
 
-    user_generations_today = get_user_generations_today(user_id, "suno")
+    user_generations_today = await get_generations_used_async(user_id, "suno")
     logger.info(f"User {user_id} has generated {user_generations_today} times today")
     
     max_generations = int(MAX_GENERATIONS_PER_DAY)
@@ -272,8 +270,15 @@ async def generate_custom_music(update: Update, context: ContextTypes.DEFAULT_TY
         return ConversationHandler.END
 
     user_id = update.effective_user.id
+    user_name = update.effective_user.username
     chat_id = update.effective_chat.id
 
+    max_generations = int(MAX_GENERATIONS_PER_DAY)
+    reservation = await reserve_generation_async(user_id, "suno", max_generations)
+    if not reservation:
+        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {max_generations} generations.")
+        return ConversationHandler.END
+
     title = context.user_data['title']
     make_instrumental = context.user_data['make_instrumental']
     lyrics = context.user_data.get('lyrics', '')
@@ -282,10 +287,11 @@ async def generate_custom_music(update: Update, context: ContextTypes.DEFAULT_TY
     progress_message = await update.message.reply_text("🎵 Queueing custom music generation task...")
 
     try:
-        generate_custom_music_task.send(title, make_instrumental, lyrics, tags, user_id, chat_id)
+        generate_custom_music_task.send(title, make_instrumental, lyrics, tags, user_id, chat_id, reservation)
         await progress_message.edit_text("Your custom music generation task has been queued. You'll be notified when it's ready.")
     except Exception as e:
         logger.error(f"Error queueing custom music generation for user {user_id}: {str(e)}")
+        await refund_generation_async(reservation)
         await update.message.reply_text("An error occurred while queueing your custom music generation. Please try again later.")
 
     return ConversationHandler.END
@@ -18,4 +18,5 @@ dramatiq.set_broker(redis_broker)
 from .image_tasks import *
 from .suno_tasks import *
 from .flux_tasks import *
-from .voice_tasks import *
\ No newline at end of file
+from .voice_tasks import *
+from .summary_tasks import *
\ No newline at end of file
@@ -4,16 +4,17 @@ import dramatiq
 import logging
 import time
 from performance_metrics import record_response_time, record_error
-from database import save_user_generation, get_user_generations_today
+from quota import commit_generation, refund_generation
 import fal_client
-from telegram import Bot
-from config import TELEGRAM_BOT_TOKEN, MAX_FLUX_GENERATIONS_PER_DAY, FLUX_MODELS
+from telegram_rate_limiter import rate_limited_bot
+from progress_service import push_progress, finish_progress
+from config import FLUX_MODELS
 import asyncio
 
 logger = logging.getLogger(__name__)
 
 @dramatiq.actor
-def generate_flux_image_task(prompt: str, model_id: str, user_id: int, chat_id: int, progress_message_id: int):
+def generate_flux_image_task(prompt: str, model_id: str, user_id: int, chat_id: int, progress_message_id: int, reservation: dict = None):
     start_time = time.time()
     try:
         logger.info(f"Starting Flux image generation for user {user_id} with prompt: '{prompt}'")
@@ -22,7 +23,8 @@ def generate_flux_image_task(prompt: str, model_id: str, user_id: int, chat_id:
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         
-        bot = Bot(token=TELEGRAM_BOT_TOKEN)
+        bot = rate_limited_bot()
+        push_progress(chat_id, progress_message_id, "🎨 Generating image...")
         
         # Submit the task to fal_client
         handler = fal_client.submit(
@@ -47,23 +49,24 @@ def generate_flux_image_task(prompt: str, model_id: str, user_id: int, chat_id:
             ))
             
             # Save user generation
-            save_user_generation(user_id, prompt, "flux")
+            commit_generation(reservation, prompt)
             
-            # Calculate and send remaining generations message
-            user_generations_today = get_user_generations_today(user_id, "flux")
-            remaining_generations = MAX_FLUX_GENERATIONS_PER_DAY - user_generations_today
-            loop.run_until_complete(bot.send_message(
-                chat_id=chat_id,
-                text=f"You have {remaining_generations} Flux image generations left for today."
-            ))
+            # Send remaining generations message
+            if reservation:
+                loop.run_until_complete(bot.send_message(
+                    chat_id=chat_id,
+                    text=f"You have {reservation['remaining']} Flux image generations left for today."
+                ))
         else:
             logger.error("No image URL in the result")
+            refund_generation(reservation)
             loop.run_until_complete(bot.send_message(
                 chat_id=chat_id,
                 text="Sorry, I couldn't generate an image. Please try again."
             ))
 
         # Delete the progress message
+        finish_progress(chat_id, progress_message_id)
         loop.run_until_complete(bot.delete_message(chat_id=chat_id, message_id=progress_message_id))
 
         end_time = time.time()
@@ -73,6 +76,8 @@ def generate_flux_image_task(prompt: str, model_id: str, user_id: int, chat_id:
 
     except Exception as e:
         logger.error(f"Flux image generation error for user {user_id}: {str(e)}")
+        finish_progress(chat_id, progress_message_id)
+        refund_generation(reservation)
         loop.run_until_complete(bot.send_message(
             chat_id=chat_id,
             text=f"An error occurred while generating the Flux image: {str(e)}"
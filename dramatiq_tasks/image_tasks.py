@@ -4,16 +4,18 @@ import dramatiq
 import logging
 from performance_metrics import record_response_time, record_error
 from image_processing import generate_image_openai, analyze_image_openai
-from database import save_conversation, save_user_generation, get_user_generations_today
+from database import save_conversation
+from quota import commit_generation, refund_generation
 from image_processing import analyze_image_openai_bytes  # Import the new function
 import time
 import asyncio
 import base64
 import fal_client
-from telegram import Bot
+from telegram_rate_limiter import rate_limited_bot
+from progress_service import push_progress, finish_progress
 import io
 import aiohttp
-from config import TELEGRAM_BOT_TOKEN, MAX_VIDEO_GENERATIONS_PER_DAY
+from config import MAX_VIDEO_GENERATIONS_PER_DAY
 
 
 
@@ -21,7 +23,7 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 @dramatiq.actor
-def generate_image_task(prompt: str, user_id: int, chat_id: int):
+def generate_image_task(prompt: str, user_id: int, chat_id: int, reservation: dict = None):
     start_time = time.time()
     try:
         logger.info(f"Starting image generation for user {user_id} with prompt: '{prompt}'")
@@ -37,12 +39,13 @@ def generate_image_task(prompt: str, user_id: int, chat_id: int):
         logger.info(f"Image generated in {response_time:.2f} seconds for user {user_id}")
         
         save_conversation(user_id, prompt, "Image generated (Dramatiq)", "image")
-        save_user_generation(user_id, prompt, "image")
+        commit_generation(reservation, prompt)
         
         logger.info(f"Sending image result for user {user_id}")
         send_image_result.send(chat_id, image_url, prompt)
     except Exception as e:
         logger.error(f"Image generation error for user {user_id}: {str(e)}", exc_info=True)
+        refund_generation(reservation)
         record_error("image_generation_error")
         send_error_message.send(chat_id, str(e))
 
@@ -80,7 +83,7 @@ def analyze_image_task(image_base64: str, user_id: int, chat_id: int):
 @dramatiq.actor
 def send_image_result(chat_id: int, image_url: str, prompt: str):
     logger.info(f"Sending image result to chat {chat_id}")
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+    bot = rate_limited_bot()
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     try:
@@ -95,7 +98,7 @@ def send_image_result(chat_id: int, image_url: str, prompt: str):
 @dramatiq.actor
 def send_analysis_result(chat_id: int, analysis: str):
     logger.info(f"Sending analysis result to chat {chat_id}")
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+    bot = rate_limited_bot()
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     try:
@@ -110,7 +113,7 @@ def send_analysis_result(chat_id: int, analysis: str):
 @dramatiq.actor
 def send_error_message(chat_id: int, error: str):
     logger.info(f"Sending error message to chat {chat_id}")
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+    bot = rate_limited_bot()
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     try:
@@ -122,51 +125,31 @@ def send_error_message(chat_id: int, error: str):
         loop.close()
 
 
-MAX_VIDEO_PER_DAY = 2  # Limit to 2 videos per day
 VIDEO_GENERATION_TIMEOUT = 600  # 10 minutes total timeout
 
 @dramatiq.actor(max_retries=0)  # No retries for video generation
-def generate_video_task(prompt: str, user_id: int, chat_id: int, progress_message_id: int):
+def generate_video_task(prompt: str, user_id: int, chat_id: int, progress_message_id: int, reservation: dict = None):
     start_time = time.time()
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+    bot = rate_limited_bot()
 
     async def generate_video():
-        last_progress_time = time.time()
         last_message = ""
 
         def on_queue_update(update):
-            nonlocal last_progress_time, last_message
+            nonlocal last_message
             if isinstance(update, fal_client.InProgress):
                 logs = getattr(update, 'logs', None)
                 if logs:
                     message = logs[-1].get("message", "Processing video...") if logs else "Processing video..."
-                    current_time = time.time()
-                    
-                    # Only update message if it's different or if 10 seconds have passed
-                    if message != last_message or (current_time - last_progress_time) >= 10:
+                    if message != last_message:
                         logger.info(f"Generation progress for user {user_id}: {message}")
-                        try:
-                            loop.run_until_complete(
-                                bot.edit_message_text(
-                                    chat_id=chat_id,
-                                    message_id=progress_message_id,
-                                    text=f"🎬 {message}\n\nThis is slow AF and may take up to 10 minutes..."
-                                )
-                            )
-                            last_progress_time = current_time
-                            last_message = message
-                        except Exception as e:
-                            if "Message is not modified" not in str(e):
-                                logger.error(f"Error updating progress message: {str(e)}")
+                        # The bot's progress service picks this up and paces the edits
+                        push_progress(chat_id, progress_message_id, f"🎬 {message}\n\nThis is slow AF and may take up to 10 minutes...")
+                        last_message = message
 
         try:
-            # Check generation limit first
-            user_generations_today = get_user_generations_today(user_id, "video")
-            if user_generations_today >= MAX_VIDEO_PER_DAY:
-                raise Exception(f"You have reached your daily limit of {MAX_VIDEO_PER_DAY} video generations. Please try again tomorrow.")
-
             logger.info(f"Submitting video generation request for user {user_id}")
             
             async with asyncio.timeout(VIDEO_GENERATION_TIMEOUT):
@@ -197,6 +180,7 @@ def generate_video_task(prompt: str, user_id: int, chat_id: int, progress_messag
                             if response.status == 200:
                                 video_content = await response.read()
                                 
+                                finish_progress(chat_id, progress_message_id)
                                 try:
                                     await bot.delete_message(chat_id=chat_id, message_id=progress_message_id)
                                 except Exception as e:
@@ -209,13 +193,13 @@ def generate_video_task(prompt: str, user_id: int, chat_id: int, progress_messag
                                     supports_streaming=True
                                 )
                                 
-                                save_user_generation(user_id, prompt, "video")
-                                remaining_generations = MAX_VIDEO_PER_DAY - (user_generations_today + 1)
+                                commit_generation(reservation, prompt)
                                 
-                                await bot.send_message(
-                                    chat_id=chat_id,
-                                    text=f"You have {remaining_generations} video generations left for today."
-                                )
+                                if reservation:
+                                    await bot.send_message(
+                                        chat_id=chat_id,
+                                        text=f"You have {reservation['remaining']} video generations left for today."
+                                    )
                             else:
                                 raise Exception(f"Failed to download video: HTTP {response.status}")
 
@@ -226,17 +210,17 @@ def generate_video_task(prompt: str, user_id: int, chat_id: int, progress_messag
         except Exception as e:
             error_msg = str(e)
             logger.error(f"Video generation error for user {user_id}: {error_msg}")
+            refund_generation(reservation)
             
             user_msg = "An error occurred while generating the video. "
-            if "daily limit" in error_msg.lower():
-                user_msg = error_msg  # Use the limit message directly
-            elif "timed out" in error_msg.lower():
+            if "timed out" in error_msg.lower():
                 user_msg += "The generation process timed out. Note that video generation can take up to 10 minutes. Please try again with a simpler prompt."
             elif "no video url" in error_msg.lower():
                 user_msg += "The video generation failed. Please try again with a different prompt."
             else:
                 user_msg += "Please try again later or with a different prompt."
             
+            finish_progress(chat_id, progress_message_id)
             try:
                 await bot.edit_message_text(
                     chat_id=chat_id,
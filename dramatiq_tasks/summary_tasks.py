@@ -0,0 +1,87 @@
+# dramatiq_tasks/summary_tasks.py
+
+import dramatiq
+import logging
+import anthropic
+from config import ANTHROPIC_API_KEY, ANTHROPIC_TIMEOUT, SUMMARY_MODEL, SUMMARY_KEEP_MESSAGES, SUMMARY_MAX_TOKENS
+from conversation_state import CONVERSATIONS
+from performance_metrics import record_error
+
+logger = logging.getLogger(__name__)
+
+# Folds the older turns of a long conversation into its running summary, off
+# the request path. Handlers call schedule_summary(_async) after storing a
+# turn; at most one job per conversation is queued or running at a time.
+
+SUMMARY_SYSTEM_MESSAGE = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Update the existing summary with the new turns. Keep facts about the user, their goals, "
+    "decisions made, open questions and anything the assistant promised to do. Be concise, "
+    "write in the third person and reply with the summary only."
+)
+
+# Actors are synchronous and each task would otherwise need its own event loop,
+# so this job uses the blocking client
+summary_client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY, timeout=ANTHROPIC_TIMEOUT, max_retries=2)
+
+def _message_text(message: dict) -> str:
+    content = message.get("content")
+    if isinstance(content, str):
+        return content
+    parts = []
+    for block in content or []:
+        if block.get("type") == "text":
+            parts.append(block.get("text", ""))
+        elif block.get("type") == "input_audio":
+            parts.append("[voice message]")
+    return " ".join(parts)
+
+def _transcript(messages: list) -> str:
+    return "\n\n".join(f"{message.get('role', 'user').capitalize()}: {_message_text(message)}" for message in messages)
+
+def _summarize(summary, messages: list) -> str:
+    prompt = f"Existing summary:\n{summary or '(none)'}\n\nNew turns:\n{_transcript(messages)}"
+    response = summary_client.messages.create(
+        model=SUMMARY_MODEL,
+        max_tokens=SUMMARY_MAX_TOKENS,
+        system=SUMMARY_SYSTEM_MESSAGE,
+        messages=[{"role": "user", "content": prompt}]
+    )
+    return "".join(block.text for block in response.content if block.type == "text").strip()
+
+@dramatiq.actor(max_retries=0)
+def summarize_conversation_task(kind: str, user_id: int):
+    conversation = CONVERSATIONS[kind](user_id)
+    try:
+        summary, messages = conversation.recent_with_summary()
+        # Summarize everything but the recent turns, and leave the history starting with a user turn
+        count = max(len(messages) - SUMMARY_KEEP_MESSAGES, 0)
+        while 0 < count < len(messages) and messages[count].get("role") != "user":
+            count += 1
+        if count == 0 or count == len(messages):
+            return
+
+        new_summary = _summarize(summary, messages[:count])
+        if not new_summary:
+            logger.warning(f"[User {user_id}] Empty {kind} conversation summary, keeping history as is")
+            return
+        if conversation.compact(count, messages[count - 1], new_summary):
+            logger.info(f"[User {user_id}] Summarized {count} {kind} messages into {len(new_summary)} characters")
+        else:
+            logger.info(f"[User {user_id}] {kind} conversation changed while summarizing, will retry on a later turn")
+    except Exception as e:
+        logger.error(f"[User {user_id}] Error summarizing {kind} conversation: {str(e)}")
+        record_error("conversation_summary_error")
+    finally:
+        conversation.release_summary()
+
+def schedule_summary(kind: str, user_id: int, length: int):
+    """Queue a summary job once a history of `length` messages reaches the trigger, unless one is pending."""
+    conversation = CONVERSATIONS[kind](user_id)
+    if conversation.needs_summary(length) and conversation.claim_summary():
+        summarize_conversation_task.send(kind, user_id)
+
+async def schedule_summary_async(kind: str, user_id: int, length: int):
+    conversation = CONVERSATIONS[kind](user_id)
+    if conversation.needs_summary(length) and await conversation.claim_summary_async():
+        summarize_conversation_task.send(kind, user_id)
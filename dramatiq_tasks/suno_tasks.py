@@ -3,14 +3,16 @@
 import dramatiq
 import logging
 from performance_metrics import record_response_time, record_error
-from database import save_conversation, save_user_generation, get_user_generations_today
-from config import SUNO_BASE_URL, TELEGRAM_BOT_TOKEN, MAX_GENERATIONS_PER_DAY
+from database import save_conversation
+from quota import commit_generation, refund_generation
+from config import SUNO_BASE_URL
 import time
 import asyncio
 import aiohttp
-from telegram import Bot
+from telegram_rate_limiter import rate_limited_bot
 import os
 from utils import openai_client
+from response_cache import cached_completion
 
 logger = logging.getLogger(__name__)
 
@@ -61,16 +63,18 @@ async def wait_for_generation(generation_ids):
     return completed_generations
 
 async def generate_lyrics_summary(lyrics):
-    try:
-        response = await openai_client.chat.completions.create(
-            model="gpt-4o-2024-08-06",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that summarizes song lyrics. You do not provide all of the lyrics, just a nice summary."},
-                {"role": "user", "content": f"Please provide a brief summary of these lyrics:\n\n{lyrics}"}
-            ],
-            max_tokens=100,
-        )
+    model = "gpt-4o-2024-08-06"
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant that summarizes song lyrics. You do not provide all of the lyrics, just a nice summary."},
+        {"role": "user", "content": f"Please provide a brief summary of these lyrics:\n\n{lyrics}"}
+    ]
+
+    async def summarize():
+        response = await openai_client.chat.completions.create(model=model, messages=messages, max_tokens=100)
         return response.choices[0].message.content
+
+    try:
+        return await cached_completion("lyrics_summary", model, None, messages, {"max_tokens": 100}, summarize)
     except Exception as e:
         logger.error(f"Error generating lyrics summary: {e}")
         return "Unable to generate lyrics summary."
@@ -107,7 +111,7 @@ async def download_video(video_url, file_name):
                 raise Exception(f"Failed to download video, status code: {response.status}")
 
 @dramatiq.actor
-def generate_music_task(prompt: str, user_id: int, chat_id: int, make_instrumental: bool = False):
+def generate_music_task(prompt: str, user_id: int, chat_id: int, make_instrumental: bool = False, reservation: dict = None):
     start_time = time.time()
     try:
         logger.info(f"Starting {'instrumental ' if make_instrumental else ''}music generation for user {user_id} with prompt: '{prompt}'")
@@ -128,7 +132,7 @@ def generate_music_task(prompt: str, user_id: int, chat_id: int, make_instrument
             generation_ids = [song_data['id'] for song_data in response]
             completed_generations = loop.run_until_complete(wait_for_generation(generation_ids))
             
-            bot = Bot(token=TELEGRAM_BOT_TOKEN)
+            bot = rate_limited_bot()
             
             for index, completed_generation in enumerate(completed_generations, 1):
                 generation_id = completed_generation['id']
@@ -229,7 +233,9 @@ def generate_music_task(prompt: str, user_id: int, chat_id: int, make_instrument
                             if os.path.exists(file):
                                 os.remove(file)
 
-            save_user_generation(user_id, prompt, "suno")
+            commit_generation(reservation, prompt)
+        else:
+            refund_generation(reservation)
         
         end_time = time.time()
         record_response_time(end_time - start_time)
@@ -237,13 +243,14 @@ def generate_music_task(prompt: str, user_id: int, chat_id: int, make_instrument
     
     except Exception as e:
         logger.error(f"Music generation error for user {user_id}: {str(e)}")
+        refund_generation(reservation)
         record_error("suno_music_generation_error")
         send_error_message.send(chat_id, str(e))
 
 @dramatiq.actor
 def send_error_message(chat_id: int, error: str):
     logger.info(f"Sending error message to chat {chat_id}")
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+    bot = rate_limited_bot()
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     try:
@@ -256,7 +263,7 @@ def send_error_message(chat_id: int, error: str):
 @dramatiq.actor
 def send_error_message(chat_id: int, error: str):
     logger.info(f"Sending error message to chat {chat_id}")
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+    bot = rate_limited_bot()
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     try:
@@ -268,7 +275,7 @@ def send_error_message(chat_id: int, error: str):
         loop.close()
 
 @dramatiq.actor
-def generate_custom_music_task(title: str, make_instrumental: bool, lyrics: str, tags: str, user_id: int, chat_id: int):
+def generate_custom_music_task(title: str, make_instrumental: bool, lyrics: str, tags: str, user_id: int, chat_id: int, reservation: dict = None):
     start_time = time.time()
     try:
         logger.info(f"Starting custom music generation for user {user_id}")
@@ -291,7 +298,7 @@ def generate_custom_music_task(title: str, make_instrumental: bool, lyrics: str,
             generation_ids = [song_data['id'] for song_data in response]
             completed_generations = loop.run_until_complete(wait_for_generation(generation_ids))
             
-            bot = Bot(token=TELEGRAM_BOT_TOKEN)
+            bot = rate_limited_bot()
             
             for index, completed_generation in enumerate(completed_generations, 1):
                 # Process each generated track
@@ -396,16 +403,16 @@ def generate_custom_music_task(title: str, make_instrumental: bool, lyrics: str,
                             if os.path.exists(file):
                                 os.remove(file)
 
-            save_user_generation(user_id, data['prompt'], "suno")
+            commit_generation(reservation, data['prompt'])
             
-            user_generations_today = get_user_generations_today(user_id, "suno")
-            remaining_generations = max(0, MAX_GENERATIONS_PER_DAY - user_generations_today)
-            loop.run_until_complete(bot.send_message(
-                chat_id=chat_id,
-                text=f"You have used {len(completed_generations)} custom generations. You have {remaining_generations} music generations left for today."
-            ))
+            if reservation:
+                loop.run_until_complete(bot.send_message(
+                    chat_id=chat_id,
+                    text=f"You have used {len(completed_generations)} custom generations. You have {reservation['remaining']} music generations left for today."
+                ))
         else:
             logger.error(f"Suno custom music generation failed for user {user_id}. Response: {response}")
+            refund_generation(reservation)
             loop.run_until_complete(bot.send_message(
                 chat_id=chat_id,
                 text="Failed to generate custom music. Please try again later."
@@ -417,5 +424,6 @@ def generate_custom_music_task(title: str, make_instrumental: bool, lyrics: str,
     
     except Exception as e:
         logger.error(f"Custom music generation error for user {user_id}: {str(e)}")
+        refund_generation(reservation)
         record_error("suno_custom_music_generation_error")
         send_error_message.send(chat_id, str(e))
\ No newline at end of file
@@ -2,10 +2,9 @@ import dramatiq
 import logging
 import base64
 import io
-import json
 import tenacity
 from pydub import AudioSegment
-from telegram import Bot
+from telegram_rate_limiter import rate_limited_bot
 import telegram
 import asyncio
 from utils import openai_client
@@ -15,15 +14,19 @@ import httpx
 import openai
 import redis
 from config import (
-    TELEGRAM_BOT_TOKEN, REDIS_HOST, REDIS_PORT, REDIS_DB,
+    REDIS_HOST, REDIS_PORT, REDIS_DB,
     DEFAULT_GPT_VOICE, GPT_VOICES
 )
+from conversation_state import voice_conversation
+from context_budget import fit_history, summary_text
+from .summary_tasks import schedule_summary
 
 # Set up Redis
 redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
 
 logger = logging.getLogger(__name__)
-audio_conversation_pattern = "user:*:conversation"
+VOICE_MODEL = "gpt-4o-audio-preview"
+audio_conversation_pattern = "user:*:conversation*"
 for key in redis_client.scan_iter(audio_conversation_pattern):
     redis_client.delete(key)
 logger.info("Cleared existing voice conversations from Redis")
@@ -42,30 +45,7 @@ RETRY_EXCEPTIONS = (
     TimeoutError,
 )
 
-class ConversationState:
-    def __init__(self, user_id: int):
-        self.user_id = user_id
-        self.redis_key = f"user:{user_id}:conversation"
-        
-    def load(self) -> list:
-        """Load conversation history from Redis"""
-        data = redis_client.get(self.redis_key)
-        if data:
-            return json.loads(data.decode('utf-8'))
-        return []
-    
-    def save(self, messages: list):
-        """Save conversation history to Redis"""
-        redis_client.setex(self.redis_key, 24*60*60, json.dumps(messages))
-    
-    def add_message(self, role: str, **content):
-        """Add a message to the conversation history"""
-        messages = self.load()
-        messages.append({"role": role, **content})
-        self.save(messages)
-        return messages
-
-async def make_openai_request_with_retry(messages, bot, chat_id, message_id, voice_id=DEFAULT_GPT_VOICE, attempt_number=0):
+async def make_openai_request_with_retry(messages, bot, chat_id, message_id, voice_id=DEFAULT_GPT_VOICE, attempt_number=0, user_id=0):
     """Make OpenAI API request with enhanced retry logic"""
     try:
         async for attempt in AsyncRetrying(
@@ -90,7 +70,7 @@ async def make_openai_request_with_retry(messages, bot, chat_id, message_id, voi
                 
                 try:
                     return await openai_client.chat.completions.create(
-                        model="gpt-4o-audio-preview",
+                        model=VOICE_MODEL,
                         modalities=["text", "audio"],
                         audio={"voice": voice_id, "format": "wav"},
                         messages=messages
@@ -99,8 +79,7 @@ async def make_openai_request_with_retry(messages, bot, chat_id, message_id, voi
                     if "Invalid voice" in str(e):
                         # Clear conversation and notify user
                         logger.info(f"Voice mismatch detected, clearing conversation history")
-                        conversation = ConversationState(messages[0].get('user_id', 0))
-                        conversation.save([])  # Clear conversation history
+                        voice_conversation(user_id).clear()
                         
                         await bot.send_message(
                             chat_id=chat_id,
@@ -110,7 +89,7 @@ async def make_openai_request_with_retry(messages, bot, chat_id, message_id, voi
                         # Retry with just the current message
                         current_message = messages[-1]  # Keep only the latest message
                         return await openai_client.chat.completions.create(
-                            model="gpt-4o-audio-preview",
+                            model=VOICE_MODEL,
                             modalities=["text", "audio"],
                             audio={"voice": voice_id, "format": "wav"},
                             messages=[current_message]
@@ -145,11 +124,11 @@ async def make_openai_request_with_retry(messages, bot, chat_id, message_id, voi
 @dramatiq.actor(max_retries=3, min_backoff=10000, max_backoff=60000)
 def process_voice_message_task(voice_data_base64: str, user_id: int, chat_id: int, message_id: int, task_context: dict):
     try:
-        bot = Bot(token=TELEGRAM_BOT_TOKEN)
+        bot = rate_limited_bot()
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         
-        conversation = ConversationState(user_id)
+        conversation = voice_conversation(user_id)
 
         # Get voice from task context or use default
         voice_id = task_context.get('voice_id', DEFAULT_GPT_VOICE)
@@ -174,11 +153,8 @@ def process_voice_message_task(voice_data_base64: str, user_id: int, chat_id: in
             wav_data = wav_io.getvalue()
             encoded_voice = base64.b64encode(wav_data).decode('utf-8')
 
-            # Get conversation history
-            messages = conversation.load()
-            
-            # Add current user message
-            messages.append({
+            # Get conversation history and add the current user message
+            user_message = {
                 "role": "user",
                 "content": [
                     {
@@ -189,13 +165,17 @@ def process_voice_message_task(voice_data_base64: str, user_id: int, chat_id: in
                         }
                     }
                 ]
-            })
+            }
+            summary, history = conversation.recent_with_summary()
+            preamble = [{"role": "system", "content": summary_text(summary)}] if summary else []
+            history, _ = fit_history(VOICE_MODEL, history, *preamble, user_message)
+            messages = preamble + history + [user_message]
 
             logger.info(f"[User {user_id}] Sending request with {len(messages)} messages using voice {voice_id}")
 
             # Make API request with the voice_id
             completion = loop.run_until_complete(
-                make_openai_request_with_retry(messages, bot, chat_id, message_id, voice_id)
+                make_openai_request_with_retry(messages, bot, chat_id, message_id, voice_id, user_id=user_id)
             )
 
             # Process response
@@ -204,8 +184,8 @@ def process_voice_message_task(voice_data_base64: str, user_id: int, chat_id: in
             transcript = assistant_message.audio.transcript
             audio_id = assistant_message.audio.id
 
-            # Save assistant's response to conversation history
-            messages.append({
+            # Save the turn to the conversation history and compact it in the background once it gets long
+            length = conversation.append(user_message, {
                 "role": "assistant",
                 "content": transcript,
                 "audio": {
@@ -213,9 +193,7 @@ def process_voice_message_task(voice_data_base64: str, user_id: int, chat_id: in
                 }
             })
             
-            # Update conversation history
-            conversation.save(messages[-10:])  # Keep last 10 messages
-            
+            schedule_summary("voice", user_id, length)
             logger.info(f"[User {user_id}] Updated conversation history with audio_id: {audio_id}")
 
             # Clean up progress message
@@ -270,6 +248,5 @@ def process_voice_message_task(voice_data_base64: str, user_id: int, chat_id: in
 @dramatiq.actor
 def clear_conversation(user_id: int):
     """Clear a user's conversation history"""
-    conversation = ConversationState(user_id)
-    redis_client.delete(conversation.redis_key)
+    voice_conversation(user_id).clear()
     logger.info(f"[User {user_id}] Conversation history cleared")
\ No newline at end of file
@@ -1,10 +1,12 @@
 import logging
 from telegram import Update
-from telegram.ext import ContextTypes
+from telegram.ext import ContextTypes, ApplicationHandlerStop
 from config import ADMIN_USER_IDS, DEFAULT_SYSTEM_MESSAGE
-from database import get_all_users, get_user_stats, ban_user, unban_user, get_postgres_connection, get_active_users
+from database import (iter_all_users, get_user_stats_async, ban_user_async, unban_user_async,
+                      get_top_active_users_async, get_top_commands_async)
 from performance_metrics import record_command_usage, get_performance_metrics, save_performance_data
 from model_cache import update_model_cache
+from ban_list import is_banned
 
 logger = logging.getLogger(__name__)
 
@@ -35,16 +37,17 @@ async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("Please provide a message to broadcast.")
         return
     
-    users = get_all_users()
+    total_count = 0
     success_count = 0
-    for user_id in users:
+    async for user_id in iter_all_users():
+        total_count += 1
         try:
             await context.bot.send_message(chat_id=user_id, text=message)
             success_count += 1
         except Exception as e:
             logger.error(f"Failed to send broadcast to user {user_id}: {str(e)}")
     
-    await update.message.reply_text(f"Broadcast sent to {success_count}/{len(users)} users.")
+    await update.message.reply_text(f"Broadcast sent to {success_count}/{total_count} users.")
 
 async def admin_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     record_command_usage("admin_user_stats")
@@ -53,11 +56,10 @@ async def admin_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return
     
     try:
-        stats = get_user_stats()
-        active_users = get_active_users(7)  # Get users active in the last 7 days
+        stats = await get_user_stats_async()
+        top_users = await get_top_active_users_async(7, 10)  # Top users active in the last 7 days
 
         logger.info(f"Retrieved user stats: {stats}")
-        logger.info(f"Retrieved {len(active_users)} active users in the last 7 days")
 
         stats_message = (
             f"📊 User Statistics:\n\n"
@@ -66,11 +68,11 @@ async def admin_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             f"Claude Messages: {stats['total_claude_messages']}\n"
             f"GPT Messages: {stats['total_gpt_messages']}\n"
             f"Active Users (24h): {stats['active_users_24h']}\n"
-            f"Active Users (7d): {len(active_users)}\n\n"
+            f"Active Users (7d): {stats['active_users_7d']}\n\n"
             f"👥 Top 10 Active Users (Last 7 Days):\n"
         )
 
-        for user in sorted(active_users, key=lambda x: x['total_messages'], reverse=True)[:10]:
+        for user in top_users:
             try:
                 chat_member = await context.bot.get_chat_member(user['id'], user['id'])
                 user_info = chat_member.user
@@ -92,17 +94,7 @@ async def admin_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             )
 
         # Get top 10 most used commands
-        conn = get_postgres_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT command, SUM(count) as total
-        FROM command_usage
-        GROUP BY command
-        ORDER BY total DESC
-        LIMIT 10
-        ''')
-        top_commands = cursor.fetchall()
-        conn.close()
+        top_commands = await get_top_commands_async(10)
 
         stats_message += "🔝 Top 10 Commands:\n"
         for command, count in top_commands:
@@ -118,6 +110,13 @@ async def admin_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         logger.error(f"Error in admin_user_stats: {e}")
         await update.message.reply_text(f"An error occurred while retrieving user stats: {e}")
 
+async def reject_banned_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Runs before every other handler; the ban list lives in memory so this costs a set lookup
+    user = update.effective_user
+    if user and is_banned(user.id):
+        logger.info(f"Ignoring update from banned user {user.id}")
+        raise ApplicationHandlerStop
+
 async def admin_ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     record_command_usage("admin_ban_user")
     if update.effective_user.id not in ADMIN_USER_IDS:
@@ -129,7 +128,7 @@ async def admin_ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     
     user_id = int(context.args[0])
-    if ban_user(user_id):
+    if await ban_user_async(user_id):
         await update.message.reply_text(f"User {user_id} has been banned.")
     else:
         await update.message.reply_text(f"Failed to ban user {user_id}.")
@@ -145,7 +144,7 @@ async def admin_unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return
     
     user_id = int(context.args[0])
-    if unban_user(user_id):
+    if await unban_user_async(user_id):
         await update.message.reply_text(f"User {user_id} has been unbanned.")
     else:
         await update.message.reply_text(f"Failed to unban user {user_id}.")
@@ -211,7 +210,7 @@ async def admin_performance(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Save performance data before retrieving metrics
         await save_performance_data()
         
-        metrics = get_performance_metrics()
+        metrics = await get_performance_metrics()
         
         # Extract and format different parts of the metrics
         parts = metrics.split('\n\n')
@@ -240,7 +239,7 @@ async def admin_performance(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.error(f"Error retrieving performance metrics: {str(e)}")
         await update.message.reply_text(f"An error occurred while retrieving performance metrics: {str(e)}")
         
-        metrics = get_performance_metrics()
+        metrics = await get_performance_metrics()
         if not metrics.strip():
             logger.warning("No performance metrics retrieved")
             await update.message.reply_text("No performance metrics available at this time.")
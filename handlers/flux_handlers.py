@@ -7,8 +7,10 @@ from telegram.ext import ContextTypes, CommandHandler
 from config import FLUX_MODELS, DEFAULT_FLUX_MODEL, MAX_FLUX_GENERATIONS_PER_DAY, MAX_BRR_PER_DAY
 from performance_metrics import record_command_usage, record_response_time, record_error
 from queue_system import queue_task
-from database import get_user_generations_today, save_user_generation
+from progress_service import progress_service
+from quota import reserve_generation_async, commit_generation_async, refund_generation_async
 import fal_client
+from preferences_cache import get_user_preference_async, set_user_preference_async
 
 logger = logging.getLogger(__name__)
 
@@ -34,18 +36,17 @@ async def flux_model_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     model_name = next((name for name, id in FLUX_MODELS.items() if id == model_id), None)
     
     if model_name:
-        context.user_data['flux_model'] = model_name
+        await set_user_preference_async(update.effective_user.id, 'flux_model', model_name)
         await query.edit_message_text(f"Flux model set to {model_name}")
     else:
         await query.edit_message_text("Invalid model selection. Please try again.")
 
 async def current_flux_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     record_command_usage("current_flux_model")
-    current = context.user_data.get('flux_model', DEFAULT_FLUX_MODEL)
+    current = await get_user_preference_async(update.effective_user.id, 'flux_model') or DEFAULT_FLUX_MODEL
     await update.message.reply_text(f"Current Flux model: {current}")
 
 from config import FLUX_MODELS, DEFAULT_FLUX_MODEL, MAX_FLUX_GENERATIONS_PER_DAY
-from database import get_user_generations_today, save_user_generation
 
 @queue_task('long_run')
 async def flux_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -58,16 +59,15 @@ async def flux_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await update.message.reply_text("Sorry, there's an issue with the generation limit configuration. Please try again later or contact support.")
         return
 
-    user_generations_today = get_user_generations_today(user_id, "flux")
-    logger.info(f"User {user_id} has generated {user_generations_today} Flux images today")
-    if user_generations_today >= MAX_FLUX_GENERATIONS_PER_DAY:
-        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {MAX_FLUX_GENERATIONS_PER_DAY} Flux image generations.")
-        return
-
     if not context.args:
         await update.message.reply_text("Please provide a prompt after the /flux command.")
         return
 
+    reservation = await reserve_generation_async(user_id, "flux", MAX_FLUX_GENERATIONS_PER_DAY)
+    if not reservation:
+        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {MAX_FLUX_GENERATIONS_PER_DAY} Flux image generations.")
+        return
+
     prompt = ' '.join(context.args)
     logger.info(f"User {user_id} requested Flux image generation: '{prompt[:50]}...'")
 
@@ -75,25 +75,14 @@ async def flux_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
     start_time = time.time()
     try:
-        model_name = context.user_data.get('flux_model', DEFAULT_FLUX_MODEL)
+        model_name = await get_user_preference_async(update.effective_user.id, 'flux_model') or DEFAULT_FLUX_MODEL
         model_id = FLUX_MODELS[model_name]
 
-        async def update_progress():
-            steps = [
-                "Analyzing prompt", "Preparing canvas", "Sketching outlines", 
-                "Adding details", "Applying colors", "Refining image", 
-                "Enhancing details", "Adjusting lighting", "Finalizing composition"
-            ]
-            step_index = 0
-            dots = 0
-            while True:
-                step = steps[step_index % len(steps)]
-                await progress_message.edit_text(f"🎨 {step}{'.' * dots}")
-                dots = (dots + 1) % 4
-                step_index += 1
-                await asyncio.sleep(2)
-
-        progress_task = asyncio.create_task(update_progress())
+        progress = progress_service.start(progress_message, "🎨", [
+            "Analyzing prompt", "Preparing canvas", "Sketching outlines",
+            "Adding details", "Applying colors", "Refining image",
+            "Enhancing details", "Adjusting lighting", "Finalizing composition"
+        ])
 
         try:
             loop = asyncio.get_running_loop()
@@ -112,16 +101,16 @@ async def flux_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                 await update.message.reply_photo(photo=image_url, caption=f"Generated image using {model_name} for: {prompt}")
                 
                 # Save user generation
-                save_user_generation(user_id, image_url, "flux")
+                await commit_generation_async(reservation, image_url)
                 
-                # Calculate and send remaining generations message
-                remaining_generations = MAX_FLUX_GENERATIONS_PER_DAY - (user_generations_today + 1)
-                await update.message.reply_text(f"You have {remaining_generations} Flux image generations left for today.")
+                # Send remaining generations message
+                await update.message.reply_text(f"You have {reservation['remaining']} Flux image generations left for today.")
             else:
                 logger.error("No image URL in the result")
+                await refund_generation_async(reservation)
                 await update.message.reply_text("Sorry, I couldn't generate an image. Please try again.")
         finally:
-            progress_task.cancel()
+            await progress_service.stop(progress)
             await progress_message.delete()
 
         end_time = time.time()
@@ -131,6 +120,7 @@ async def flux_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
     except Exception as e:
         logger.error(f"Flux image generation error for user {user_id}: {str(e)}")
+        await refund_generation_async(reservation)
         await progress_message.edit_text(f"An error occurred while generating the image: {str(e)}")
         record_error("flux_image_generation_error")
     finally:
@@ -142,17 +132,16 @@ async def remove_background(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     user_name = update.effective_user.username
 
-    # Check user's daily limit
-    user_generations_today = get_user_generations_today(user_id, "rbb")
-    logger.info(f"User {user_id} has removed {user_generations_today} backgrounds today")
-    if user_generations_today >= MAX_BRR_PER_DAY:
-        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {MAX_FLUX_GENERATIONS_PER_DAY} Flux generations.")
-        return
-
     if not update.message.reply_to_message or not update.message.reply_to_message.photo:
         await update.message.reply_text("Please reply to an image with the /remove_bg command.")
         return
 
+    # Reserve one of the user's daily background removals
+    reservation = await reserve_generation_async(user_id, "rbb", MAX_BRR_PER_DAY)
+    if not reservation:
+        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {MAX_BRR_PER_DAY} background removals.")
+        return
+
     logger.info(f"User {user_id} requested background removal")
 
     progress_message = await update.message.reply_text("🖼️ Processing image for background removal...")
@@ -163,21 +152,10 @@ async def remove_background(update: Update, context: ContextTypes.DEFAULT_TYPE)
         file = await context.bot.get_file(photo.file_id)
         file_url = file.file_path
 
-        async def update_progress():
-            steps = [
-                "Analyzing image", "Identifying foreground", "Removing background",
-                "Refining edges", "Finalizing image"
-            ]
-            step_index = 0
-            dots = 0
-            while True:
-                step = steps[step_index % len(steps)]
-                await progress_message.edit_text(f"🖼️ {step}{'.' * dots}")
-                dots = (dots + 1) % 4
-                step_index += 1
-                await asyncio.sleep(2)
-
-        progress_task = asyncio.create_task(update_progress())
+        progress = progress_service.start(progress_message, "🖼️", [
+            "Analyzing image", "Identifying foreground", "Removing background",
+            "Refining edges", "Finalizing image"
+        ])
 
         try:
             loop = asyncio.get_running_loop()
@@ -197,21 +175,20 @@ async def remove_background(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 await progress_message.delete()
 
                 # Save user generation
-                save_user_generation(user_id, "remove_bg", "rbb")
+                await commit_generation_async(reservation, "remove_bg")
 
-                user_generations_today = get_user_generations_today(user_id, "rbb")
-                remaining_generations = max(0, MAX_BRR_PER_DAY - user_generations_today)
-                await update.message.reply_text(f"You have {remaining_generations} background removals left for today.")
+                await update.message.reply_text(f"You have {reservation['remaining']} background removals left for today.")
 
                 logger.info(f"Background removed successfully for user {user_id}")
             else:
                 raise ValueError("Unexpected response format from fal.ai API")
 
         finally:
-            progress_task.cancel()
+            await progress_service.stop(progress)
 
     except Exception as e:
         logger.error(f"Background removal error for user {user_id}: {str(e)}")
+        await refund_generation_async(reservation)
         await progress_message.edit_text(f"An error occurred during background removal: {str(e)}")
         record_error("background_removal_error")
 
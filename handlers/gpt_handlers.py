@@ -4,17 +4,21 @@ import base64
 import io
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler
-from config import OPENAI_API_KEY
+from config import OPENAI_API_KEY, CHAT_HISTORY_MAX_MESSAGES
 from utils import openai_client
 from performance_metrics import record_command_usage, record_response_time, record_model_usage, record_error
 from queue_system import queue_task
-from database import save_conversation, get_user_conversations
+from database import save_conversation_async
 import openai
 from pydub import AudioSegment
 import subprocess
 from config import GPT_VOICES, DEFAULT_GPT_VOICE, GPT_VOICE_PREVIEWS
 import aiohttp
 import asyncio
+from preferences_cache import get_user_preference_async, set_user_preference_async
+from streaming import StreamingReply
+from context_budget import fit_history
+from response_cache import cache_key, get_cached_response, store_response
 
 logger = logging.getLogger(__name__)
 
@@ -75,7 +79,7 @@ async def gpt_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
     try:
         # Get the user's preferred model or use the default
-        model = context.user_data.get('gpt_model') or DEFAULT_GPT_MODEL
+        model = await get_user_preference_async(update.effective_user.id, 'openai_model') or DEFAULT_GPT_MODEL
 
         if not model or 'realtime' in model.lower():
             available_models = await fetch_gpt_models()
@@ -83,27 +87,41 @@ async def gpt_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             if not model:
                 await update.message.reply_text("No suitable GPT model is available. Please try again later.")
                 return
-            context.user_data['gpt_model'] = model
+            await set_user_preference_async(update.effective_user.id, 'openai_model', model)
 
         logger.info(f"Using model: {model} for user {user_id}")
 
         # Get or initialize GPT conversation history from user context
         gpt_conversation = context.user_data.get('gpt_conversation', [])
         
-        # Prepare messages for API call
-        messages = gpt_conversation + [{"role": "user", "content": user_message}]
+        # Prepare messages for API call, with as much history as fits the model's token budget
+        new_message = {"role": "user", "content": user_message}
+        history, _ = fit_history(model, gpt_conversation, new_message)
+        messages = history + [new_message]
 
         # Send typing action
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
 
+        reply = StreamingReply(update.message, start_time)
+        await reply.start()
+
+        # First turns have no history and no system message, so identical prompts are answered from the cache
+        key = cache_key("gpt_first_turn", model, None, messages, {"max_tokens": 1000}) if not gpt_conversation else None
+        cached = await get_cached_response("gpt_first_turn", key) if key else None
         try:
-            # Attempt to use chat completions API first
-            response = await openai_client.chat.completions.create(
-                model=model,
-                messages=messages,
-                max_tokens=1000,
-            )
-            assistant_response = response.choices[0].message.content
+            if cached is not None:
+                await reply.feed(cached)
+            else:
+                # Attempt to use chat completions API first, streamed into Telegram
+                stream = await openai_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=1000,
+                    stream=True,
+                )
+                async for chunk in stream:
+                    if chunk.choices:
+                        await reply.feed(chunk.choices[0].delta.content)
         except openai.BadRequestError as e:
             if "This is not a chat model" in str(e):
                 # If it's not a chat model, fall back to completions API
@@ -113,21 +131,22 @@ async def gpt_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                     prompt=prompt,
                     max_tokens=1000,
                 )
-                assistant_response = response.choices[0].text.strip()
+                await reply.feed(response.choices[0].text.strip())
             else:
                 raise  # Re-raise if it's a different kind of BadRequestError
+        assistant_response = await reply.finish()
+        if key and cached is None and reply.first_token_at is not None:
+            await store_response(key, model, assistant_response)
 
         # Update conversation history
         gpt_conversation.append({"role": "user", "content": user_message})
         gpt_conversation.append({"role": "assistant", "content": assistant_response})
         
-        # Keep only the last 10 messages to manage context length
-        context.user_data['gpt_conversation'] = gpt_conversation[-10:]
-
-        await update.message.reply_text(assistant_response)
+        # Keep a bounded history; fit_history picks what is sent each turn
+        context.user_data['gpt_conversation'] = gpt_conversation[-CHAT_HISTORY_MAX_MESSAGES:]
 
         # Save the conversation
-        save_conversation(user_id, user_message, assistant_response, model_type='gpt')
+        await save_conversation_async(user_id, user_message, assistant_response, model_type='gpt')
 
         # Record performance metrics
         end_time = time.time()
@@ -169,7 +188,7 @@ async def gpt_model_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     model = query.data.split(':')[1]
     if 'realtime' not in model.lower():
-        context.user_data['gpt_model'] = model
+        await set_user_preference_async(update.effective_user.id, 'openai_model', model)
         await query.edit_message_text(f"GPT model set to {model}")
         logger.info(f"User {update.effective_user.id} set GPT model to {model}")
     else:
@@ -178,7 +197,7 @@ async def gpt_model_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def current_gpt_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     record_command_usage("current_gpt_model")
-    model = context.user_data.get('gpt_model', DEFAULT_GPT_MODEL)
+    model = await get_user_preference_async(update.effective_user.id, 'openai_model') or DEFAULT_GPT_MODEL
     await update.message.reply_text(f"Current GPT model: {model}")
     logger.info(f"User {update.effective_user.id} checked current GPT model: {model}")
 
@@ -243,7 +262,7 @@ async def gpt_voice_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             del context.user_data['audio_conversation']
             
         # Set new voice
-        context.user_data['gpt_voice'] = voice_id
+        await set_user_preference_async(update.effective_user.id, 'gpt_voice', voice_id)
         await query.edit_message_text(
             f"Voice set to: {GPT_VOICES[voice_id]}\n\n"
             "Note: Conversation history has been cleared to ensure voice consistency."
@@ -255,7 +274,7 @@ async def gpt_voice_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def current_gpt_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show current GPT voice setting"""
     record_command_usage("current_gpt_voice")
-    voice_id = context.user_data.get('gpt_voice', DEFAULT_GPT_VOICE)
+    voice_id = await get_user_preference_async(update.effective_user.id, 'gpt_voice') or DEFAULT_GPT_VOICE
     voice_description = GPT_VOICES.get(voice_id, "Unknown")
     await update.message.reply_text(f"Current voice: {voice_description}")
 
@@ -275,29 +294,30 @@ async def speak_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         start_time = time.time()
         
         # Get existing conversation history and voice preference
-        messages = context.user_data.get('gpt_conversation', [])
-        voice_id = context.user_data.get('gpt_voice', DEFAULT_GPT_VOICE)
-        messages.append({"role": "user", "content": prompt})
+        history = context.user_data.get('gpt_conversation', [])
+        voice_id = await get_user_preference_async(update.effective_user.id, 'gpt_voice') or DEFAULT_GPT_VOICE
+        new_message = {"role": "user", "content": prompt}
+        fitted, _ = fit_history("gpt-4o-audio-preview", history, new_message)
 
         completion = await openai_client.chat.completions.create(
             model="gpt-4o-audio-preview",
             modalities=["text", "audio"],
             audio={"voice": voice_id, "format": "wav"},
-            messages=messages
+            messages=fitted + [new_message]
         )
 
         assistant_message = completion.choices[0].message
         wav_bytes = base64.b64decode(assistant_message.audio.data)
         transcript = assistant_message.audio.transcript
 
-        # Update conversation history with both the transcript and audio response
-        messages.append({
+        # Update conversation history with both the prompt and the transcript of the audio response
+        messages = history + [new_message, {
             "role": "assistant",
             "content": transcript
-        })
+        }]
         
         # Update the conversation history in context
-        context.user_data['gpt_conversation'] = messages[-10:]  # Keep last 10 messages
+        context.user_data['gpt_conversation'] = messages[-CHAT_HISTORY_MAX_MESSAGES:]
 
         end_time = time.time()
         response_time = end_time - start_time
@@ -348,7 +368,7 @@ async def voice_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         voice_data_base64 = base64.b64encode(voice_data).decode('utf-8')
 
         # Get user's preferred voice
-        voice_id = context.user_data.get('gpt_voice', DEFAULT_GPT_VOICE)
+        voice_id = await get_user_preference_async(update.effective_user.id, 'gpt_voice') or DEFAULT_GPT_VOICE
         
         # Pack conversation data and voice preference into the task context
         task_context = {
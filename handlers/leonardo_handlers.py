@@ -8,9 +8,12 @@ from telegram.ext import ContextTypes, CallbackQueryHandler
 from config import LEONARDO_AI_KEY, LEONARDO_API_BASE_URL, DEFAULT_LEONARDO_MODEL
 from performance_metrics import record_command_usage, record_response_time, record_error
 from queue_system import queue_task
+from progress_service import progress_service
 import aiohttp
 from PIL import Image
 import io
+from preferences_cache import get_user_preference_async, set_user_preference_async
+from response_cache import cached_completion
 
 
 logger = logging.getLogger(__name__)
@@ -81,7 +84,7 @@ async def leonardo_model_callback(update: Update, context: ContextTypes.DEFAULT_
             return
 
         # Set the model in the user's context data
-        context.user_data['leonardo_model'] = model_id
+        await set_user_preference_async(update.effective_user.id, 'leonardo_model', model_id)
         await query.edit_message_text(f"Leonardo.ai model set to {model_name} (ID: {model_id})")
         logger.info(f"User {update.effective_user.id} set Leonardo model to {model_name} (ID: {model_id})")
 
@@ -95,42 +98,12 @@ async def leonardo_model_callback(update: Update, context: ContextTypes.DEFAULT_
 
 async def current_leonardo_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     record_command_usage("current_leonardo_model")
-    model_id = context.user_data.get('leonardo_model', DEFAULT_LEONARDO_MODEL)
+    model_id = await get_user_preference_async(update.effective_user.id, 'leonardo_model') or DEFAULT_LEONARDO_MODEL
     if not leonardo_model_cache:
         await update_leonardo_model_cache()
     model_name = leonardo_model_cache.get(model_id, "Unknown")
     await update.message.reply_text(f"Current Leonardo.ai model: {model_name} (ID: {model_id})")
 
-async def improve_leonardo_prompt(prompt: str) -> str:
-    url = f"{LEONARDO_API_BASE_URL}/prompt/improve"
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "authorization": f"Bearer {LEONARDO_AI_KEY}"
-    }
-    payload = {
-        "prompt": prompt
-    }
-    try:
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-        response_data = response.json()
-        
-        if 'promptGeneration' in response_data and 'prompt' in response_data['promptGeneration']:
-            improved_prompt = response_data['promptGeneration']['prompt']
-            logger.info(f"Prompt improved: '{prompt}' -> '{improved_prompt}'")
-            return improved_prompt
-        else:
-            logger.warning(f"Prompt improvement API returned unexpected structure. Response: {response_data}")
-            return prompt
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error improving prompt: {str(e)}")
-        return prompt  # Return original prompt if improvement fails
-    except json.JSONDecodeError:
-        logger.error(f"Error decoding JSON response from prompt improvement API. Response text: {response.text}")
-        return prompt
-
-
 def truncate_text(text: str, max_length: int = 15) -> str:
     """Truncate text to a specified length and add ellipsis if necessary."""
     return (text[:max_length] + '...') if len(text) > max_length else text
@@ -145,23 +118,29 @@ async def improve_leonardo_prompt(prompt: str) -> str:
     payload = {
         "prompt": prompt
     }
-    try:
+
+    async def improve():
         response = requests.post(url, json=payload, headers=headers)
         response.raise_for_status()
         response_data = response.json()
-        
+
         if 'promptGeneration' in response_data and 'prompt' in response_data['promptGeneration']:
-            improved_prompt = response_data['promptGeneration']['prompt']
-            logger.info(f"Prompt improved: '{truncate_text(prompt)}' -> '{truncate_text(improved_prompt)}'")
-            return improved_prompt
-        else:
-            logger.warning(f"Prompt improvement API returned unexpected structure. Response: {response_data}")
+            return response_data['promptGeneration']['prompt']
+        logger.warning(f"Prompt improvement API returned unexpected structure. Response: {response_data}")
+        return None
+
+    try:
+        # Cached so the same prompt doesn't go back to the API; failures are not cached
+        improved_prompt = await cached_completion("leonardo_prompt", "leonardo-prompt-improve", None, prompt, None, improve)
+        if not improved_prompt:
             return prompt
+        logger.info(f"Prompt improved: '{truncate_text(prompt)}' -> '{truncate_text(improved_prompt)}'")
+        return improved_prompt
     except requests.exceptions.RequestException as e:
         logger.error(f"Error improving prompt: {str(e)}")
         return prompt  # Return original prompt if improvement fails
-    except json.JSONDecodeError:
-        logger.error(f"Error decoding JSON response from prompt improvement API. Response text: {response.text}")
+    except json.JSONDecodeError as e:
+        logger.error(f"Error decoding JSON response from prompt improvement API: {e}")
         return prompt
 
 @queue_task('long_run')
@@ -172,7 +151,7 @@ async def leonardo_generate_image(update: Update, context: ContextTypes.DEFAULT_
         return
 
     original_prompt = ' '.join(context.args)
-    model_id = context.user_data.get('leonardo_model', DEFAULT_LEONARDO_MODEL)
+    model_id = await get_user_preference_async(update.effective_user.id, 'leonardo_model') or DEFAULT_LEONARDO_MODEL
     logger.info(f"User {update.effective_user.id} requested Leonardo.ai image generation: '{truncate_text(original_prompt)}'")
 
     progress_message = await update.message.reply_text("🎨 Improving prompt...")
@@ -184,14 +163,7 @@ async def leonardo_generate_image(update: Update, context: ContextTypes.DEFAULT_
         else:
             await progress_message.edit_text("🎨 Generating image with original prompt...")
 
-        async def update_progress():
-            dots = 1
-            while True:
-                await progress_message.edit_text(f"🎨 Generating image with Leonardo.ai{'.' * dots}")
-                dots = (dots % 3) + 1
-                await asyncio.sleep(2)
-
-        progress_task = asyncio.create_task(update_progress())
+        progress = progress_service.start(progress_message, "🎨", ["Generating image with Leonardo.ai"])
 
         try:
             headers = {
@@ -233,7 +205,7 @@ async def leonardo_generate_image(update: Update, context: ContextTypes.DEFAULT_
             await progress_message.delete()
 
         finally:
-            progress_task.cancel()
+            await progress_service.stop(progress)
 
         logger.info(f"Leonardo.ai image generated successfully for user {update.effective_user.id}")
 
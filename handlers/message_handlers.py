@@ -1,12 +1,18 @@
+import asyncio
 import logging
 import time
+import anthropic
 from telegram import Update
 from telegram.ext import ContextTypes
 from config import DEFAULT_MODEL, DEFAULT_SYSTEM_MESSAGE, ADMIN_USER_IDS
-from utils import anthropic_client
-from database import save_conversation, get_user_session, update_user_session
+from database import save_conversation_async
+from conversation_state import claude_conversation
+from streaming import StreamingReply
+from claude_context import stream_reply
+from dramatiq_tasks.summary_tasks import schedule_summary_async
 from performance_metrics import record_response_time, record_model_usage, record_error, record_command_usage
 from queue_system import queue_task
+from preferences_cache import get_user_preference_async
 
 logger = logging.getLogger(__name__)
 
@@ -15,7 +21,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_name = update.effective_user.username
     user_message = update.message.text
     user_id = update.effective_user.id
-    model = context.user_data.get('model', DEFAULT_MODEL)
+    model = await get_user_preference_async(update.effective_user.id, 'claude_model') or DEFAULT_MODEL
     system_message = context.user_data.get('system_message', DEFAULT_SYSTEM_MESSAGE)
 
     # Check if the message is in a group chat and mentions the bot
@@ -31,38 +37,39 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     try:
         # Get user session and conversation history
-        session = get_user_session(user_id)
-        conversation_history = session.get('conversation', [])
-
-        # Prepare messages for API call
-        messages = conversation_history + [{"role": "user", "content": user_message}]
+        conversation = claude_conversation(user_id)
+        summary, conversation_history = await conversation.recent_with_summary_async()
 
         # Send typing action
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
 
-        response = anthropic_client.messages.create(
-            model=model,
-            max_tokens=1000,
-            system=system_message,
-            messages=messages
-        )
-        assistant_response = response.content[0].text
-
-        # Update conversation history
-        conversation_history.append({"role": "user", "content": user_message})
-        conversation_history.append({"role": "assistant", "content": assistant_response})
-        update_user_session(user_id, {'conversation': conversation_history[-10:]})  # Keep last 10 messages
+        # Stream the reply into Telegram as it is generated
+        reply = StreamingReply(update.message, start_time)
+        await reply.start()
+        assistant_response = await stream_reply(reply, model, system_message, conversation_history, user_message, summary=summary)
 
-        await update.message.reply_text(assistant_response)
+        # Update conversation history and compact it in the background once it gets long
+        length = await conversation.append_async(
+            {"role": "user", "content": user_message},
+            {"role": "assistant", "content": assistant_response}
+        )
+        await schedule_summary_async("claude", user_id, length)
 
         # Save the conversation
-        save_conversation(user_id, user_message, assistant_response, model_type='claude')
+        await save_conversation_async(user_id, user_message, assistant_response, model_type='claude')
 
         # Record performance metrics
         end_time = time.time()
         record_response_time(end_time - start_time)
         record_model_usage(model)
 
+    except asyncio.CancelledError:
+        logger.info(f"Claude request for user {user_id} cancelled")
+        raise
+    except anthropic.APITimeoutError:
+        logger.error(f"Claude request for user {user_id} timed out")
+        await update.message.reply_text("The model took too long to respond. Please try again.")
+        record_error("anthropic_timeout")
     except Exception as e:
         logger.error(f"Error processing message for user {user_name} ({user_id}): {str(e)}")
         await update.message.reply_text(f"An error occurred: {str(e)}")
@@ -5,6 +5,7 @@ from config import DEFAULT_MODEL
 from model_cache import get_models
 from performance_metrics import record_command_usage
 from voice_cache import get_voices
+from preferences_cache import get_user_preference_async, set_user_preference_async
 
 logger = logging.getLogger(__name__)
 
@@ -30,14 +31,14 @@ async def set_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     # Set the model only if a valid argument is provided
     model = context.args[0]
-    context.user_data['model'] = model
+    await set_user_preference_async(update.effective_user.id, 'claude_model', model)
 
     logger.info(f"User {user.id} successfully set model to {model}")
     await update.message.reply_text(f"Model set to: {model}")
 
 async def current_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     record_command_usage("current_model")
-    current = context.user_data.get('model', DEFAULT_MODEL)
+    current = await get_user_preference_async(update.effective_user.id, 'claude_model') or DEFAULT_MODEL
     models = await get_models()
     logger.info(f"User {update.effective_user.id} checked current model: {models.get(current, 'Unknown')}")
     await update.message.reply_text(f"Current model: {models.get(current, 'Unknown')}")
@@ -49,7 +50,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     if query.data in await get_models():  # Only handle model-related callbacks
         chosen_model = query.data
-        context.user_data['model'] = chosen_model
+        await set_user_preference_async(update.effective_user.id, 'claude_model', chosen_model)
         models = await get_models()
         logger.info(f"User {update.effective_user.id} set model to {models.get(chosen_model, 'Unknown')}")
         await query.edit_message_text(f"Model set to {models.get(chosen_model, 'Unknown')}")
@@ -7,7 +7,8 @@ from telegram.ext import ContextTypes, CommandHandler, ConversationHandler, Mess
 from config import MAX_REPLICATE_GENERATIONS_PER_DAY
 from performance_metrics import record_command_usage, record_response_time, record_error
 from queue_system import queue_task
-from database import get_user_generations_today, save_user_generation
+from progress_service import progress_service
+from quota import get_generations_used_async, reserve_generation_async, commit_generation_async, refund_generation_async
 import replicate
 import aiohttp
 import io 
@@ -40,13 +41,20 @@ UPLOAD_PERSON, UPLOAD_TARGET = range(2)
 UPLOADING, PROMPT, ADDITIONAL_IMAGES = range(3)
 UPLOAD_IMAGE, SCALE_FACTOR, FACE_ENHANCE = range(3)
 
+async def reserve_replicate_generation(update: Update):
+    # The conversations only check the limit up front; the slot is taken once the job is scheduled
+    reservation = await reserve_generation_async(update.effective_user.id, "replicate", MAX_REPLICATE_GENERATIONS_PER_DAY)
+    if not reservation:
+        await update.effective_message.reply_text(f"Sorry {update.effective_user.username}, you have reached your daily limit of {MAX_REPLICATE_GENERATIONS_PER_DAY} Replicate image generations.")
+    return reservation
+
 async def photomaker_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     record_command_usage("photomaker")
     user_id = update.effective_user.id
     user_name = update.effective_user.username
     logger.info(f"Photomaker started by user {user_id} ({user_name})")
 
-    user_generations_today = get_user_generations_today(user_id, "replicate")
+    user_generations_today = await get_generations_used_async(user_id, "replicate")
     logger.info(f"User {user_id} has generated {user_generations_today} Replicate images today")
     if user_generations_today >= MAX_REPLICATE_GENERATIONS_PER_DAY:
         logger.warning(f"User {user_id} reached daily limit for Replicate generations")
@@ -103,13 +111,18 @@ async def get_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     await query.edit_message_text(f"Style selected: {selected_style}")
     
+    reservation = await reserve_replicate_generation(update)
+    if not reservation:
+        return ConversationHandler.END
+
     # Prepare data for the job
     job_data = {
         'chat_id': update.effective_chat.id,
         'user_id': update.effective_user.id,
         'photomaker_prompt': context.user_data.get('photomaker_prompt'),
         'photomaker_style': selected_style,
-        'photomaker_images': context.user_data.get('photomaker_images', [])
+        'photomaker_images': context.user_data.get('photomaker_images', []),
+        'reservation': reservation
     }
     
     # Schedule the image generation task
@@ -151,16 +164,17 @@ async def generate_image(context: ContextTypes.DEFAULT_TYPE) -> None:
             caption = f"Generated image using Photomaker:\nPrompt: {data['photomaker_prompt']}\nStyle: {data['photomaker_style']}"
             await context.bot.send_photo(chat_id=chat_id, photo=image_url, caption=caption)
             
-            save_user_generation(user_id, data['photomaker_prompt'], "replicate")
+            await commit_generation_async(data.get('reservation'), data['photomaker_prompt'])
             
-            user_generations_today = get_user_generations_today(user_id, "replicate")
-            remaining_generations = MAX_REPLICATE_GENERATIONS_PER_DAY - user_generations_today
-            await context.bot.send_message(chat_id=chat_id, text=f"You have {remaining_generations} Replicate image generations left for today.")
+            if data.get('reservation'):
+                await context.bot.send_message(chat_id=chat_id, text=f"You have {data['reservation']['remaining']} Replicate image generations left for today.")
         else:
+            await refund_generation_async(data.get('reservation'))
             await context.bot.send_message(chat_id=chat_id, text="Sorry, I couldn't generate an image. Please try again.")
 
     except Exception as e:
         logger.error(f"Photomaker image generation error for user {user_id}: {str(e)}")
+        await refund_generation_async(data.get('reservation'))
         await context.bot.send_message(chat_id=chat_id, text=f"An error occurred while generating the image: {str(e)}")
         record_error("photomaker_image_generation_error")
 
@@ -176,16 +190,15 @@ async def san_andreas_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = update.effective_user.id
     user_name = update.effective_user.username
 
-    user_generations_today = get_user_generations_today(user_id, "replicate")
-    logger.info(f"User {user_id} has generated {user_generations_today} Replicate images today")
-    if user_generations_today >= MAX_REPLICATE_GENERATIONS_PER_DAY:
-        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {MAX_REPLICATE_GENERATIONS_PER_DAY} Replicate image generations.")
-        return
-
     if not context.args:
         await update.message.reply_text(f"Please provide a prompt after the /san_andreas command. Be sure to include the trigger word '{SAN_ANDREAS_TRIGGER_WORD}' at the end of your prompt for best results.")
         return
 
+    reservation = await reserve_generation_async(user_id, "replicate", MAX_REPLICATE_GENERATIONS_PER_DAY)
+    if not reservation:
+        await update.message.reply_text(f"Sorry {user_name}, you have reached your daily limit of {MAX_REPLICATE_GENERATIONS_PER_DAY} Replicate image generations.")
+        return
+
     prompt = ' '.join(context.args)
     if not prompt.strip().endswith(SAN_ANDREAS_TRIGGER_WORD):
         prompt = f"{prompt.strip()} {SAN_ANDREAS_TRIGGER_WORD}"
@@ -197,22 +210,11 @@ async def san_andreas_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     start_time = time.time()
     try:
-        async def update_progress():
-            steps = [
-                "Loading San Andreas assets", "Preparing scene", "Generating characters",
-                "Adding vehicles", "Setting up lighting", "Rendering image",
-                "Applying GTA filters", "Finalizing output"
-            ]
-            step_index = 0
-            dots = 0
-            while True:
-                step = steps[step_index % len(steps)]
-                await progress_message.edit_text(f"🎮 {step}{'.' * dots}")
-                dots = (dots + 1) % 4
-                step_index += 1
-                await asyncio.sleep(2)
-
-        progress_task = asyncio.create_task(update_progress())
+        progress = progress_service.start(progress_message, "🎮", [
+            "Loading San Andreas assets", "Preparing scene", "Generating characters",
+            "Adding vehicles", "Setting up lighting", "Rendering image",
+            "Applying GTA filters", "Finalizing output"
+        ])
 
         try:
             input_data = {
@@ -231,16 +233,16 @@ async def san_andreas_command(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await update.message.reply_photo(photo=image_url, caption=f"Generated San Andreas style image for: {prompt}")
                 
                 # Save user generation
-                save_user_generation(user_id, prompt, "replicate")
+                await commit_generation_async(reservation, prompt)
                 
-                # Calculate and send remaining generations message
-                remaining_generations = MAX_REPLICATE_GENERATIONS_PER_DAY - (user_generations_today + 1)
-                await update.message.reply_text(f"You have {remaining_generations} San Andreas image generations left for today.")
+                # Send remaining generations message
+                await update.message.reply_text(f"You have {reservation['remaining']} San Andreas image generations left for today.")
             else:
                 logger.error("No image URL in the result")
+                await refund_generation_async(reservation)
                 await update.message.reply_text("Sorry, I couldn't generate an image. Please try again.")
         finally:
-            progress_task.cancel()
+            await progress_service.stop(progress)
             await progress_message.delete()
 
         end_time = time.time()
@@ -250,6 +252,7 @@ async def san_andreas_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     except Exception as e:
         logger.error(f"San Andreas image generation error for user {user_id}: {str(e)}")
+        await refund_generation_async(reservation)
         await progress_message.edit_text(f"An error occurred while generating the image: {str(e)}")
         record_error("san_andreas_image_generation_error")
     finally:
@@ -261,7 +264,7 @@ async def become_image_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_name = update.effective_user.username
     logger.info(f"Become Image started by user {user_id} ({user_name})")
 
-    user_generations_today = get_user_generations_today(user_id, "replicate")
+    user_generations_today = await get_generations_used_async(user_id, "replicate")
     logger.info(f"User {user_id} has generated {user_generations_today} Replicate images today")
     if user_generations_today >= MAX_REPLICATE_GENERATIONS_PER_DAY:
         logger.warning(f"User {user_id} reached daily limit for Replicate generations")
@@ -286,12 +289,17 @@ async def upload_target(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         file = await update.message.photo[-1].get_file()
         context.user_data['target_image'] = file.file_path
         
+        reservation = await reserve_replicate_generation(update)
+        if not reservation:
+            return ConversationHandler.END
+
         # Prepare data for the job
         job_data = {
             'chat_id': update.effective_chat.id,
             'user_id': update.effective_user.id,
             'person_image': context.user_data['person_image'],
-            'target_image': file.file_path
+            'target_image': file.file_path,
+            'reservation': reservation
         }
         
         # Schedule the image generation task
@@ -334,16 +342,17 @@ async def generate_become_image(context: ContextTypes.DEFAULT_TYPE) -> None:
             caption = "Generated 'Become Image' result"
             await context.bot.send_photo(chat_id=chat_id, photo=image_url, caption=caption)
             
-            save_user_generation(user_id, "become_image", "replicate")
+            await commit_generation_async(data.get('reservation'), "become_image")
             
-            user_generations_today = get_user_generations_today(user_id, "replicate")
-            remaining_generations = MAX_REPLICATE_GENERATIONS_PER_DAY - user_generations_today
-            await context.bot.send_message(chat_id=chat_id, text=f"You have {remaining_generations} Replicate image generations left for today.")
+            if data.get('reservation'):
+                await context.bot.send_message(chat_id=chat_id, text=f"You have {data['reservation']['remaining']} Replicate image generations left for today.")
         else:
+            await refund_generation_async(data.get('reservation'))
             await context.bot.send_message(chat_id=chat_id, text="Sorry, I couldn't generate the 'Become Image'. Please try again.")
 
     except Exception as e:
         logger.error(f"Become Image generation error for user {user_id}: {str(e)}")
+        await refund_generation_async(data.get('reservation'))
         await context.bot.send_message(chat_id=chat_id, text=f"An error occurred while generating the 'Become Image': {str(e)}")
         record_error("become_image_generation_error")
 
@@ -357,7 +366,7 @@ async def photomaker_style_start(update: Update, context: ContextTypes.DEFAULT_T
     user_name = update.effective_user.username
     logger.info(f"Photomaker Style started by user {user_id} ({user_name})")
 
-    user_generations_today = get_user_generations_today(user_id, "replicate")
+    user_generations_today = await get_generations_used_async(user_id, "replicate")
     logger.info(f"User {user_id} has generated {user_generations_today} Replicate images today")
     if user_generations_today >= MAX_REPLICATE_GENERATIONS_PER_DAY:
         logger.warning(f"User {user_id} reached daily limit for Replicate generations")
@@ -401,12 +410,17 @@ async def get_prompt_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     
     context.user_data['photomaker_style_prompt'] = prompt
     
+    reservation = await reserve_replicate_generation(update)
+    if not reservation:
+        return ConversationHandler.END
+
     # Prepare data for the job
     job_data = {
         'chat_id': update.effective_chat.id,
         'user_id': update.effective_user.id,
         'photomaker_style_prompt': prompt,
-        'photomaker_style_images': context.user_data.get('photomaker_style_images', [])
+        'photomaker_style_images': context.user_data.get('photomaker_style_images', []),
+        'reservation': reservation
     }
     
     # Schedule the image generation task
@@ -451,16 +465,17 @@ async def generate_photomaker_style_image(context: ContextTypes.DEFAULT_TYPE) ->
             caption = f"Generated image using Photomaker Style:\nPrompt: {data['photomaker_style_prompt']}"
             await context.bot.send_photo(chat_id=chat_id, photo=image_url, caption=caption)
             
-            save_user_generation(user_id, data['photomaker_style_prompt'], "replicate")
+            await commit_generation_async(data.get('reservation'), data['photomaker_style_prompt'])
             
-            user_generations_today = get_user_generations_today(user_id, "replicate")
-            remaining_generations = MAX_REPLICATE_GENERATIONS_PER_DAY - user_generations_today
-            await context.bot.send_message(chat_id=chat_id, text=f"You have {remaining_generations} Replicate image generations left for today.")
+            if data.get('reservation'):
+                await context.bot.send_message(chat_id=chat_id, text=f"You have {data['reservation']['remaining']} Replicate image generations left for today.")
         else:
+            await refund_generation_async(data.get('reservation'))
             await context.bot.send_message(chat_id=chat_id, text="Sorry, I couldn't generate an image. Please try again.")
 
     except Exception as e:
         logger.error(f"Photomaker Style image generation error for user {user_id}: {str(e)}")
+        await refund_generation_async(data.get('reservation'))
         await context.bot.send_message(chat_id=chat_id, text=f"An error occurred while generating the image: {str(e)}")
         record_error("photomaker_style_image_generation_error")
 
@@ -474,7 +489,7 @@ async def upscale_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     user_name = update.effective_user.username
     logger.info(f"Upscale started by user {user_id} ({user_name})")
 
-    user_generations_today = get_user_generations_today(user_id, "replicate")
+    user_generations_today = await get_generations_used_async(user_id, "replicate")
     logger.info(f"User {user_id} has generated {user_generations_today} Replicate images today")
     if user_generations_today >= MAX_REPLICATE_GENERATIONS_PER_DAY:
         logger.warning(f"User {user_id} reached daily limit for Replicate generations")
@@ -521,13 +536,18 @@ async def face_enhance_callback(update: Update, context: ContextTypes.DEFAULT_TY
     face_enhance = query.data == 'face_enhance_yes'
     context.user_data['face_enhance'] = face_enhance
     
+    reservation = await reserve_replicate_generation(update)
+    if not reservation:
+        return ConversationHandler.END
+
     # Prepare data for the job
     job_data = {
         'chat_id': update.effective_chat.id,
         'user_id': update.effective_user.id,
         'upscale_image': context.user_data['upscale_image'],
         'scale_factor': context.user_data['scale_factor'],
-        'face_enhance': face_enhance
+        'face_enhance': face_enhance,
+        'reservation': reservation
     }
     
     # Schedule the image upscaling task
@@ -595,16 +615,17 @@ async def generate_upscaled_image(context: ContextTypes.DEFAULT_TYPE) -> None:
                         await context.bot.send_message(chat_id=chat_id, 
                                                        text=f"I couldn't send the image directly, but you can view it here: {image_url}\n\n{caption}")
             
-            save_user_generation(user_id, "upscale", "replicate")
+            await commit_generation_async(data.get('reservation'), "upscale")
             
-            user_generations_today = get_user_generations_today(user_id, "replicate")
-            remaining_generations = MAX_REPLICATE_GENERATIONS_PER_DAY - user_generations_today
-            await context.bot.send_message(chat_id=chat_id, text=f"You have {remaining_generations} Replicate image generations left for today.")
+            if data.get('reservation'):
+                await context.bot.send_message(chat_id=chat_id, text=f"You have {data['reservation']['remaining']} Replicate image generations left for today.")
         else:
+            await refund_generation_async(data.get('reservation'))
             await context.bot.send_message(chat_id=chat_id, text="Sorry, I couldn't upscale the image. Please try again.")
 
     except Exception as e:
         logger.error(f"Image upscaling error for user {user_id}: {str(e)}")
+        await refund_generation_async(data.get('reservation'))
         await context.bot.send_message(chat_id=chat_id, text=f"An error occurred while upscaling the image: {str(e)}")
         record_error("image_upscaling_error")
 
@@ -1,5 +1,7 @@
+import asyncio
 import logging
 import time
+import anthropic
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ConversationHandler, CommandHandler, CallbackQueryHandler, ContextTypes, 
@@ -8,11 +10,14 @@ from telegram.ext import (
 from config import DEFAULT_MODEL, DEFAULT_SYSTEM_MESSAGE, ADMIN_USER_IDS, SUPPORT_CHAT_ID
 from model_cache import get_models
 from voice_cache import get_voices, get_default_voice
-from database import get_user_conversations, save_conversation
-from utils import anthropic_client
 from performance_metrics import record_command_usage, record_response_time, record_model_usage, record_error
 from queue_system import queue_task
-from database import get_user_conversations, save_conversation, clear_user_conversations, delete_user_session
+from database import get_user_conversations_async, save_conversation_async, clear_user_conversations_async
+from session_store import delete_session_async
+from conversation_state import claude_conversation
+from preferences_cache import get_user_preference_async, set_user_preference_async
+from streaming import StreamingReply
+from claude_context import stream_reply
 
 
 logger = logging.getLogger(__name__)
@@ -38,7 +43,7 @@ help_categories = {
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
-    context.user_data['model'] = DEFAULT_MODEL
+    await set_user_preference_async(update.effective_user.id, 'claude_model', DEFAULT_MODEL)
     is_admin = user.id in ADMIN_USER_IDS
 
     welcome_message = (
@@ -386,8 +391,9 @@ async def delete_session_command(update: Update, context: ContextTypes.DEFAULT_T
     user_id = update.effective_user.id
     logger.info(f"User {user_id} requested session deletion")
 
-    delete_user_session(user_id)
-    clear_user_conversations(user_id)
+    await delete_session_async(user_id)
+    await claude_conversation(user_id).clear_async()
+    await clear_user_conversations_async(user_id)
 
     # Clear the conversation history in the context
     if 'conversation' in context.user_data:
@@ -398,7 +404,7 @@ async def delete_session_command(update: Update, context: ContextTypes.DEFAULT_T
         del context.user_data['gpt_conversation']
 
     # Reset model to default
-    context.user_data['model'] = DEFAULT_MODEL
+    await set_user_preference_async(update.effective_user.id, 'claude_model', DEFAULT_MODEL)
 
     # Reset system message to default
     context.user_data['system_message'] = DEFAULT_SYSTEM_MESSAGE
@@ -409,7 +415,7 @@ async def get_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     record_command_usage("history")
     user_id = update.effective_user.id
     logger.info(f"User {user_id} requested conversation history")
-    conversations = get_user_conversations(user_id)
+    conversations = await get_user_conversations_async(user_id)
     if conversations:
         history = "Your recent conversations:\n\n"
         for conv in conversations:
@@ -444,7 +450,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_name = update.effective_user.username      
     user_message = update.message.text
     user_id = update.effective_user.id
-    model = context.user_data.get('model', DEFAULT_MODEL)
+    model = await get_user_preference_async(update.effective_user.id, 'claude_model') or DEFAULT_MODEL
     system_message = context.user_data.get('system_message', DEFAULT_SYSTEM_MESSAGE)
 
     # Check if the message is in a group chat and mentions the bot
@@ -459,26 +465,25 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     start_time = time.time()
 
     try:
-        response = anthropic_client.messages.create(
-            model=model,
-            max_tokens=1000,
-            system=system_message,
-            messages=[
-                {"role": "user", "content": user_message}
-            ]
-        )
-
-        assistant_response = response.content[0].text
-        await update.message.reply_text(assistant_response)
+        reply = StreamingReply(update.message, start_time)
+        await reply.start()
+        assistant_response = await stream_reply(reply, model, system_message, [], user_message)
 
         # Save the conversation
-        save_conversation(user_id, user_message, assistant_response)
+        await save_conversation_async(user_id, user_message, assistant_response)
 
         # Record performance metrics
         end_time = time.time()
         record_response_time(end_time - start_time)
         record_model_usage(model)
 
+    except asyncio.CancelledError:
+        logger.info(f"Claude request for user {user_id} cancelled")
+        raise
+    except anthropic.APITimeoutError:
+        logger.error(f"Claude request for user {user_id} timed out")
+        await update.message.reply_text("The model took too long to respond. Please try again.")
+        record_error("anthropic_timeout")
     except Exception as e:
         logger.error(f"Error processing message for user {user_id}: {e}")
         await update.message.reply_text(f"An error occurred: {e}")
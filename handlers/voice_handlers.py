@@ -10,7 +10,8 @@ from config import ELEVENLABS_API_KEY, ELEVENLABS_SOUND_GENERATION_API_URL
 from voice_cache import get_voices, get_default_voice, update_voice_cache
 from performance_metrics import record_command_usage, record_error, record_response_time
 from queue_system import queue_task
-from database import get_user_session, update_user_session
+from session_store import get_session_field_async, update_session_async, delete_session_fields_async
+from preferences_cache import get_user_preference_async, set_user_preference_async
 
 logger = logging.getLogger(__name__)
 
@@ -102,7 +103,7 @@ async def voice_button_callback(update: Update, context: ContextTypes.DEFAULT_TY
         voice_id = next((vid for vid in voices.keys() if vid.startswith(truncated_id)), None)
 
         if voice_id:
-            context.user_data['voice_id'] = voice_id
+            await set_user_preference_async(update.effective_user.id, 'tts_voice', voice_id)
             voice_name = voices.get(voice_id, "Unknown")
             logger.info(f"User {update.effective_user.id} set voice to {voice_name} (ID: {voice_id})")
             await query.edit_message_text(f"Voice set to {voice_name}")
@@ -115,7 +116,7 @@ async def voice_button_callback(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def current_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     record_command_usage("current_voice")
-    voice_id = context.user_data.get('voice_id', get_default_voice())
+    voice_id = await get_user_preference_async(update.effective_user.id, 'tts_voice') or get_default_voice()
     voices = await get_voices()
     voice_name = voices.get(voice_id, "Unknown")
     logger.info(f"User {update.effective_user.id} checked current voice: {voice_name} (ID: {voice_id})")
@@ -129,14 +130,14 @@ async def tts_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
 
     text = ' '.join(context.args)
-    voice_id = context.user_data.get('voice_id')
+    voice_id = await get_user_preference_async(update.effective_user.id, 'tts_voice')
 
     if not voice_id:
         # Automatically set a default voice
         voices = await get_voices()
         if voices:
             voice_id = next(iter(voices))  # Get the first available voice
-            context.user_data['voice_id'] = voice_id
+            await set_user_preference_async(update.effective_user.id, 'tts_voice', voice_id)
             await update.message.reply_text(f"No voice was set. I've automatically selected a default voice for you. You can change it later with /setvoice.")
         else:
             await update.message.reply_text("No voices are available. Please try again later.")
@@ -153,9 +154,7 @@ async def tts_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
 async def start_voice_addition(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    user_session = get_user_session(user_id)
-    
-    if 'custom_voice_id' in user_session:
+    if await get_session_field_async(user_id, 'custom_voice_id'):
         await update.message.reply_text("You already have a custom voice. You can only have one custom voice at a time. "
                                         "If you want to create a new one, please delete your existing custom voice first.")
         return ConversationHandler.END
@@ -190,9 +189,7 @@ async def receive_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
                 logger.info(f"Voice cache updated for user {user_id}")
                 
                 # Update user session with custom voice ID
-                user_session = get_user_session(user_id)
-                user_session['custom_voice_id'] = voice_id
-                update_user_session(user_id, user_session)
+                await update_session_async(user_id, {'custom_voice_id': voice_id})
                 
                 await update.message.reply_text(f"Your custom voice '{context.user_data['voice_name']}' has been added successfully! You can now use it for text-to-speech.")
             else:
@@ -241,18 +238,15 @@ async def add_voice_to_elevenlabs(name, file_path, user_id):
 
 async def delete_custom_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    user_session = get_user_session(user_id)
+    voice_id = await get_session_field_async(user_id, 'custom_voice_id')
     
-    if 'custom_voice_id' not in user_session:
+    if not voice_id:
         await update.message.reply_text("You don't have a custom voice to delete.")
         return
     
-    voice_id = user_session['custom_voice_id']
-    
     # Delete voice from ElevenLabs
     if await delete_voice_from_elevenlabs(voice_id):
-        del user_session['custom_voice_id']
-        update_user_session(user_id, user_session)
+        await delete_session_fields_async(user_id, 'custom_voice_id')
         await update_voice_cache()
         await update.message.reply_text("Your custom voice has been deleted successfully.")
     else:
@@ -1,12 +1,14 @@
 import psycopg2
 from psycopg2 import sql
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from migrations import run_migrations
 from config import POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_PORT
 import logging
 
 logger = logging.getLogger(__name__)
 
 def init_db():
+    conn = cur = None
     # First, connect to PostgreSQL server to create database if needed
     try:
         conn = psycopg2.connect(
@@ -34,7 +36,7 @@ def init_db():
         cur.close()
         conn.close()
 
-        # Now connect to the bot's database
+        # Now connect to the bot's database and apply the schema migrations
         conn = psycopg2.connect(
             dbname=POSTGRES_DB,
             user=POSTGRES_USER,
@@ -42,116 +44,9 @@ def init_db():
             host=POSTGRES_HOST,
             port=POSTGRES_PORT
         )
-        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-        cur = conn.cursor()
-
-        # Create users table
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id BIGINT PRIMARY KEY,
-            first_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            total_messages INTEGER DEFAULT 0,
-            total_claude_messages INTEGER DEFAULT 0,
-            total_gpt_messages INTEGER DEFAULT 0
-        )
-        """)
-
-        # Create conversations table
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS conversations (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT,
-            user_message TEXT,
-            bot_response TEXT,
-            model_type VARCHAR(50) DEFAULT 'claude',
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-
-        # Create banned_users table
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS banned_users (
-            user_id BIGINT PRIMARY KEY,
-            banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-
-        # Create command_usage table
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS command_usage (
-            command TEXT PRIMARY KEY,
-            count INTEGER DEFAULT 0
-        )
-        """)
-
-        # Create user_generations table
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS user_generations (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT,
-            prompt TEXT,
-            generation_type VARCHAR(20),
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-
-        # Create response_times table
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS response_times (
-            id SERIAL PRIMARY KEY,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            avg_duration FLOAT,
-            min_duration FLOAT,
-            max_duration FLOAT
-        )
-        """)
-
-        # Create model_usage table
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS model_usage (
-            model TEXT PRIMARY KEY,
-            count INTEGER DEFAULT 0
-        )
-        """)
-
-        # Create errors table
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS errors (
-            error_type TEXT PRIMARY KEY,
-            count INTEGER DEFAULT 0
-        )
-        """)
-
-        # Create user_data table for conversation histories and other user-specific data
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS user_data (
-            user_id BIGINT,
-            data_type VARCHAR(50),
-            data JSONB,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (user_id, data_type)
-        )
-        """)
-
-        # Create index for user_data
-        cur.execute("""
-        CREATE INDEX IF NOT EXISTS idx_user_data_lookup 
-        ON user_data(user_id, data_type)
-        """)
-
-        # Create connection_errors table for monitoring connection issues
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS connection_errors (
-            id SERIAL PRIMARY KEY,
-            error_type VARCHAR(100),
-            details TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
+        version = run_migrations(conn)
 
-        print("All tables created successfully.")
+        print(f"Schema is at version {version}.")
 
     except psycopg2.Error as e:
         print(f"An error occurred: {e}")
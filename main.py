@@ -4,10 +4,13 @@ import os
 from logging.handlers import RotatingFileHandler
 from bot import initialize_bot
 from model_cache import update_model_cache
-from performance_metrics import init_performance_db
 from queue_system import start_task_queue
-from config import ADMIN_USER_IDS
-from database import init_db
+from config import ADMIN_USER_IDS, BOT_MODE, ALLOWED_UPDATES
+from database import init_db, maintain_partitions, close_db_pool, flush_conversation_buffer
+from ban_list import load_ban_list
+from quota import drain_audit_writes
+from utils import close_api_clients
+from webhook_server import start_webhook
 
 def setup_logging():
     log_dir = "./logs"
@@ -54,10 +57,11 @@ async def main():
         init_db()
         logger.info("Database initialized successfully")
 
-        # Initialize performance metrics database
-        logger.info("Initializing performance metrics database")
-        init_performance_db()
-        logger.info("Performance metrics database initialized successfully")
+        # Create the upcoming partitions in case the nightly jobs were missed while the bot was down
+        maintain_partitions()
+
+        # Load the banned users into memory for the admission check
+        load_ban_list()
 
         # Ensure the model cache is populated before starting the bot
         logger.info("About to update model cache")
@@ -98,9 +102,14 @@ async def main():
             raise
         logger.info("Application started successfully")
 
-        logger.info("About to start polling")
-        await application.updater.start_polling()
-        logger.info("Polling started successfully")
+        if BOT_MODE == "webhook":
+            logger.info("About to start webhook server")
+            webhook_runner = await start_webhook(application)
+            logger.info("Webhook server started successfully")
+        else:
+            logger.info("About to start polling")
+            await application.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+            logger.info("Polling started successfully")
 
         # Notify admins that the bot has been restarted
         logger.info("Bot restarted or rebooted successfully. Notifying admins.")
@@ -121,6 +130,8 @@ async def main():
     finally:
         logger.info("Entering finally block")
         logger.info("Stopping bot")
+        if 'webhook_runner' in locals():
+            await webhook_runner.cleanup()
         if 'application' in locals() and hasattr(application, 'stop'):
             try:
                 await application.stop()
@@ -143,6 +154,12 @@ async def main():
             await asyncio.gather(*worker_tasks.values(), return_exceptions=True)
             logger.info("Worker tasks cancelled")
 
+        # Write out whatever the chat path and the quota audit log still have pending
+        await drain_audit_writes()
+        await flush_conversation_buffer()
+        close_db_pool()
+        await close_api_clients()
+
         logger.info("Bot stopped")
 
 if __name__ == "__main__":
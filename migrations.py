@@ -0,0 +1,451 @@
+# migrations.py
+
+import logging
+from datetime import date, datetime, timedelta
+from typing import Dict
+from psycopg2 import sql
+from config import GENERATION_RETENTION_DAYS
+
+logger = logging.getLogger(__name__)
+
+# The schema is versioned in the schema_version table. Each entry in MIGRATIONS
+# runs exactly once, in its own transaction, so a deploy applies its DDL once
+# (from initdb.py or the first process to boot) and every later bot start or
+# Dramatiq worker only reads the current version. To change the schema, append
+# a new (version, name, function) entry; never edit one that has shipped.
+#
+# This module only needs psycopg2 and config, so initdb.py can run it without
+# Redis or the connection pool.
+
+# Large append-only tables are range-partitioned by time:
+#   user_generations  one partition per day   (user_generations_pYYYYMMDD)
+#   conversations     one partition per month (conversations_pYYYYMM)
+# Retention drops or archives whole partitions instead of deleting rows, so
+# the nightly jobs no longer compete with the live inserts.
+#
+# Each table also has a DEFAULT partition ({table}_default), so inserts keep
+# working when the bot (which creates partitions ahead) has been down longer
+# than the partitions it created. Creating a partition moves the default's rows
+# for that range into it, and the bot's maintenance does so for every day or
+# month it finds there.
+
+GENERATION_PARTITION_PREFIX = "user_generations_p"
+CONVERSATION_PARTITION_PREFIX = "conversations_p"
+DEFAULT_PARTITION_SUFFIX = "_default"
+STATS_ROLLUP_SLOTS = 16
+
+USER_GENERATIONS_DDL = """
+CREATE TABLE IF NOT EXISTS user_generations (
+    id BIGSERIAL,
+    user_id BIGINT,
+    prompt TEXT,
+    generation_type VARCHAR(20),
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp)
+"""
+
+CONVERSATIONS_DDL = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id BIGSERIAL,
+    user_id BIGINT,
+    user_message TEXT,
+    bot_response TEXT,
+    model_type VARCHAR(20),
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp)
+"""
+
+def lock_partition_maintenance(cur):
+    # The bot and every worker touch partitions at startup; serialize them until commit
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('partition_maintenance'))")
+
+def first_of_month(day: date, months: int = 0) -> date:
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+def _table_exists(cur, name: str) -> bool:
+    cur.execute("SELECT to_regclass(%s)", (name,))
+    return cur.fetchone()[0] is not None
+
+def _take_from_default(cur, table: str, start: date, end: date) -> bool:
+    """Move the default partition's rows in [start, end) to the partition_rows temp table; False if there are none."""
+    default = f"{table}{DEFAULT_PARTITION_SUFFIX}"
+    if not _table_exists(cur, default):
+        return False
+    # Hold off inserts into the default until the new partition takes over the range
+    cur.execute(sql.SQL("LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE").format(sql.Identifier(default)))
+    cur.execute(sql.SQL("SELECT 1 FROM {} WHERE timestamp >= %s AND timestamp < %s LIMIT 1").format(sql.Identifier(default)), (start, end))
+    if not cur.fetchone():
+        return False
+    cur.execute(sql.SQL("CREATE TEMP TABLE partition_rows (LIKE {})").format(sql.Identifier(table)))
+    cur.execute(sql.SQL("""
+        WITH moved AS (DELETE FROM {} WHERE timestamp >= %s AND timestamp < %s RETURNING *)
+        INSERT INTO partition_rows SELECT * FROM moved
+    """).format(sql.Identifier(default)), (start, end))
+    logger.warning(f"Moving {cur.rowcount} rows from {default} into a new partition for {start}")
+    return True
+
+def create_partition(cur, table: str, name: str, start: date, end: date):
+    if _table_exists(cur, name):
+        return
+    # Postgres refuses the new partition while the default holds rows in its range
+    moved = _take_from_default(cur, table, start, end)
+    cur.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)").format(
+        sql.Identifier(name), sql.Identifier(table)
+    ), (start, end))
+    if moved:
+        cur.execute(sql.SQL("INSERT INTO {} SELECT * FROM partition_rows").format(sql.Identifier(table)))
+        cur.execute("DROP TABLE partition_rows")
+
+def create_default_partition(cur, table: str):
+    cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT").format(
+        sql.Identifier(f"{table}{DEFAULT_PARTITION_SUFFIX}"), sql.Identifier(table)
+    ))
+
+def default_partition_periods(cur, table: str, unit: str) -> list:
+    """The distinct days or months ('day' / 'month') of the rows in the table's default partition."""
+    cur.execute(sql.SQL("SELECT DISTINCT date_trunc(%s, timestamp)::date FROM {}").format(
+        sql.Identifier(f"{table}{DEFAULT_PARTITION_SUFFIX}")
+    ), (unit,))
+    return sorted(row[0] for row in cur.fetchall())
+
+def list_partitions(cur, table: str, prefix: str, date_format: str) -> Dict[date, str]:
+    cur.execute("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+        JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+        WHERE parent.relname = %s
+    """, (table,))
+    partitions = {}
+    for (name,) in cur.fetchall():
+        if name == f"{table}{DEFAULT_PARTITION_SUFFIX}":
+            continue
+        try:
+            partitions[datetime.strptime(name[len(prefix):], date_format).date()] = name
+        except ValueError:
+            logger.warning(f"Ignoring unexpected {table} partition {name}")
+    return partitions
+
+def create_generation_partition(cur, day: date):
+    create_partition(cur, "user_generations", f"{GENERATION_PARTITION_PREFIX}{day.strftime('%Y%m%d')}",
+                      day, day + timedelta(days=1))
+
+def create_conversation_partition(cur, month: date):
+    create_partition(cur, "conversations", f"{CONVERSATION_PARTITION_PREFIX}{month.strftime('%Y%m')}",
+                      month, first_of_month(month, 1))
+
+def _is_plain_table(cur, table: str) -> bool:
+    cur.execute("SELECT relkind FROM pg_class WHERE relname = %s AND relkind IN ('r', 'p')", (table,))
+    row = cur.fetchone()
+    return bool(row) and row[0] == 'r'
+
+def _rename_legacy_table(cur, table: str):
+    cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(sql.Identifier(table), sql.Identifier(f"{table}_legacy")))
+    cur.execute(sql.SQL("ALTER SEQUENCE IF EXISTS {} RENAME TO {}").format(
+        sql.Identifier(f"{table}_id_seq"), sql.Identifier(f"{table}_legacy_id_seq")
+    ))
+
+def _migrate_user_generations(cur):
+    # Older deployments created user_generations as a plain table; move the
+    # rows still inside the retention window into the partitioned layout.
+    if not _is_plain_table(cur, "user_generations"):
+        return
+    logger.info("Converting user_generations to a partitioned table")
+    _rename_legacy_table(cur, "user_generations")
+    cur.execute(USER_GENERATIONS_DDL)
+    cur.execute("SELECT MIN(timestamp)::date FROM user_generations_legacy WHERE timestamp >= CURRENT_DATE - %s", (GENERATION_RETENTION_DAYS,))
+    first_day = cur.fetchone()[0]
+    if first_day:
+        day = first_day
+        while day < date.today():
+            create_generation_partition(cur, day)
+            day += timedelta(days=1)
+    create_generation_partition(cur, date.today())
+    cur.execute("""
+        INSERT INTO user_generations (user_id, prompt, generation_type, timestamp)
+        SELECT user_id, prompt, generation_type, timestamp FROM user_generations_legacy
+        WHERE timestamp >= CURRENT_DATE - %s AND timestamp < CURRENT_DATE + 1
+    """, (GENERATION_RETENTION_DAYS,))
+    logger.info(f"Moved {cur.rowcount} generation records into partitions")
+    cur.execute("DROP TABLE user_generations_legacy")
+
+def _migrate_conversations(cur):
+    # Same one-off conversion for conversations; history is kept in full and
+    # left for archive_old_conversations to age out.
+    if not _is_plain_table(cur, "conversations"):
+        return
+    logger.info("Converting conversations to a partitioned table")
+    _rename_legacy_table(cur, "conversations")
+    cur.execute(CONVERSATIONS_DDL)
+    cur.execute("SELECT MIN(timestamp)::date FROM conversations_legacy")
+    first_day = cur.fetchone()[0]
+    current_month = first_of_month(date.today())
+    month = first_of_month(first_day) if first_day else current_month
+    while month <= current_month:
+        create_conversation_partition(cur, month)
+        month = first_of_month(month, 1)
+    cur.execute("""
+        INSERT INTO conversations (user_id, user_message, bot_response, model_type, timestamp)
+        SELECT user_id, user_message, bot_response, model_type, timestamp FROM conversations_legacy
+        WHERE timestamp IS NOT NULL AND timestamp < %s
+    """, (first_of_month(current_month, 1),))
+    logger.info(f"Moved {cur.rowcount} conversations into partitions")
+    cur.execute("DROP TABLE conversations_legacy")
+
+def _baseline(cur):
+    lock_partition_maintenance(cur)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id BIGINT PRIMARY KEY,
+        first_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        total_messages INTEGER DEFAULT 0,
+        total_claude_messages INTEGER DEFAULT 0,
+        total_gpt_messages INTEGER DEFAULT 0
+    )
+    """)
+
+    # Partitioned tables, converting plain tables left by older deployments
+    _migrate_user_generations(cur)
+    cur.execute(USER_GENERATIONS_DDL)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_user_generations_user_type_ts
+    ON user_generations (user_id, generation_type, timestamp)
+    """)
+    create_generation_partition(cur, date.today())
+
+    _migrate_conversations(cur)
+    cur.execute(CONVERSATIONS_DDL)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_conversations_user_ts
+    ON conversations (user_id, timestamp DESC)
+    """)
+    create_conversation_partition(cur, first_of_month(date.today()))
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_preferences (
+        user_id BIGINT PRIMARY KEY,
+        flux_model TEXT,
+        suno_model TEXT,
+        image_model TEXT,
+        openai_model TEXT,
+        leonardo_model TEXT,
+        replicate_model TEXT
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS banned_users (
+        user_id BIGINT PRIMARY KEY,
+        banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    # Performance metrics
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS response_times (
+        id SERIAL PRIMARY KEY,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        avg_duration FLOAT,
+        min_duration FLOAT,
+        max_duration FLOAT
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS model_usage (
+        model TEXT PRIMARY KEY,
+        count INTEGER DEFAULT 0
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS command_usage (
+        command TEXT PRIMARY KEY,
+        count INTEGER DEFAULT 0
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS errors (
+        error_type TEXT PRIMARY KEY,
+        count INTEGER DEFAULT 0
+    )
+    """)
+
+    # Conversation histories and other user-specific data
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_data (
+        user_id BIGINT,
+        data_type VARCHAR(50),
+        data JSONB,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, data_type)
+    )
+    """)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_user_data_lookup
+    ON user_data(user_id, data_type)
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS connection_errors (
+        id SERIAL PRIMARY KEY,
+        error_type VARCHAR(100),
+        details TEXT,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+def _reconcile_columns(cur):
+    # The three old bootstraps disagreed, so existing databases may be missing
+    # columns that a fresh baseline has
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS first_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+    for column in ('claude_model', 'flux_model', 'suno_model', 'image_model', 'openai_model',
+                   'leonardo_model', 'replicate_model', 'tts_voice', 'gpt_voice'):
+        cur.execute(sql.SQL("ALTER TABLE user_preferences ADD COLUMN IF NOT EXISTS {} TEXT").format(sql.Identifier(column)))
+
+def _stats_rollup(cur):
+    # Running totals behind get_user_stats, striped over STATS_ROLLUP_SLOTS rows
+    # (slot = user id modulo the slot count) so concurrent saves rarely wait on
+    # the same row; reading the totals sums a fixed number of rows
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_stats_rollup (
+        slot SMALLINT PRIMARY KEY,
+        total_users BIGINT NOT NULL DEFAULT 0,
+        total_messages BIGINT NOT NULL DEFAULT 0,
+        total_claude_messages BIGINT NOT NULL DEFAULT 0,
+        total_gpt_messages BIGINT NOT NULL DEFAULT 0
+    )
+    """)
+    # Hold off writers to users while seeding so no increment falls in between
+    cur.execute("LOCK TABLE users IN SHARE MODE")
+    cur.execute("""
+    INSERT INTO user_stats_rollup (slot, total_users, total_messages, total_claude_messages, total_gpt_messages)
+    SELECT slots.slot, COUNT(users.id), COALESCE(SUM(users.total_messages), 0),
+           COALESCE(SUM(users.total_claude_messages), 0), COALESCE(SUM(users.total_gpt_messages), 0)
+    FROM generate_series(0, %s - 1) AS slots(slot)
+    LEFT JOIN users ON users.id %% %s = slots.slot
+    GROUP BY slots.slot
+    ON CONFLICT (slot) DO NOTHING
+    """, (STATS_ROLLUP_SLOTS, STATS_ROLLUP_SLOTS))
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_last_interaction ON users (last_interaction)")
+
+def _first_token_times(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS first_token_times (
+        id SERIAL PRIMARY KEY,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        avg_duration FLOAT,
+        min_duration FLOAT,
+        max_duration FLOAT
+    )
+    """)
+
+def _prompt_cache_usage(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS prompt_cache_usage (
+        metric TEXT PRIMARY KEY,
+        tokens BIGINT DEFAULT 0
+    )
+    """)
+
+def _context_tokens(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS context_tokens (
+        id SERIAL PRIMARY KEY,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        avg_tokens FLOAT,
+        min_tokens INTEGER,
+        max_tokens INTEGER
+    )
+    """)
+
+def _queue_stats(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS queue_stats (
+        id SERIAL PRIMARY KEY,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        queue_type TEXT,
+        avg_wait FLOAT,
+        max_wait FLOAT,
+        max_depth INTEGER
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS queue_rejections (
+        reason TEXT PRIMARY KEY,
+        count INTEGER DEFAULT 0
+    )
+    """)
+
+def _default_partitions(cur):
+    lock_partition_maintenance(cur)
+    create_default_partition(cur, "user_generations")
+    create_default_partition(cur, "conversations")
+
+MIGRATIONS = [
+    (1, "baseline", _baseline),
+    (2, "reconcile columns", _reconcile_columns),
+    (3, "user stats rollup", _stats_rollup),
+    (4, "first token times", _first_token_times),
+    (5, "prompt cache usage", _prompt_cache_usage),
+    (6, "context tokens", _context_tokens),
+    (7, "queue stats", _queue_stats),
+    (8, "default partitions", _default_partitions),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(cur) -> int:
+    cur.execute("SELECT to_regclass('schema_version')")
+    if cur.fetchone()[0] is None:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+def run_migrations(conn) -> int:
+    """Apply every pending migration on `conn` and return the resulting schema version."""
+    with conn.cursor() as cur:
+        # Session lock, held across the per-migration commits below, so processes
+        # booting together wait for the first one instead of racing it
+        cur.execute("SELECT pg_advisory_lock(hashtext('schema_migrations'))")
+        try:
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
+            conn.commit()
+
+            version = get_schema_version(cur)
+            for number, name, migrate in MIGRATIONS:
+                if number <= version:
+                    continue
+                logger.info(f"Applying schema migration {number}: {name}")
+                try:
+                    migrate(cur)
+                    cur.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)", (number, name))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                version = number
+            return version
+        finally:
+            if not conn.closed:
+                conn.rollback()
+                cur.execute("SELECT pg_advisory_unlock(hashtext('schema_migrations'))")
+                conn.commit()
+
+def ensure_schema(conn) -> int:
+    """Check the schema version and only run the migrations when it is behind."""
+    with conn.cursor() as cur:
+        version = get_schema_version(cur)
+    conn.commit()
+    if version >= LATEST_VERSION:
+        return version
+    return run_migrations(conn)
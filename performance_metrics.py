@@ -4,61 +4,58 @@ import psycopg2
 import statistics
 import logging
 from telegram.ext import ContextTypes
-from database import get_postgres_connection
+from database import get_postgres_connection, run_db
+from response_cache import get_cache_stats
+from telegram_rate_limiter import get_rate_limiter_stats
 
 logger = logging.getLogger(__name__)
 
 # Initialize performance tracking
 performance_data = {
     'response_times': [],
+    'first_token_times': [],
+    'context_tokens': [],
     'model_usage': defaultdict(int),
     'command_usage': defaultdict(int),
-    'errors': defaultdict(int)
+    'errors': defaultdict(int),
+    'prompt_cache': defaultdict(int),
+    'queue_waits': defaultdict(list),
+    'queue_depths': defaultdict(int),
+    'queue_rejections': defaultdict(int)
 }
 
-def init_performance_db():
-    conn = get_postgres_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS response_times (
-        id SERIAL PRIMARY KEY,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        avg_duration FLOAT,
-        min_duration FLOAT,
-        max_duration FLOAT
-    )
-    ''')
-
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS model_usage (
-        model TEXT PRIMARY KEY,
-        count INTEGER
-    )
-    ''')
-
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS command_usage (
-        command TEXT PRIMARY KEY,
-        count INTEGER
-    )
-    ''')
-
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS errors (
-        error_type TEXT PRIMARY KEY,
-        count INTEGER
-    )
-    ''')
-
-    conn.commit()
-    conn.close()
-    logger.info("Performance database initialized")
-
 def record_response_time(duration):
     performance_data['response_times'].append(duration)
     logger.debug(f"Recorded response time: {duration}")
 
+def record_first_token_time(duration):
+    performance_data['first_token_times'].append(duration)
+    logger.debug(f"Recorded time to first token: {duration}")
+
+def record_context_tokens(tokens):
+    performance_data['context_tokens'].append(tokens)
+    logger.debug(f"Recorded context size: {tokens} tokens")
+
+def record_prompt_cache_usage(read_tokens, written_tokens, uncached_tokens):
+    # Hits are input tokens served from the prompt cache; misses are tokens
+    # written to it plus tokens sent outside any cached prefix
+    performance_data['prompt_cache']['cache_read'] += read_tokens
+    performance_data['prompt_cache']['cache_write'] += written_tokens
+    performance_data['prompt_cache']['uncached'] += uncached_tokens
+    logger.debug(f"Recorded prompt cache usage: read={read_tokens}, write={written_tokens}, uncached={uncached_tokens}")
+
+def record_queue_wait(queue_type, duration):
+    performance_data['queue_waits'][queue_type].append(duration)
+
+def record_queue_depth(queue_type, depth):
+    # Only the peak depth of each period is kept
+    if depth > performance_data['queue_depths'][queue_type]:
+        performance_data['queue_depths'][queue_type] = depth
+
+def record_queue_rejection(queue_type, reason):
+    performance_data['queue_rejections'][f"{queue_type}:{reason}"] += 1
+    logger.debug(f"Recorded queue rejection: {queue_type} ({reason})")
+
 def record_model_usage(model):
     performance_data['model_usage'][model] += 1
     logger.debug(f"Recorded model usage: {model}")
@@ -80,88 +77,173 @@ def record_error(error_type):
     logger.debug(f"Recorded error: {error_type}")
 
 async def save_performance_data(context: ContextTypes.DEFAULT_TYPE = None):
-    conn = get_postgres_connection()
-    cursor = conn.cursor()
+    # Swap the counters out on the event loop thread so the database thread never
+    # iterates dicts that handlers are still writing to
+    snapshot = {
+        'response_times': list(performance_data['response_times']),
+        'first_token_times': list(performance_data['first_token_times']),
+        'context_tokens': list(performance_data['context_tokens']),
+        'model_usage': dict(performance_data['model_usage']),
+        'command_usage': dict(performance_data['command_usage']),
+        'errors': dict(performance_data['errors']),
+        'prompt_cache': dict(performance_data['prompt_cache']),
+        'queue_waits': {k: list(v) for k, v in performance_data['queue_waits'].items()},
+        'queue_depths': dict(performance_data['queue_depths']),
+        'queue_rejections': dict(performance_data['queue_rejections'])
+    }
+    performance_data['response_times'].clear()
+    performance_data['first_token_times'].clear()
+    performance_data['context_tokens'].clear()
+    performance_data['model_usage'].clear()
+    performance_data['command_usage'].clear()
+    performance_data['errors'].clear()
+    performance_data['prompt_cache'].clear()
+    performance_data['queue_waits'].clear()
+    performance_data['queue_depths'].clear()
+    performance_data['queue_rejections'].clear()
+    await run_db(_save_performance_snapshot, snapshot)
 
+def _save_performance_snapshot(snapshot):
     try:
-        # Save response times
-        if performance_data['response_times']:
-            avg_duration = statistics.mean(performance_data['response_times'])
-            min_duration = min(performance_data['response_times'])
-            max_duration = max(performance_data['response_times'])
-            cursor.execute('INSERT INTO response_times (avg_duration, min_duration, max_duration) VALUES (%s, %s, %s)',
-                           (avg_duration, min_duration, max_duration))
-            logger.info(f"Saved response times: avg={avg_duration}, min={min_duration}, max={max_duration}")
-            performance_data['response_times'].clear()
-
-        # Save model usage
-        for model, count in performance_data['model_usage'].items():
-            cursor.execute('''
-            INSERT INTO model_usage (model, count) 
-            VALUES (%s, %s) 
-            ON CONFLICT (model) 
-            DO UPDATE SET count = model_usage.count + %s
-            ''', (model, count, count))
-            logger.info(f"Saved model usage: {model} = {count}")
-        performance_data['model_usage'].clear()
-
-        # Save command usage
-        for command, count in performance_data['command_usage'].items():
-            cursor.execute('''
-            INSERT INTO command_usage (command, count) 
-            VALUES (%s, %s) 
-            ON CONFLICT (command) 
-            DO UPDATE SET count = command_usage.count + %s
-            ''', (command, count, count))
-            logger.info(f"Saved command usage: {command} = {count}")
-        performance_data['command_usage'].clear()
-
-        # Save errors
-        for error_type, count in performance_data['errors'].items():
-            cursor.execute('''
-            INSERT INTO errors (error_type, count) 
-            VALUES (%s, %s) 
-            ON CONFLICT (error_type) 
-            DO UPDATE SET count = errors.count + %s
-            ''', (error_type, count, count))
-            logger.info(f"Saved error count: {error_type} = {count}")
-        performance_data['errors'].clear()
-
-        conn.commit()
+        with get_postgres_connection() as conn:
+            with conn.cursor() as cursor:
+                # Save response times
+                if snapshot['response_times']:
+                    avg_duration = statistics.mean(snapshot['response_times'])
+                    min_duration = min(snapshot['response_times'])
+                    max_duration = max(snapshot['response_times'])
+                    cursor.execute('INSERT INTO response_times (avg_duration, min_duration, max_duration) VALUES (%s, %s, %s)',
+                                   (avg_duration, min_duration, max_duration))
+                    logger.info(f"Saved response times: avg={avg_duration}, min={min_duration}, max={max_duration}")
+
+                # Save time to first token of streamed replies
+                if snapshot['first_token_times']:
+                    cursor.execute('INSERT INTO first_token_times (avg_duration, min_duration, max_duration) VALUES (%s, %s, %s)',
+                                   (statistics.mean(snapshot['first_token_times']), min(snapshot['first_token_times']),
+                                    max(snapshot['first_token_times'])))
+
+                # Save assembled prompt sizes
+                if snapshot['context_tokens']:
+                    cursor.execute('INSERT INTO context_tokens (avg_tokens, min_tokens, max_tokens) VALUES (%s, %s, %s)',
+                                   (statistics.mean(snapshot['context_tokens']), min(snapshot['context_tokens']),
+                                    max(snapshot['context_tokens'])))
+
+                # Save model usage
+                for model, count in snapshot['model_usage'].items():
+                    cursor.execute('''
+                    INSERT INTO model_usage (model, count) 
+                    VALUES (%s, %s) 
+                    ON CONFLICT (model) 
+                    DO UPDATE SET count = model_usage.count + %s
+                    ''', (model, count, count))
+                    logger.info(f"Saved model usage: {model} = {count}")
+
+                # Save command usage
+                for command, count in snapshot['command_usage'].items():
+                    cursor.execute('''
+                    INSERT INTO command_usage (command, count) 
+                    VALUES (%s, %s) 
+                    ON CONFLICT (command) 
+                    DO UPDATE SET count = command_usage.count + %s
+                    ''', (command, count, count))
+                    logger.info(f"Saved command usage: {command} = {count}")
+
+                # Save errors
+                for error_type, count in snapshot['errors'].items():
+                    cursor.execute('''
+                    INSERT INTO errors (error_type, count) 
+                    VALUES (%s, %s) 
+                    ON CONFLICT (error_type) 
+                    DO UPDATE SET count = errors.count + %s
+                    ''', (error_type, count, count))
+                    logger.info(f"Saved error count: {error_type} = {count}")
+
+                # Save prompt cache token counts
+                for metric, tokens in snapshot['prompt_cache'].items():
+                    cursor.execute('''
+                    INSERT INTO prompt_cache_usage (metric, tokens)
+                    VALUES (%s, %s)
+                    ON CONFLICT (metric)
+                    DO UPDATE SET tokens = prompt_cache_usage.tokens + %s
+                    ''', (metric, tokens, tokens))
+
+                # Save task queue wait times and peak depth per queue type
+                for queue_type in set(snapshot['queue_waits']) | set(snapshot['queue_depths']):
+                    waits = snapshot['queue_waits'].get(queue_type) or [0.0]
+                    cursor.execute('INSERT INTO queue_stats (queue_type, avg_wait, max_wait, max_depth) VALUES (%s, %s, %s, %s)',
+                                   (queue_type, statistics.mean(waits), max(waits), snapshot['queue_depths'].get(queue_type, 0)))
+
+                # Save refused and shed tasks
+                for reason, count in snapshot['queue_rejections'].items():
+                    cursor.execute('''
+                    INSERT INTO queue_rejections (reason, count)
+                    VALUES (%s, %s)
+                    ON CONFLICT (reason)
+                    DO UPDATE SET count = queue_rejections.count + %s
+                    ''', (reason, count, count))
+                    logger.info(f"Saved queue rejections: {reason} = {count}")
+
         logger.info("Performance data saved to database")
     except Exception as e:
         logger.error(f"Error saving performance data: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
 
-def get_performance_metrics():
-    conn = get_postgres_connection()
-    cursor = conn.cursor()
+async def get_performance_metrics():
+    return await run_db(_get_performance_metrics)
+
+def _get_performance_metrics():
+    with get_postgres_connection() as conn:
+        with conn.cursor() as cursor:
+            # Get average, min, and max response times
+            cursor.execute('SELECT AVG(avg_duration), MIN(min_duration), MAX(max_duration) FROM response_times')
+            avg_response_time, min_response_time, max_response_time = cursor.fetchone()
+
+            cursor.execute('SELECT AVG(avg_duration), MIN(min_duration), MAX(max_duration) FROM first_token_times')
+            avg_first_token, min_first_token, max_first_token = cursor.fetchone()
 
-    # Get average, min, and max response times
-    cursor.execute('SELECT AVG(avg_duration), MIN(min_duration), MAX(max_duration) FROM response_times')
-    avg_response_time, min_response_time, max_response_time = cursor.fetchone()
+            cursor.execute('SELECT AVG(avg_tokens), MIN(min_tokens), MAX(max_tokens) FROM context_tokens')
+            avg_context_tokens, min_context_tokens, max_context_tokens = cursor.fetchone()
 
-    # Get model usage
-    cursor.execute('SELECT model, SUM(count) FROM model_usage GROUP BY model ORDER BY SUM(count) DESC')
-    model_usage = dict(cursor.fetchall())
+            # Get model usage
+            cursor.execute('SELECT model, SUM(count) FROM model_usage GROUP BY model ORDER BY SUM(count) DESC')
+            model_usage = dict(cursor.fetchall())
 
-    # Get command usage
-    cursor.execute('SELECT command, SUM(count) FROM command_usage GROUP BY command ORDER BY SUM(count) DESC')
-    command_usage = dict(cursor.fetchall())
+            # Get command usage
+            cursor.execute('SELECT command, SUM(count) FROM command_usage GROUP BY command ORDER BY SUM(count) DESC')
+            command_usage = dict(cursor.fetchall())
 
-    # Get error counts
-    cursor.execute('SELECT error_type, SUM(count) FROM errors GROUP BY error_type ORDER BY SUM(count) DESC')
-    errors = dict(cursor.fetchall())
+            # Get error counts
+            cursor.execute('SELECT error_type, SUM(count) FROM errors GROUP BY error_type ORDER BY SUM(count) DESC')
+            errors = dict(cursor.fetchall())
 
-    conn.close()
+            # Get prompt cache token counts
+            cursor.execute('SELECT metric, tokens FROM prompt_cache_usage')
+            prompt_cache = dict(cursor.fetchall())
+
+            # Get task queue wait times, peak depths and rejections
+            cursor.execute('''
+            SELECT queue_type, AVG(avg_wait), MAX(max_wait), MAX(max_depth)
+            FROM queue_stats GROUP BY queue_type ORDER BY queue_type
+            ''')
+            queue_stats = cursor.fetchall()
+            cursor.execute('SELECT reason, count FROM queue_rejections ORDER BY count DESC')
+            queue_rejections = dict(cursor.fetchall())
 
     metrics = f"Response times:\n"
     metrics += f"  Average: {avg_response_time:.2f} seconds\n"
     metrics += f"  Minimum: {min_response_time:.2f} seconds\n"
     metrics += f"  Maximum: {max_response_time:.2f} seconds\n\n"
+
+    if avg_first_token is not None:
+        metrics += "Time to first token:\n"
+        metrics += f"  Average: {avg_first_token:.2f} seconds\n"
+        metrics += f"  Minimum: {min_first_token:.2f} seconds\n"
+        metrics += f"  Maximum: {max_first_token:.2f} seconds\n\n"
+
+    if avg_context_tokens is not None:
+        metrics += "Prompt size (tokens):\n"
+        metrics += f"  Average: {avg_context_tokens:.0f}\n"
+        metrics += f"  Minimum: {min_context_tokens}\n"
+        metrics += f"  Maximum: {max_context_tokens}\n\n"
     
     metrics += "Model usage:\n"
     for model, count in model_usage.items():
@@ -174,7 +256,46 @@ def get_performance_metrics():
     metrics += "\nErrors:\n"
     for error_type, count in errors.items():
         metrics += f"  {error_type}: {count} times\n"
+
+    cache_read = prompt_cache.get('cache_read', 0)
+    cache_missed = prompt_cache.get('cache_write', 0) + prompt_cache.get('uncached', 0)
+    if cache_read or cache_missed:
+        metrics += "\nPrompt cache:\n"
+        metrics += f"  Hit tokens: {cache_read}\n"
+        metrics += f"  Miss tokens: {cache_missed} ({prompt_cache.get('cache_write', 0)} written to cache)\n"
+        metrics += f"  Hit rate: {cache_read / (cache_read + cache_missed):.1%}\n"
+
+    if queue_stats:
+        metrics += "\nTask queues:\n"
+        for queue_type, avg_wait, max_wait, max_depth in queue_stats:
+            metrics += f"  {queue_type}: average wait {avg_wait:.2f}s, max wait {max_wait:.2f}s, peak depth {max_depth}\n"
+        for reason, count in queue_rejections.items():
+            metrics += f"  {reason}: {count} tasks dropped\n"
+
+    try:
+        response_cache_stats = get_cache_stats()
+    except Exception as e:
+        logger.error(f"Error reading LLM response cache stats: {e}")
+        response_cache_stats = {}
+    if response_cache_stats:
+        metrics += "\nLLM response cache:\n"
+        for namespace, counts in sorted(response_cache_stats.items()):
+            metrics += f"  {namespace}: {counts['hit']} hits, {counts['miss']} misses\n"
     
+    try:
+        rate_limiter_stats = get_rate_limiter_stats()
+    except Exception as e:
+        logger.error(f"Error reading Telegram rate limiter stats: {e}")
+        rate_limiter_stats = None
+    if rate_limiter_stats and rate_limiter_stats['sends']:
+        delayed = rate_limiter_stats['delayed']
+        metrics += "\nTelegram rate limiter:\n"
+        metrics += f"  Requests sent: {rate_limiter_stats['sends']}\n"
+        metrics += f"  Queued: {delayed} ({delayed / rate_limiter_stats['sends']:.1%})\n"
+        if delayed:
+            metrics += f"  Average queueing delay: {rate_limiter_stats['delay_ms'] / delayed / 1000:.2f} seconds\n"
+        metrics += f"  RetryAfter received: {rate_limiter_stats['retry_after']}\n"
+
     logger.info(f"Retrieved performance metrics")
     return metrics
 def record_connection_error(error_type: str, details: str = None):
@@ -191,6 +312,7 @@ def record_connection_error(error_type: str, details: str = None):
         logger.error(f"Failed to record connection error: {e}")
 
 # Make sure all necessary functions are exported
-__all__ = ['init_performance_db', 'record_response_time', 'record_model_usage', 
+__all__ = ['record_response_time', 'record_first_token_time', 'record_prompt_cache_usage', 'record_context_tokens', 'record_queue_wait',
+           'record_queue_depth', 'record_queue_rejection', 'record_model_usage', 
            'record_command_usage', 'record_error', 'save_performance_data', 
            'get_performance_metrics','record_connection_error']
\ No newline at end of file
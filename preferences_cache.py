@@ -0,0 +1,107 @@
+# preferences_cache.py
+
+import logging
+import os
+import threading
+import time
+from typing import Optional
+import redis
+from config import REDIS_HOST, REDIS_PORT, REDIS_DB, PREFERENCES_CACHE_TTL
+from database import (get_user_preferences_row, save_user_model, run_db,
+                      PREFERENCE_COLUMNS, PREFERENCES_INVALIDATION_CHANNEL)
+
+logger = logging.getLogger(__name__)
+
+# Per-process read-through cache of user_preferences rows. A lookup is a dict
+# hit; the whole row is loaded on the first miss and kept for
+# PREFERENCES_CACHE_TTL seconds. save_user_model publishes the user id on
+# PREFERENCES_INVALIDATION_CHANNEL, and every process (the bot and each
+# Dramatiq worker) drops its copy when it sees it. The TTL bounds staleness
+# if an invalidation is missed while Redis is unreachable.
+
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+
+_cache = {}     # user_id -> (expires_at, preferences dict)
+_versions = {}  # user_id -> invalidation counter, guards against storing a row loaded before an invalidation
+_lock = threading.Lock()
+_subscriber = None
+_subscriber_pid = None
+
+def _on_invalidate(message):
+    try:
+        invalidate_user_preferences(int(message['data']))
+    except (TypeError, ValueError):
+        logger.warning(f"Ignoring malformed preferences invalidation: {message['data']!r}")
+
+def _ensure_subscriber():
+    global _subscriber, _subscriber_pid
+    if _subscriber_pid == os.getpid():
+        return
+    with _lock:
+        if _subscriber_pid == os.getpid():
+            return
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{PREFERENCES_INVALIDATION_CHANNEL: _on_invalidate})
+            _subscriber = pubsub.run_in_thread(sleep_time=1, daemon=True)
+            logger.info("Subscribed to user preferences invalidations")
+        except Exception as e:
+            # Entries still expire after the TTL; try subscribing again on the next lookup
+            logger.error(f"Could not subscribe to preferences invalidations: {e}")
+            return
+        _cache.clear()
+        _subscriber_pid = os.getpid()
+
+def invalidate_user_preferences(user_id: int):
+    with _lock:
+        _cache.pop(user_id, None)
+        _versions[user_id] = _versions.get(user_id, 0) + 1
+
+def _cached(user_id: int):
+    _ensure_subscriber()
+    entry = _cache.get(user_id)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+def _store(user_id: int, version: int, preferences: Optional[dict]):
+    # None means the load failed; don't pin that for a whole TTL
+    if preferences is None:
+        return
+    with _lock:
+        if _versions.get(user_id, 0) == version:
+            _cache[user_id] = (time.monotonic() + PREFERENCES_CACHE_TTL, preferences)
+
+def get_user_preferences(user_id: int) -> dict:
+    preferences = _cached(user_id)
+    if preferences is None:
+        version = _versions.get(user_id, 0)
+        preferences = get_user_preferences_row(user_id)
+        _store(user_id, version, preferences)
+    return preferences or {}
+
+def get_user_preference(user_id: int, column: str, default=None):
+    return get_user_preferences(user_id).get(column) or default
+
+def set_user_preference(user_id: int, column: str, value) -> None:
+    if column not in PREFERENCE_COLUMNS:
+        raise ValueError(f"Unknown preference column: {column}")
+    save_user_model(user_id, column, value)
+    invalidate_user_preferences(user_id)
+
+async def get_user_preferences_async(user_id: int) -> dict:
+    preferences = _cached(user_id)
+    if preferences is None:
+        version = _versions.get(user_id, 0)
+        preferences = await run_db(get_user_preferences_row, user_id)
+        _store(user_id, version, preferences)
+    return preferences or {}
+
+async def get_user_preference_async(user_id: int, column: str, default=None):
+    return (await get_user_preferences_async(user_id)).get(column) or default
+
+async def set_user_preference_async(user_id: int, column: str, value) -> None:
+    if column not in PREFERENCE_COLUMNS:
+        raise ValueError(f"Unknown preference column: {column}")
+    await run_db(save_user_model, user_id, column, value)
+    invalidate_user_preferences(user_id)
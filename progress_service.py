@@ -0,0 +1,204 @@
+# progress_service.py
+
+import asyncio
+import logging
+import time
+import redis
+import redis.asyncio as aioredis
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter
+from config import (REDIS_HOST, REDIS_PORT, REDIS_DB, PROGRESS_TICK, PROGRESS_MIN_INTERVAL, PROGRESS_MAX_INTERVAL,
+                    PROGRESS_BACKOFF_FACTOR, PROGRESS_MAX_AGE)
+from telegram_rate_limiter import RateLimitSkipped, saturated_recently
+
+logger = logging.getLogger(__name__)
+
+# Owns the "working on it..." messages of long-running jobs. Instead of one
+# coroutine per job editing its message every 2 seconds, a single scheduler
+# ticks all of them. Each message is edited at its own interval, which grows
+# the longer the job runs; edits that wouldn't change the text are skipped,
+# and the cosmetic step animation pauses while the Bot API rate limiter is
+# queueing requests. An edit never waits for the limiter: it only goes out
+# if a token is free with one to spare for the job's real reply, otherwise
+# the frame is skipped. Real progress replaces the animation and is shown at
+# the next tick: handlers push it directly, Dramatiq workers push it through
+# Redis with push_progress() for messages the bot registered with remote=True.
+#
+# Keys:
+#   progress:{chat_id}:{message_id}   latest text pushed by a worker ("" = job finished)
+
+PUSH_TTL = int(PROGRESS_MAX_AGE)
+
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+async_redis_client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+
+def _push_key(chat_id: int, message_id: int) -> str:
+    return f"progress:{chat_id}:{message_id}"
+
+def push_progress(chat_id: int, message_id: int, text: str):
+    """Show `text` on a progress message tracked by the bot process (for Dramatiq workers)."""
+    try:
+        redis_client.set(_push_key(chat_id, message_id), text, ex=PUSH_TTL)
+    except Exception as e:
+        logger.error(f"Error pushing progress for message {message_id} in chat {chat_id}: {e}")
+
+def finish_progress(chat_id: int, message_id: int):
+    """Tell the bot process to stop updating a progress message (for Dramatiq workers)."""
+    push_progress(chat_id, message_id, "")
+
+class ProgressEntry:
+    def __init__(self, message: Message, prefix: str, steps: tuple, remote: bool):
+        self.message = message
+        self.prefix = prefix
+        self.steps = steps
+        self.remote = remote
+        self.pushed = None
+        self.shown = message.text
+        self.frame = 0
+        self.interval = PROGRESS_MIN_INTERVAL
+        self.started_at = time.monotonic()
+        self.last_edit_at = self.started_at
+        self.next_update_at = self.started_at + self.interval
+        self.inflight = None
+
+    @property
+    def key(self) -> tuple:
+        return (self.message.chat_id, self.message.message_id)
+
+    def render(self):
+        if self.pushed is not None:
+            return self.pushed
+        if not self.steps:
+            return None
+        step = self.steps[self.frame % len(self.steps)]
+        return f"{self.prefix} {step}{'.' * (self.frame % 4)}"
+
+    def set_pushed(self, text: str):
+        if text == self.pushed:
+            return
+        self.pushed = text
+        self.interval = PROGRESS_MIN_INTERVAL
+        self.next_update_at = min(self.next_update_at, self.last_edit_at + PROGRESS_MIN_INTERVAL)
+
+class ProgressService:
+    def __init__(self):
+        self._entries = {}
+        self._task = None
+        self._inflight = set()
+        self._paused_until = 0.0
+
+    def start(self, message: Message, prefix: str = "", steps=(), remote: bool = False) -> tuple:
+        """Track a progress message; returns the key to push to and stop it with.
+
+        `steps` are cycled through as an animation until real progress is
+        pushed. With remote=True the message also shows text pushed by a
+        Dramatiq worker through push_progress().
+        """
+        entry = ProgressEntry(message, prefix, tuple(steps), remote)
+        self._entries[entry.key] = entry
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return entry.key
+
+    def push(self, key: tuple, text: str):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.set_pushed(text)
+
+    async def stop(self, key: tuple):
+        """Stop updating the message, waiting for an edit already in flight.
+
+        That is at most one Bot API round trip (edits never queue for the rate
+        limiter), and it keeps a late frame from overwriting what the caller
+        edits the message to next.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry.inflight is not None and not entry.inflight.done():
+            try:
+                await entry.inflight
+            except Exception:
+                pass
+
+    def active_count(self) -> int:
+        return len(self._entries)
+
+    async def _run(self):
+        while self._entries:
+            await asyncio.sleep(PROGRESS_TICK)
+            try:
+                await self._tick()
+            except Exception as e:
+                logger.error(f"Error updating progress messages: {str(e)}")
+
+    async def _pull_remote(self):
+        remote = [entry for entry in self._entries.values() if entry.remote]
+        if not remote:
+            return
+        values = await async_redis_client.mget([_push_key(*entry.key) for entry in remote])
+        for entry, value in zip(remote, values):
+            if value is None:
+                continue
+            text = value.decode('utf-8')
+            if text:
+                entry.set_pushed(text)
+            else:
+                self._entries.pop(entry.key, None)
+
+    async def _tick(self):
+        await self._pull_remote()
+        now = time.monotonic()
+        # Animation frames are the first thing to give up when Telegram traffic is backing up
+        cosmetic_allowed = now >= self._paused_until and not saturated_recently(PROGRESS_MIN_INTERVAL)
+        for entry in list(self._entries.values()):
+            if now - entry.started_at > PROGRESS_MAX_AGE:
+                self._entries.pop(entry.key, None)
+                continue
+            if entry.next_update_at > now or (entry.inflight is not None and not entry.inflight.done()):
+                continue
+            if entry.pushed is None:
+                if not cosmetic_allowed:
+                    entry.next_update_at = now + entry.interval
+                    continue
+                entry.frame += 1
+            entry.interval = min(entry.interval * PROGRESS_BACKOFF_FACTOR, PROGRESS_MAX_INTERVAL)
+            entry.next_update_at = now + entry.interval
+            text = entry.render()
+            if text is None or text == entry.shown:
+                continue
+            # Not awaited here: one slow chat must not hold up the others' next tick
+            entry.inflight = asyncio.create_task(self._edit(entry, text))
+            self._inflight.add(entry.inflight)
+            entry.inflight.add_done_callback(self._inflight.discard)
+
+    async def _edit(self, entry: ProgressEntry, text: str):
+        try:
+            # Neither queued nor retried by the rate limiter: a skipped frame is better than a late one.
+            # Through the bot, Message.edit_text doesn't take rate_limit_args.
+            await entry.message.get_bot().edit_message_text(
+                chat_id=entry.message.chat_id,
+                message_id=entry.message.message_id,
+                text=text,
+                rate_limit_args={"max_retries": 0, "skip_if_limited": True}
+            )
+            entry.shown = text
+            entry.last_edit_at = time.monotonic()
+        except RateLimitSkipped:
+            # Tried again at the entry's next update
+            pass
+        except RetryAfter as e:
+            self._paused_until = time.monotonic() + float(e.retry_after)
+            entry.next_update_at = self._paused_until + entry.interval
+            logger.warning(f"Progress updates paused for {e.retry_after}s after RetryAfter")
+        except BadRequest as e:
+            error = str(e).lower()
+            if "not modified" in error:
+                entry.shown = text
+            elif "not found" in error or "can't be edited" in error:
+                # The job finished and removed or replaced its message
+                self._entries.pop(entry.key, None)
+            else:
+                logger.error(f"Error editing progress message in chat {entry.message.chat_id}: {str(e)}")
+        except Exception as e:
+            logger.error(f"Error editing progress message in chat {entry.message.chat_id}: {str(e)}")
+
+progress_service = ProgressService()
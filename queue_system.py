@@ -1,34 +1,247 @@
 import asyncio
 import logging
+import time
+from collections import deque, Counter
 from telegram import Update
 from telegram.ext import ContextTypes
 from functools import partial
+from config import (QUICK_QUEUE_WORKERS, LONG_RUN_QUEUE_WORKERS, QUEUE_ADMIN_WEIGHT, QUEUE_USER_WEIGHTS,
+                    ADMIN_USER_IDS, QUICK_QUEUE_MAX_DEPTH, LONG_RUN_QUEUE_MAX_DEPTH, QUEUE_MAX_TASKS_PER_USER,
+                    QUICK_QUEUE_MAX_WAIT, LONG_RUN_QUEUE_MAX_WAIT)
+from performance_metrics import record_queue_wait, record_queue_depth, record_queue_rejection
+from progress_service import progress_service
 
 logger = logging.getLogger(__name__)
 
+# Cost of one task in deficit round-robin; a user with weight w is served w tasks per round
+TASK_COST = 1.0
+# Floor for weights from a custom weight_for, so every user earns a turn within a few rounds
+MIN_WEIGHT = 0.1
+
+# Replies for tasks that are refused at admission or dropped before running
+BUSY_MESSAGES = {
+    'full': "⏳ I'm handling a lot of requests right now. Please try again in a minute.",
+    'shed': "⏳ I'm handling a lot of requests right now, so one of your queued requests was dropped. Please send it again in a minute.",
+    'user_limit': "⏳ You already have several requests waiting. Please wait for them to finish before sending more.",
+    'stale': "⏳ Your request waited too long in the queue and was dropped. Please send it again.",
+}
+
+def user_weight(user_id: int) -> float:
+    if user_id in QUEUE_USER_WEIGHTS:
+        return QUEUE_USER_WEIGHTS[user_id]
+    if user_id in ADMIN_USER_IDS:
+        return QUEUE_ADMIN_WEIGHT
+    return 1.0
+
+class FairQueue:
+    """Deficit round-robin queue over users.
+
+    Each user with pending tasks has their own FIFO. Users take turns in the
+    order they became active; at the start of a turn a user's deficit grows by
+    their weight and they are served tasks while it covers the task cost, so a
+    user with a burst of messages gets one task (or `weight` tasks) per round
+    instead of holding everyone behind them. Same get/put/qsize/task_done
+    interface as asyncio.Queue, for a single consumer.
+    """
+
+    def __init__(self, weight_for=user_weight):
+        self.weight_for = weight_for
+        self._tasks = {}         # user_id -> deque of pending items
+        self._deficit = {}       # user_id -> accumulated credit
+        self._active = deque()   # users with pending items, in round-robin order
+        self._turn_started = False
+        self._size = 0
+        self._not_empty = asyncio.Event()
+
+    def _weight(self, user_id: int) -> float:
+        return max(self.weight_for(user_id), MIN_WEIGHT)
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def put_nowait(self, user_id: int, item):
+        if user_id not in self._tasks:
+            self._tasks[user_id] = deque()
+            self._deficit[user_id] = 0.0
+            self._active.append(user_id)
+        self._tasks[user_id].append(item)
+        self._size += 1
+        self._not_empty.set()
+
+    async def put(self, user_id: int, item):
+        self.put_nowait(user_id, item)
+
+    def get_nowait(self):
+        if not self._size:
+            raise asyncio.QueueEmpty
+        while True:
+            user_id = self._active[0]
+            if not self._turn_started:
+                self._deficit[user_id] += self._weight(user_id)
+                self._turn_started = True
+            if self._deficit[user_id] >= TASK_COST:
+                break
+            # Not enough credit this round (weights below 1); carry it over
+            self._active.rotate(-1)
+            self._turn_started = False
+
+        self._deficit[user_id] -= TASK_COST
+        tasks = self._tasks[user_id]
+        item = tasks.popleft()
+        self._size -= 1
+        if not tasks:
+            # An idle user keeps no credit
+            del self._tasks[user_id]
+            del self._deficit[user_id]
+            self._active.popleft()
+            self._turn_started = False
+        elif self._deficit[user_id] < TASK_COST:
+            self._active.rotate(-1)
+            self._turn_started = False
+        if not self._size:
+            self._not_empty.clear()
+        return item
+
+    async def get(self):
+        while not self._size:
+            await self._not_empty.wait()
+        return self.get_nowait()
+
+    def task_done(self):
+        pass
+
+    def pending_for(self, user_id: int) -> int:
+        tasks = self._tasks.get(user_id)
+        return len(tasks) if tasks else 0
+
+    def heaviest_user(self):
+        """The user with the most pending tasks relative to their weight, or None."""
+        if not self._active:
+            return None
+        return max(self._active, key=lambda user_id: len(self._tasks[user_id]) / self._weight(user_id))
+
+    def pop_newest(self, user_id: int):
+        """Remove and return the most recently queued task of `user_id`."""
+        tasks = self._tasks[user_id]
+        item = tasks.pop()
+        self._size -= 1
+        if not tasks:
+            if self._active[0] == user_id:
+                self._turn_started = False
+            self._active.remove(user_id)
+            del self._tasks[user_id]
+            del self._deficit[user_id]
+        if not self._size:
+            self._not_empty.clear()
+        return item
+
+    def snapshot(self) -> list:
+        """[(user_id, pending, deficit, weight)] in round-robin order, current user first."""
+        return [
+            (user_id, len(self._tasks[user_id]), self._deficit[user_id], self._weight(user_id))
+            for user_id in self._active
+        ]
+
 class TaskQueue:
-    def __init__(self):
+    """Per-type pools of worker shards.
+
+    Each queue type has a fixed number of shards, each a FairQueue with its
+    own worker. A task goes to the shard picked by its user id, so a user's
+    tasks run one at a time in arrival order while other users' tasks run on
+    the other shards, and users sharing a shard are served round-robin.
+
+    Shards are bounded. A user over their pending-task limit is refused; when
+    a shard is full, the newest task of the user with the most pending work
+    (relative to weight) is shed to make room if that user is heavier than
+    the one enqueueing, otherwise the new task is refused. Tasks that waited
+    longer than the queue type's max wait are dropped instead of run. Either
+    way the task's on_shed callback is told why, so the user gets an
+    immediate "busy" reply rather than a late answer.
+    """
+
+    def __init__(self, shard_counts: dict = None, max_depths: dict = None, max_waits: dict = None):
+        shard_counts = shard_counts or {'long_run': LONG_RUN_QUEUE_WORKERS, 'quick': QUICK_QUEUE_WORKERS}
         self.queues = {
-            'long_run': asyncio.Queue(),
-            'quick': asyncio.Queue()
+            queue_type: [FairQueue() for _ in range(max(count, 1))]
+            for queue_type, count in shard_counts.items()
         }
+        self.max_depths = max_depths or {'long_run': LONG_RUN_QUEUE_MAX_DEPTH, 'quick': QUICK_QUEUE_MAX_DEPTH}
+        self.max_waits = max_waits or {'long_run': LONG_RUN_QUEUE_MAX_WAIT, 'quick': QUICK_QUEUE_MAX_WAIT}
+        self.rejected = Counter()   # "{queue_type}:{reason}" -> tasks refused or dropped since start
         self.workers = {}
         self.loop = asyncio.get_event_loop()
-        logger.info("TaskQueue initialized")
+        logger.info(f"TaskQueue initialized with shards: {', '.join(f'{k}={len(v)}' for k, v in self.queues.items())}")
+
+    def shard_for(self, task_type: str, user_id: int) -> int:
+        return user_id % len(self.queues[task_type])
 
-    async def add_task(self, task_type: str, user_id: int, task_func, *args, **kwargs):
-        logger.info(f"Adding {task_type} task for user {user_id} to queue")
-        await self.queues[task_type].put((user_id, task_func, args, kwargs))
-        logger.info(f"{task_type.capitalize()} task added to queue for user {user_id}. Queue size: {self.queues[task_type].qsize()}")
-        if task_type not in self.workers or self.workers[task_type].done():
-            self.workers[task_type] = asyncio.create_task(self.worker(task_type))
+    def queue_depths(self, task_type: str) -> list:
+        return [queue.qsize() for queue in self.queues[task_type]]
 
-    async def worker(self, queue_type: str):
-        logger.info(f"Worker for {queue_type} queue started")
+    def scheduler_state(self, task_type: str) -> list:
+        """Per shard, the FairQueue snapshot of the users waiting in it."""
+        return [queue.snapshot() for queue in self.queues[task_type]]
+
+    def _ensure_worker(self, task_type: str, shard: int):
+        name = f"{task_type}:{shard}"
+        if name not in self.workers or self.workers[name].done():
+            self.workers[name] = asyncio.create_task(self.worker(task_type, shard))
+
+    def _reject(self, task_type: str, user_id: int, reason: str):
+        self.rejected[f"{task_type}:{reason}"] += 1
+        record_queue_rejection(task_type, reason)
+        logger.warning(f"{task_type.capitalize()} task for user {user_id} dropped: {reason}")
+
+    async def _notify(self, on_shed, reason: str):
+        if on_shed is None:
+            return
+        try:
+            await on_shed(reason)
+        except Exception as e:
+            logger.error(f"Error notifying user of a dropped task: {str(e)}")
+
+    async def add_task(self, task_type: str, user_id: int, task_func, *args, on_shed=None, **kwargs) -> bool:
+        """Queue a task; returns False (after awaiting on_shed(reason)) if it was refused."""
+        shard = self.shard_for(task_type, user_id)
+        queue = self.queues[task_type][shard]
+
+        if queue.pending_for(user_id) >= QUEUE_MAX_TASKS_PER_USER:
+            self._reject(task_type, user_id, 'user_limit')
+            await self._notify(on_shed, 'user_limit')
+            return False
+        if queue.qsize() >= self.max_depths[task_type]:
+            heaviest = queue.heaviest_user()
+            if heaviest is None or (queue.pending_for(heaviest) / queue.weight_for(heaviest)
+                                    <= (queue.pending_for(user_id) + 1) / queue.weight_for(user_id)):
+                self._reject(task_type, user_id, 'full')
+                await self._notify(on_shed, 'full')
+                return False
+            *_, shed_on_shed = queue.pop_newest(heaviest)
+            self._reject(task_type, heaviest, 'shed')
+            asyncio.create_task(self._notify(shed_on_shed, 'shed'))
+
+        await queue.put(user_id, (user_id, task_func, args, kwargs, time.monotonic(), on_shed))
+        record_queue_depth(task_type, queue.qsize())
+        logger.info(f"{task_type.capitalize()} task added to shard {shard} for user {user_id}. Shard queue size: {queue.qsize()}")
+        self._ensure_worker(task_type, shard)
+        return True
+
+    async def worker(self, queue_type: str, shard: int):
+        logger.info(f"Worker for {queue_type} shard {shard} started")
+        queue = self.queues[queue_type][shard]
         while True:
             try:
-                user_id, task_func, args, kwargs = await self.queues[queue_type].get()
-                logger.info(f"Processing {queue_type} task for user {user_id}")
+                user_id, task_func, args, kwargs, enqueued_at, on_shed = await queue.get()
+                waited = time.monotonic() - enqueued_at
+                record_queue_wait(queue_type, waited)
+                if self.max_waits[queue_type] and waited > self.max_waits[queue_type]:
+                    self._reject(queue_type, user_id, 'stale')
+                    await self._notify(on_shed, 'stale')
+                    continue
+                logger.info(f"Processing {queue_type} task for user {user_id} after {waited:.2f}s in queue")
                 try:
                     await task_func(*args, **kwargs)
                     logger.info(f"{queue_type.capitalize()} task completed for user {user_id}")
@@ -36,16 +249,17 @@ class TaskQueue:
                     logger.error(f"Error processing {queue_type} task for user {user_id}: {str(e)}")
                     logger.exception("Exception details:")
                 finally:
-                    self.queues[queue_type].task_done()
+                    queue.task_done()
             except Exception as e:
-                logger.error(f"Error in {queue_type} worker: {str(e)}")
+                logger.error(f"Error in {queue_type} worker {shard}: {str(e)}")
                 await asyncio.sleep(1)
 
     def start(self):
         logger.info("Starting task queues")
-        for queue_type in self.queues.keys():
-            self.workers[queue_type] = asyncio.create_task(self.worker(queue_type))
-        logger.info(f"Task queue workers started: {', '.join(self.workers.keys())}")
+        for queue_type, shards in self.queues.items():
+            for shard in range(len(shards)):
+                self._ensure_worker(queue_type, shard)
+        logger.info(f"Task queue workers started: {len(self.workers)}")
 
 task_queue = TaskQueue()
 
@@ -66,7 +280,10 @@ def queue_task(task_type='quick'):
                     logger.error(f"Error in {task_type} task for user {user_id}: {str(e)}")
                     await update.message.reply_text("An error occurred while processing your request. Please try again later.")
             
-            await task_queue.add_task(task_type, user_id, task_wrapper)
+            async def notify_busy(reason):
+                await update.effective_message.reply_text(BUSY_MESSAGES[reason])
+
+            await task_queue.add_task(task_type, user_id, task_wrapper, on_shed=notify_busy)
             
 #            if task_type == 'long_run':
 #                await update.message.reply_text("Your request has been queued. You'll be notified when it's ready.")
@@ -77,17 +294,26 @@ def queue_task(task_type='quick'):
 async def start_task_queue():
     logger.info("Starting task queue")
     task_queue.start()
-    logger.info(f"Task queue started with workers: {', '.join(task_queue.workers.keys())}")
+    logger.info(f"Task queue started with {len(task_queue.workers)} workers")
     return task_queue.workers
 
 async def check_queue_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    long_run_size = task_queue.queues['long_run'].qsize()
-    quick_size = task_queue.queues['quick'].qsize()
-    worker_status = ", ".join([f"{k}: {'running' if not v.done() else 'stopped'}" for k, v in task_queue.workers.items()])
-    status_message = (
-        f"Queue Status:\n"
-        f"Long-running tasks in queue: {long_run_size}\n"
-        f"Quick tasks in queue: {quick_size}\n"
-        f"Worker status: {worker_status}"
-    )
-    await update.message.reply_text(status_message)
\ No newline at end of file
+    lines = ["Queue Status:"]
+    for queue_type, label in (('long_run', "Long-running"), ('quick', "Quick")):
+        depths = task_queue.queue_depths(queue_type)
+        workers = [task_queue.workers.get(f"{queue_type}:{shard}") for shard in range(len(depths))]
+        running = sum(1 for worker in workers if worker is not None and not worker.done())
+        lines.append(f"{label} tasks in queue: {sum(depths)} ({running}/{len(depths)} workers running)")
+        lines.append(f"  Per shard: {' '.join(str(depth) for depth in depths)} (limit {task_queue.max_depths[queue_type]} each)")
+        dropped = {reason.split(':', 1)[1]: count for reason, count in task_queue.rejected.items() if reason.startswith(f"{queue_type}:")}
+        if dropped:
+            lines.append(f"  Dropped since start: {', '.join(f'{reason} {count}' for reason, count in sorted(dropped.items()))}")
+        if update.effective_user.id in ADMIN_USER_IDS:
+            waiting = sorted(
+                (entry for shard in task_queue.scheduler_state(queue_type) for entry in shard),
+                key=lambda entry: entry[1], reverse=True
+            )
+            for user_id, pending, deficit, weight in waiting[:5]:
+                lines.append(f"  User {user_id}: {pending} pending, weight {weight:g}, deficit {deficit:.1f}")
+    lines.append(f"Progress messages being updated: {progress_service.active_count()}")
+    await update.message.reply_text("\n".join(lines))
\ No newline at end of file
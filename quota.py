@@ -0,0 +1,230 @@
+# quota.py
+
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+import redis
+import redis.asyncio as aioredis
+from config import REDIS_HOST, REDIS_PORT, REDIS_DB
+from database import (get_user_generations_today, get_user_generations_today_async,
+                      save_user_generation, save_user_generation_async)
+
+logger = logging.getLogger(__name__)
+
+# Daily generation quotas live in Redis so the limit check is a single atomic
+# round trip instead of a COUNT(*) over user_generations. A slot is reserved
+# before the work is queued, committed once the result was delivered and
+# refunded when the generation fails. Postgres remains the audit log.
+#
+# If Redis is unreachable, or the day's counter can't be seeded because Postgres
+# is, the request is let through uncounted (as before the counters existed)
+# rather than failing it or pinning a wrong count in Redis for the rest of the
+# day; the next request tries again. Commits still write the audit row, and
+# the Redis side of a commit or refund is skipped with a log while it is down.
+#
+# Keys (both expire shortly after the day they belong to):
+#   quota:{generation_type}:{user_id}:{YYYYMMDD}          used slots, reserved + committed
+#   quota:{generation_type}:{user_id}:{YYYYMMDD}:pending  hash of open reservation tokens
+
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+async_redis_client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+
+# Keep the keys around for an hour past midnight so late commits/refunds still find them
+EXPIRY_GRACE_SECONDS = 3600
+
+RESERVE_SCRIPT = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+if used >= tonumber(ARGV[1]) then
+    return -1
+end
+used = redis.call('INCR', KEYS[1])
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+redis.call('EXPIREAT', KEYS[1], ARGV[4])
+redis.call('EXPIREAT', KEYS[2], ARGV[4])
+return used
+"""
+
+REFUND_SCRIPT = """
+if redis.call('HDEL', KEYS[2], ARGV[1]) == 0 then
+    return -1
+end
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+if used > 0 then
+    return redis.call('DECR', KEYS[1])
+end
+return 0
+"""
+
+_reserve = redis_client.register_script(RESERVE_SCRIPT)
+_refund = redis_client.register_script(REFUND_SCRIPT)
+_reserve_async = async_redis_client.register_script(RESERVE_SCRIPT)
+_refund_async = async_redis_client.register_script(REFUND_SCRIPT)
+
+# Background audit-log writes scheduled by commit_generation_async
+_pending_audit_writes = set()
+
+def _quota_key(user_id: int, generation_type: str) -> str:
+    return f"quota:{generation_type}:{user_id}:{datetime.now().strftime('%Y%m%d')}"
+
+def _expire_at() -> int:
+    tomorrow = (datetime.now() + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return int(tomorrow.timestamp()) + EXPIRY_GRACE_SECONDS
+
+def _new_reservation(user_id: int, generation_type: str, key: str, used: int, limit: int) -> dict:
+    # Plain dict so it can be passed through Dramatiq messages as-is
+    return {
+        "user_id": user_id,
+        "generation_type": generation_type,
+        "key": key,
+        "token": uuid.uuid4().hex,
+        "used": used,
+        "limit": limit,
+        "remaining": max(0, limit - used),
+        "counted": True
+    }
+
+def _uncounted_reservation(user_id: int, generation_type: str, key: str, limit: int, reason: str) -> dict:
+    logger.warning(f"{reason}, allowing {generation_type} generation for user {user_id} uncounted")
+    reservation = _new_reservation(user_id, generation_type, key, 0, limit)
+    reservation["counted"] = False
+    return reservation
+
+def _seed_ttl() -> int:
+    return max(1, _expire_at() - int(time.time()))
+
+# Sync API, used by the Dramatiq actors
+
+def _ensure_seeded(user_id: int, generation_type: str, key: str) -> bool:
+    """Make sure today's counter exists; False if it doesn't and Postgres couldn't be read to seed it."""
+    # First use of the day (or Redis was flushed): carry over what Postgres already recorded
+    if redis_client.exists(key):
+        return True
+    used = get_user_generations_today(user_id, generation_type)
+    if used is None:
+        return False
+    redis_client.set(key, used, nx=True, ex=_seed_ttl())
+    return True
+
+def get_generations_used(user_id: int, generation_type: str) -> int:
+    key = _quota_key(user_id, generation_type)
+    try:
+        if not _ensure_seeded(user_id, generation_type, key):
+            return 0
+        return int(redis_client.get(key) or 0)
+    except redis.RedisError as e:
+        logger.error(f"Error reading {generation_type} quota for user {user_id}: {e}")
+        return 0
+
+def reserve_generation(user_id: int, generation_type: str, limit: int) -> Optional[dict]:
+    """Atomically take one of today's slots. Returns the reservation, or None when the limit is reached."""
+    key = _quota_key(user_id, generation_type)
+    reservation = _new_reservation(user_id, generation_type, key, 0, limit)
+    try:
+        if not _ensure_seeded(user_id, generation_type, key):
+            return _uncounted_reservation(user_id, generation_type, key, limit, "Could not seed the quota counter")
+        used = _reserve(keys=[key, f"{key}:pending"], args=[limit, reservation["token"], int(time.time()), _expire_at()])
+    except redis.RedisError as e:
+        return _uncounted_reservation(user_id, generation_type, key, limit, f"Redis unavailable ({e})")
+    if used < 0:
+        logger.info(f"User {user_id} has no {generation_type} generations left today")
+        return None
+    reservation.update(used=used, remaining=max(0, limit - used))
+    logger.info(f"Reserved {generation_type} generation {used}/{limit} for user {user_id}")
+    return reservation
+
+def commit_generation(reservation: Optional[dict], prompt: str) -> None:
+    """Mark a reserved slot as used and record it in the Postgres audit log."""
+    if not reservation:
+        return
+    if reservation.get("counted", True):
+        try:
+            if not redis_client.hdel(f"{reservation['key']}:pending", reservation["token"]):
+                # Already committed or refunded
+                return
+        except redis.RedisError as e:
+            logger.error(f"Could not mark {reservation['generation_type']} reservation of user {reservation['user_id']} committed: {e}")
+    save_user_generation(reservation["user_id"], prompt, reservation["generation_type"])
+
+def refund_generation(reservation: Optional[dict]) -> None:
+    """Give a reserved slot back after a failed generation. Safe to call more than once."""
+    if not reservation or not reservation.get("counted", True):
+        return
+    try:
+        used = _refund(keys=[reservation["key"], f"{reservation['key']}:pending"], args=[reservation["token"]])
+    except redis.RedisError as e:
+        logger.error(f"Could not refund {reservation['generation_type']} generation for user {reservation['user_id']}: {e}")
+        return
+    if used >= 0:
+        logger.info(f"Refunded {reservation['generation_type']} generation for user {reservation['user_id']}")
+
+# Async API, used by the Telegram handlers
+
+async def _ensure_seeded_async(user_id: int, generation_type: str, key: str) -> bool:
+    if await async_redis_client.exists(key):
+        return True
+    used = await get_user_generations_today_async(user_id, generation_type)
+    if used is None:
+        return False
+    await async_redis_client.set(key, used, nx=True, ex=_seed_ttl())
+    return True
+
+async def get_generations_used_async(user_id: int, generation_type: str) -> int:
+    key = _quota_key(user_id, generation_type)
+    try:
+        if not await _ensure_seeded_async(user_id, generation_type, key):
+            return 0
+        return int(await async_redis_client.get(key) or 0)
+    except redis.RedisError as e:
+        logger.error(f"Error reading {generation_type} quota for user {user_id}: {e}")
+        return 0
+
+async def reserve_generation_async(user_id: int, generation_type: str, limit: int) -> Optional[dict]:
+    key = _quota_key(user_id, generation_type)
+    reservation = _new_reservation(user_id, generation_type, key, 0, limit)
+    try:
+        if not await _ensure_seeded_async(user_id, generation_type, key):
+            return _uncounted_reservation(user_id, generation_type, key, limit, "Could not seed the quota counter")
+        used = await _reserve_async(keys=[key, f"{key}:pending"], args=[limit, reservation["token"], int(time.time()), _expire_at()])
+    except redis.RedisError as e:
+        return _uncounted_reservation(user_id, generation_type, key, limit, f"Redis unavailable ({e})")
+    if used < 0:
+        logger.info(f"User {user_id} has no {generation_type} generations left today")
+        return None
+    reservation.update(used=used, remaining=max(0, limit - used))
+    logger.info(f"Reserved {generation_type} generation {used}/{limit} for user {user_id}")
+    return reservation
+
+async def commit_generation_async(reservation: Optional[dict], prompt: str) -> None:
+    if not reservation:
+        return
+    if reservation.get("counted", True):
+        try:
+            if not await async_redis_client.hdel(f"{reservation['key']}:pending", reservation["token"]):
+                # Already committed or refunded
+                return
+        except redis.RedisError as e:
+            logger.error(f"Could not mark {reservation['generation_type']} reservation of user {reservation['user_id']} committed: {e}")
+    # The audit row is written in the background, the user does not wait for it
+    task = asyncio.create_task(save_user_generation_async(reservation["user_id"], prompt, reservation["generation_type"]))
+    _pending_audit_writes.add(task)
+    task.add_done_callback(_pending_audit_writes.discard)
+
+async def drain_audit_writes():
+    """Wait for the background audit-log writes, so none are lost on shutdown."""
+    if _pending_audit_writes:
+        logger.info(f"Waiting for {len(_pending_audit_writes)} generation audit writes")
+        await asyncio.gather(*list(_pending_audit_writes), return_exceptions=True)
+
+async def refund_generation_async(reservation: Optional[dict]) -> None:
+    if not reservation or not reservation.get("counted", True):
+        return
+    try:
+        used = await _refund_async(keys=[reservation["key"], f"{reservation['key']}:pending"], args=[reservation["token"]])
+    except redis.RedisError as e:
+        logger.error(f"Could not refund {reservation['generation_type']} generation for user {reservation['user_id']}: {e}")
+        return
+    if used >= 0:
+        logger.info(f"Refunded {reservation['generation_type']} generation for user {reservation['user_id']}")
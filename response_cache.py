@@ -0,0 +1,114 @@
+# response_cache.py
+
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+import redis
+import redis.asyncio as aioredis
+from config import REDIS_HOST, REDIS_PORT, REDIS_DB, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_DEFAULT_TTL, LLM_CACHE_MODEL_TTLS
+
+logger = logging.getLogger(__name__)
+
+# Exact-match cache for LLM calls whose output only depends on their input.
+# Call sites opt in explicitly with a namespace; the key is a hash of
+# (namespace, model, system, messages, params), so any difference in the
+# request is a miss. Entries expire after the model's TTL and the cache is
+# bounded to LLM_CACHE_MAX_ENTRIES: an index sorted by last access evicts the
+# least recently used entries when a store pushes it over the limit.
+#
+# Keys:
+#   llm_cache:{sha256}   cached response text
+#   llm_cache:index      sorted set of entry keys by last access time
+#   llm_cache:stats      hash of "{namespace}:hit" / "{namespace}:miss" counters
+
+INDEX_KEY = "llm_cache:index"
+STATS_KEY = "llm_cache:stats"
+
+# Hit/miss counting happens in the same script as the lookup, so it is shared by
+# the bot and the Dramatiq workers and costs no extra round trip
+GET_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if value then
+    redis.call('ZADD', KEYS[2], ARGV[1], KEYS[1])
+    redis.call('HINCRBY', KEYS[3], ARGV[2] .. ':hit', 1)
+else
+    redis.call('ZREM', KEYS[2], KEYS[1])
+    redis.call('HINCRBY', KEYS[3], ARGV[2] .. ':miss', 1)
+end
+return value
+"""
+
+STORE_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if excess > 0 then
+    local evicted = redis.call('ZPOPMIN', KEYS[2], excess)
+    for i = 1, #evicted, 2 do
+        redis.call('DEL', evicted[i])
+    end
+end
+return 1
+"""
+
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+async_redis_client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+_get_sync = redis_client.register_script(GET_SCRIPT)
+_store_sync = redis_client.register_script(STORE_SCRIPT)
+_get_async = async_redis_client.register_script(GET_SCRIPT)
+_store_async = async_redis_client.register_script(STORE_SCRIPT)
+
+async def _run_script(sync_script, async_script, keys: list, args: list):
+    # The bot runs one loop on the main thread. Dramatiq actors run a fresh loop per task on
+    # worker threads, where an async client would keep its connections after the loop is
+    # closed, so they use the sync client on the loop's executor, which closes with the loop.
+    if threading.current_thread() is threading.main_thread():
+        return await async_script(keys=keys, args=args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, lambda: sync_script(keys=keys, args=args))
+
+def cache_key(namespace: str, model: str, system, messages, params: dict = None) -> str:
+    payload = json.dumps([namespace, model, system, messages, params or {}], sort_keys=True, default=str)
+    return f"llm_cache:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+def _ttl(model: str) -> int:
+    return LLM_CACHE_MODEL_TTLS.get(model, LLM_CACHE_DEFAULT_TTL)
+
+async def get_cached_response(namespace: str, key: str):
+    """The cached text for `key`, or None on a miss or when Redis is unavailable."""
+    try:
+        value = await _run_script(_get_sync, _get_async, [key, INDEX_KEY, STATS_KEY], [time.time(), namespace])
+    except Exception as e:
+        logger.error(f"Error reading LLM response cache: {e}")
+        return None
+    return value.decode('utf-8') if value is not None else None
+
+async def store_response(key: str, model: str, response: str):
+    if not response:
+        return
+    try:
+        await _run_script(_store_sync, _store_async, [key, INDEX_KEY], [response, _ttl(model), time.time(), LLM_CACHE_MAX_ENTRIES])
+    except Exception as e:
+        logger.error(f"Error writing LLM response cache: {e}")
+
+async def cached_completion(namespace: str, model: str, system, messages, params: dict, compute):
+    """Return the cached response for this exact request, or await compute() and cache its result."""
+    key = cache_key(namespace, model, system, messages, params)
+    cached = await get_cached_response(namespace, key)
+    if cached is not None:
+        logger.info(f"LLM response cache hit for {namespace}")
+        return cached
+    response = await compute()
+    await store_response(key, model, response)
+    return response
+
+def get_cache_stats() -> dict:
+    """Hit and miss counts per namespace, e.g. {'lyrics_summary': {'hit': 3, 'miss': 10}}."""
+    stats = {}
+    for field, count in redis_client.hgetall(STATS_KEY).items():
+        namespace, _, outcome = field.decode('utf-8').rpartition(':')
+        stats.setdefault(namespace, {'hit': 0, 'miss': 0})[outcome] = int(count)
+    return stats
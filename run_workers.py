@@ -32,7 +32,7 @@ if __name__ == "__main__":
     setup_logging()
     
     # Set sys.argv for Dramatiq modules to load
-    sys.argv = ["dramatiq", "dramatiq_tasks.image_tasks", "dramatiq_tasks.suno_tasks", "dramatiq_tasks.flux_tasks", "dramatiq_tasks.voice_tasks"]
+    sys.argv = ["dramatiq", "dramatiq_tasks.image_tasks", "dramatiq_tasks.suno_tasks", "dramatiq_tasks.flux_tasks", "dramatiq_tasks.voice_tasks", "dramatiq_tasks.summary_tasks"]
     
     # Call the main function to start Dramatiq workers
     main()
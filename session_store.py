@@ -0,0 +1,101 @@
+# session_store.py
+
+import json
+import logging
+import redis
+import redis.asyncio as aioredis
+from config import REDIS_HOST, REDIS_PORT, REDIS_DB, SESSION_TTL
+
+logger = logging.getLogger(__name__)
+
+# Per-user session data is a Redis hash, session:{user_id}, with one JSON-encoded
+# value per field. Writes touch only the fields they change and refresh the TTL
+# inside the same script, so an update is one round trip, never rewrites the
+# rest of the session and can't lose a concurrent handler's change to another
+# field. Reads are a single HGETALL or HMGET.
+
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+async_redis_client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+
+UPDATE_SCRIPT = """
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+DELETE_FIELDS_SCRIPT = """
+local removed = redis.call('HDEL', KEYS[1], unpack(ARGV, 2))
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return removed
+"""
+
+_update = redis_client.register_script(UPDATE_SCRIPT)
+_delete_fields = redis_client.register_script(DELETE_FIELDS_SCRIPT)
+_update_async = async_redis_client.register_script(UPDATE_SCRIPT)
+_delete_fields_async = async_redis_client.register_script(DELETE_FIELDS_SCRIPT)
+
+def _session_key(user_id: int) -> str:
+    return f"session:{user_id}"
+
+def _legacy_session_key(user_id: int) -> str:
+    # JSON blob used before sessions became hashes; only deleted, never read
+    return f"user:{user_id}:session"
+
+def _update_args(data: dict) -> list:
+    args = [SESSION_TTL]
+    for field, value in data.items():
+        args.extend((field, json.dumps(value)))
+    return args
+
+def _decode(raw: dict) -> dict:
+    return {field.decode('utf-8'): json.loads(value) for field, value in raw.items()}
+
+def _decode_fields(fields: tuple, values: list) -> dict:
+    return {field: json.loads(value) for field, value in zip(fields, values) if value is not None}
+
+def get_session(user_id: int) -> dict:
+    return _decode(redis_client.hgetall(_session_key(user_id)))
+
+def get_session_fields(user_id: int, *fields: str) -> dict:
+    """Only the requested fields that are set."""
+    return _decode_fields(fields, redis_client.hmget(_session_key(user_id), fields))
+
+def get_session_field(user_id: int, field: str, default=None):
+    return get_session_fields(user_id, field).get(field, default)
+
+def update_session(user_id: int, data: dict) -> None:
+    if data:
+        _update(keys=[_session_key(user_id)], args=_update_args(data))
+
+def delete_session_fields(user_id: int, *fields: str) -> int:
+    if not fields:
+        return 0
+    return _delete_fields(keys=[_session_key(user_id)], args=[SESSION_TTL, *fields])
+
+def delete_session(user_id: int) -> None:
+    redis_client.delete(_session_key(user_id), _legacy_session_key(user_id))
+    logger.info(f"Deleted session for user {user_id}")
+
+async def get_session_async(user_id: int) -> dict:
+    return _decode(await async_redis_client.hgetall(_session_key(user_id)))
+
+async def get_session_fields_async(user_id: int, *fields: str) -> dict:
+    return _decode_fields(fields, await async_redis_client.hmget(_session_key(user_id), fields))
+
+async def get_session_field_async(user_id: int, field: str, default=None):
+    return (await get_session_fields_async(user_id, field)).get(field, default)
+
+async def update_session_async(user_id: int, data: dict) -> None:
+    if data:
+        await _update_async(keys=[_session_key(user_id)], args=_update_args(data))
+
+async def delete_session_fields_async(user_id: int, *fields: str) -> int:
+    if not fields:
+        return 0
+    return await _delete_fields_async(keys=[_session_key(user_id)], args=[SESSION_TTL, *fields])
+
+async def delete_session_async(user_id: int) -> None:
+    await async_redis_client.delete(_session_key(user_id), _legacy_session_key(user_id))
+    logger.info(f"Deleted session for user {user_id}")
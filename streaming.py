@@ -0,0 +1,119 @@
+# streaming.py
+
+import asyncio
+import logging
+import time
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter
+from config import STREAM_REPLIES, STREAM_EDIT_INTERVAL, STREAM_GROUP_EDIT_INTERVAL, STREAM_MAX_EDIT_INTERVAL
+from performance_metrics import record_first_token_time
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+PLACEHOLDER = "…"
+CURSOR = " ▌"
+
+def _split_point(text: str) -> int:
+    # Prefer breaking a full message at a line break, then at a space, as long as
+    # that keeps at least half of it; otherwise cut hard at the limit
+    for separator in ("\n", " "):
+        cut = text.rfind(separator, 0, MAX_MESSAGE_LENGTH)
+        if cut >= MAX_MESSAGE_LENGTH // 2:
+            return cut + 1
+    return MAX_MESSAGE_LENGTH
+
+class StreamingReply:
+    """Shows a model reply in Telegram while it is being generated.
+
+    A placeholder reply is sent first and then edited with the text received so
+    far, at most once per edit interval (longer in groups, where Telegram's edit
+    limits are tighter). Intermediate edits aren't retried by the rate limiter:
+    a RetryAfter doubles the interval instead of stalling the stream. Text
+    beyond 4096 characters continues in a new message. With STREAM_REPLIES off
+    the text is only sent once the reply is complete.
+    """
+
+    def __init__(self, message: Message, started_at: float = None):
+        self.message = message
+        self.started_at = started_at or time.time()
+        self.text = ""
+        self.first_token_at = None
+        self._current = None   # Telegram message being edited
+        self._offset = 0       # start of the current message within self.text
+        self._shown = ""
+        self._base_interval = STREAM_EDIT_INTERVAL if message.chat.type == 'private' else STREAM_GROUP_EDIT_INTERVAL
+        self._interval = self._base_interval
+        self._next_edit = 0.0
+
+    async def start(self):
+        if STREAM_REPLIES:
+            await self._show(PLACEHOLDER, required=True)
+
+    async def feed(self, chunk: str):
+        if not chunk:
+            return
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+            record_first_token_time(self.first_token_at - self.started_at)
+        self.text += chunk
+        if STREAM_REPLIES and time.monotonic() >= self._next_edit:
+            await self._render(final=False)
+
+    async def finish(self) -> str:
+        if not self.text.strip():
+            self.text = "No response was generated."
+        await self._render(final=True)
+        return self.text
+
+    async def _render(self, final: bool):
+        pending = self.text[self._offset:]
+        while len(pending) > MAX_MESSAGE_LENGTH:
+            cut = _split_point(pending)
+            await self._show(pending[:cut], required=True)
+            self._current = None
+            self._shown = ""
+            self._offset += cut
+            pending = self.text[self._offset:]
+        if not final and len(pending) + len(CURSOR) <= MAX_MESSAGE_LENGTH:
+            pending += CURSOR
+        await self._show(pending, required=final)
+
+    async def _show(self, text: str, required: bool = False):
+        if not text.strip() or text == self._shown:
+            return
+        while True:
+            try:
+                # Through the bot: Message.reply_text/edit_text don't take rate_limit_args
+                bot = self.message.get_bot()
+                rate_limit_args = None if required else {"max_retries": 0}
+                if self._current is None:
+                    self._current = await bot.send_message(
+                        chat_id=self.message.chat_id,
+                        text=text,
+                        reply_to_message_id=None if self.message.chat.type == 'private' else self.message.message_id,
+                        message_thread_id=self.message.message_thread_id if self.message.is_topic_message else None,
+                        rate_limit_args=rate_limit_args
+                    )
+                else:
+                    await bot.edit_message_text(
+                        chat_id=self._current.chat_id,
+                        message_id=self._current.message_id,
+                        text=text,
+                        rate_limit_args=rate_limit_args
+                    )
+                self._shown = text
+                self._interval = max(self._base_interval, self._interval * 0.9)
+                break
+            except RetryAfter as e:
+                self._interval = min(self._interval * 2, STREAM_MAX_EDIT_INTERVAL)
+                logger.warning(f"Edit rate limited in chat {self.message.chat_id}, next edit in {e.retry_after}s")
+                if not required:
+                    self._next_edit = time.monotonic() + e.retry_after
+                    return
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+                break
+        self._next_edit = time.monotonic() + self._interval
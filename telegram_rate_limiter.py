@@ -0,0 +1,210 @@
+# telegram_rate_limiter.py
+
+import asyncio
+import logging
+import functools
+import time
+import redis
+import redis.asyncio as aioredis
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter, ExtBot
+from config import (TELEGRAM_BOT_TOKEN, REDIS_HOST, REDIS_PORT, REDIS_DB, TELEGRAM_GLOBAL_RATE,
+                    TELEGRAM_CHAT_RATE, TELEGRAM_GROUP_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_RETRY_AFTER_MAX_RETRIES)
+
+logger = logging.getLogger(__name__)
+
+# Rate limiter for outbound Bot API calls, shared by the bot process and the
+# Dramatiq workers through token buckets in Redis: one for the whole bot and
+# one per chat (slower for groups). A request that would exceed either waits
+# until both have a token instead of failing. A RetryAfter from Telegram
+# pauses the chat's bucket for every process and the request is retried.
+# Calls without a chat_id (getMe, answerCallbackQuery, ...) are not limited.
+# Low-priority sends (progress animations) only try once and never wait; see
+# RedisRateLimiter.
+#
+# Keys:
+#   tg_rate:global            global bucket (hash: tokens, ts)
+#   tg_rate:chat:{chat_id}    per-chat bucket
+#   tg_rate:pause:{chat_id}   set for retry_after after a RetryAfter
+#   tg_rate:stats             counters: sends, delayed, delay_ms, retry_after
+
+GLOBAL_KEY = "tg_rate:global"
+STATS_KEY = "tg_rate:stats"
+
+# Takes a token from the global and the chat bucket, or neither; returns 0 on
+# success, otherwise the milliseconds to wait before trying again. ARGV[5]
+# tokens must be left in both buckets afterwards, so low-priority sends don't
+# take the token a reply is about to need. Redis' clock is used so all
+# processes agree on time.
+ACQUIRE_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+
+local paused = redis.call('PTTL', KEYS[3])
+if paused > 0 then
+    return paused
+end
+
+local function available(key, rate, burst)
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    return math.min(burst, tokens + math.max(now - ts, 0) * rate / 1000)
+end
+
+local global_rate, global_burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local chat_rate, chat_burst = tonumber(ARGV[3]), tonumber(ARGV[4])
+local needed = 1 + tonumber(ARGV[5])
+local global_tokens = available(KEYS[1], global_rate, global_burst)
+local chat_tokens = available(KEYS[2], chat_rate, chat_burst)
+
+if global_tokens >= needed and chat_tokens >= needed then
+    redis.call('HSET', KEYS[1], 'tokens', global_tokens - 1, 'ts', now)
+    redis.call('PEXPIRE', KEYS[1], math.ceil(global_burst / global_rate * 1000) + 1000)
+    redis.call('HSET', KEYS[2], 'tokens', chat_tokens - 1, 'ts', now)
+    redis.call('PEXPIRE', KEYS[2], math.ceil(chat_burst / chat_rate * 1000) + 1000)
+    redis.call('HINCRBY', KEYS[4], 'sends', 1)
+    return 0
+end
+
+local wait = 0
+if global_tokens < needed then
+    wait = math.max(wait, math.ceil((needed - global_tokens) * 1000 / global_rate))
+end
+if chat_tokens < needed then
+    wait = math.max(wait, math.ceil((needed - chat_tokens) * 1000 / chat_rate))
+end
+return wait
+"""
+
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+async_redis_client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+_acquire_sync = redis_client.register_script(ACQUIRE_SCRIPT)
+_acquire_async = async_redis_client.register_script(ACQUIRE_SCRIPT)
+
+# When this process last had to queue a request or got a RetryAfter
+_last_saturated_at = 0.0
+
+class RateLimitSkipped(Exception):
+    """Raised for a send with rate_limit_args={"skip_if_limited": True} when no token is free right now."""
+
+def saturated_recently(seconds: float) -> bool:
+    """Whether this process' Bot API calls had to wait for the limiter in the last `seconds`."""
+    return time.monotonic() - _last_saturated_at < seconds
+
+def _record_delay(client, acquire, delay: float):
+    pipe = client.pipeline(transaction=False)
+    pipe.hincrby(STATS_KEY, 'delayed', 1)
+    pipe.hincrby(STATS_KEY, 'delay_ms', int(delay * 1000))
+    return pipe.execute()
+
+def _pause(client, acquire, chat_id, seconds: float):
+    pipe = client.pipeline(transaction=False)
+    pipe.set(f"tg_rate:pause:{chat_id}", 1, px=max(int(seconds * 1000), 1))
+    pipe.hincrby(STATS_KEY, 'retry_after', 1)
+    return pipe.execute()
+
+def _take_token(client, acquire, keys: list, args: list):
+    return acquire(keys=keys, args=args)
+
+def _chat_rate(chat_id) -> float:
+    # Negative ids and @usernames are groups and channels
+    if isinstance(chat_id, str) or chat_id < 0:
+        return TELEGRAM_GROUP_RATE
+    return TELEGRAM_CHAT_RATE
+
+class RedisRateLimiter(BaseRateLimiter):
+    """BaseRateLimiter backed by Redis token buckets, for the Application and for workers' bots.
+
+    Per call, rate_limit_args={"max_retries": n} overrides how often a
+    RetryAfter is retried; 0 hands it straight to the caller (after pausing
+    the chat). With {"skip_if_limited": True} the send never waits: it goes
+    out only if a token is free while still leaving one for the next send,
+    otherwise RateLimitSkipped is raised. Both are for sends that are better
+    skipped than delayed.
+    """
+
+    def __init__(self, blocking_client: bool = False):
+        # Dramatiq actors run each task on a fresh event loop, and an async client used there
+        # would keep its connections after the loop is closed; their bots use the sync client
+        # on the loop's executor instead, which closes with the loop
+        self.blocking_client = blocking_client
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def _acquire(self, chat_id, skip_if_limited: bool = False) -> float:
+        """Wait for a token for `chat_id`; returns the seconds spent waiting (0 if none).
+
+        With skip_if_limited, takes a token only if one is left over afterwards and raises
+        RateLimitSkipped instead of waiting.
+        """
+        keys = [GLOBAL_KEY, f"tg_rate:chat:{chat_id}", f"tg_rate:pause:{chat_id}", STATS_KEY]
+        args = [TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE, _chat_rate(chat_id), TELEGRAM_CHAT_BURST, int(skip_if_limited)]
+        started = None
+        while True:
+            wait_ms = await self._redis(_take_token, keys, args)
+            if wait_ms and skip_if_limited:
+                raise RateLimitSkipped(f"No token free for chat {chat_id}")
+            if not wait_ms:
+                return time.monotonic() - started if started is not None else 0.0
+            if started is None:
+                started = time.monotonic()
+            await asyncio.sleep(wait_ms / 1000)
+
+    async def _redis(self, operation, *args):
+        """Run operation(client, acquire_script, *args) on the client this limiter uses."""
+        if self.blocking_client:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, functools.partial(operation, redis_client, _acquire_sync, *args))
+        return await operation(async_redis_client, _acquire_async, *args)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        global _last_saturated_at
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+
+        max_retries = TELEGRAM_RETRY_AFTER_MAX_RETRIES
+        skip_if_limited = False
+        if isinstance(rate_limit_args, dict):
+            max_retries = rate_limit_args.get("max_retries", max_retries)
+            skip_if_limited = rate_limit_args.get("skip_if_limited", False)
+
+        attempt = 0
+        while True:
+            try:
+                delay = await self._acquire(chat_id, skip_if_limited)
+                if delay:
+                    _last_saturated_at = time.monotonic()
+                    await self._redis(_record_delay, delay)
+            except redis.RedisError as e:
+                # Sending unthrottled beats not sending at all
+                logger.error(f"Rate limiter unavailable, sending {endpoint} to {chat_id} unthrottled: {e}")
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = float(e.retry_after)
+                _last_saturated_at = time.monotonic()
+                logger.warning(f"{endpoint} to chat {chat_id} hit flood control, pausing the chat for {retry_after}s")
+                try:
+                    await self._redis(_pause, chat_id, retry_after)
+                except redis.RedisError as redis_error:
+                    logger.error(f"Could not record RetryAfter pause for chat {chat_id}: {redis_error}")
+                if attempt >= max_retries:
+                    raise
+                attempt += 1
+                await asyncio.sleep(retry_after)
+
+def rate_limited_bot() -> ExtBot:
+    """A Bot for the Dramatiq workers that goes through the shared rate limiter."""
+    return ExtBot(token=TELEGRAM_BOT_TOKEN, rate_limiter=RedisRateLimiter(blocking_client=True))
+
+def get_rate_limiter_stats() -> dict:
+    stats = {key.decode('utf-8'): int(value) for key, value in redis_client.hgetall(STATS_KEY).items()}
+    for counter in ('sends', 'delayed', 'delay_ms', 'retry_after'):
+        stats.setdefault(counter, 0)
+    return stats
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# config.py refuses to load without these; the tests never talk to Telegram or Anthropic
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test")
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+os.environ.setdefault("GENERATIONS_PER_DAY", "5")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
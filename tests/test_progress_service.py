@@ -0,0 +1,29 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+from progress_service import ProgressEntry, ProgressService
+from telegram_rate_limiter import RateLimitSkipped
+
+def make_entry():
+    bot = MagicMock()
+    bot.edit_message_text = AsyncMock()
+    message = MagicMock(chat_id=42, message_id=7, text="🎨 Initializing...")
+    message.get_bot.return_value = bot
+    return ProgressEntry(message, "🎨", ("Sketching",), remote=False), bot
+
+def test_edit_goes_through_the_bot_without_waiting_for_the_limiter():
+    entry, bot = make_entry()
+    asyncio.run(ProgressService()._edit(entry, "🎨 Sketching."))
+
+    bot.edit_message_text.assert_awaited_once_with(
+        chat_id=42, message_id=7, text="🎨 Sketching.",
+        rate_limit_args={"max_retries": 0, "skip_if_limited": True}
+    )
+    assert entry.shown == "🎨 Sketching."
+
+def test_edit_skipped_by_the_limiter_is_retried_later():
+    entry, bot = make_entry()
+    bot.edit_message_text.side_effect = RateLimitSkipped("no token")
+    asyncio.run(ProgressService()._edit(entry, "🎨 Sketching."))
+
+    assert entry.shown == "🎨 Initializing..."
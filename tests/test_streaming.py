@@ -0,0 +1,40 @@
+import asyncio
+import sys
+import types
+from unittest.mock import AsyncMock, MagicMock, patch
+
+# performance_metrics pulls in the database module, which needs Redis at import time
+with patch.dict(sys.modules, {"performance_metrics": types.SimpleNamespace(record_first_token_time=lambda seconds: None)}):
+    import streaming
+
+def make_message(sent_ids):
+    bot = MagicMock()
+    bot.send_message = AsyncMock(side_effect=[MagicMock(chat_id=42, message_id=message_id) for message_id in sent_ids])
+    bot.edit_message_text = AsyncMock()
+    message = MagicMock(chat_id=42, message_id=1, is_topic_message=False)
+    message.chat.type = 'private'
+    message.get_bot.return_value = bot
+    return message, bot
+
+def test_streaming_reply_placeholder_rollover_and_finish(monkeypatch):
+    monkeypatch.setattr(streaming, "STREAM_REPLIES", True)
+    message, bot = make_message([100, 101])
+    text = "word " * 1000
+
+    async def run():
+        reply = streaming.StreamingReply(message)
+        await reply.start()
+        await reply.feed(text)
+        return await reply.finish()
+
+    assert asyncio.run(run()) == text
+
+    cut = streaming._split_point(text)
+    sends = bot.send_message.await_args_list
+    assert [call.kwargs["text"] for call in sends] == [streaming.PLACEHOLDER, text[cut:]]
+    assert all(call.kwargs["chat_id"] == 42 for call in sends)
+    # The placeholder is filled with the first 4096-character part, the rest goes to a new message
+    edits = bot.edit_message_text.await_args_list
+    assert edits[-1].kwargs["message_id"] == 100
+    assert edits[-1].kwargs["text"] == text[:cut]
+    assert len(text[:cut]) <= streaming.MAX_MESSAGE_LENGTH
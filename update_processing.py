@@ -0,0 +1,64 @@
+# update_processing.py
+
+import asyncio
+import logging
+from typing import Any, Awaitable
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, but one at a time per chat.
+
+    Up to max_concurrent_updates updates are handled at once. Updates from the
+    same chat (or from the same user, for updates without a chat) wait for each
+    other and run in arrival order, so ConversationHandler state and per-chat
+    replies stay consistent. Updates with neither run unordered.
+
+    The per-chat lock is taken before a concurrency slot, so a chat with a
+    backlog doesn't hold slots that other chats could use.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}      # ordering key -> asyncio.Lock
+        self._waiting = {}    # ordering key -> updates holding or waiting for the lock
+
+    @staticmethod
+    def ordering_key(update: object):
+        chat = getattr(update, "effective_chat", None)
+        if chat is not None:
+            return ("chat", chat.id)
+        user = getattr(update, "effective_user", None)
+        if user is not None:
+            return ("user", user.id)
+        return None
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self.ordering_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._locks:
+            logger.info(f"Update processor shutting down with {len(self._locks)} chats still busy")
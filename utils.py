@@ -1,16 +1,30 @@
 import logging
 import anthropic
+import httpx
 from openai import AsyncOpenAI
-from config import ANTHROPIC_API_KEY, OPENAI_API_KEY
+from config import ANTHROPIC_API_KEY, OPENAI_API_KEY, ANTHROPIC_TIMEOUT, ANTHROPIC_MAX_CONNECTIONS
 from model_cache import update_model_cache
 from voice_cache import update_voice_cache
 
 logger = logging.getLogger(__name__)
 
 # Initialize clients
-anthropic_client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+# The Claude client is async and shares one pooled HTTP client, so a slow completion
+# only suspends its own handler; cancelling the handler task aborts the request.
+anthropic_client = anthropic.AsyncAnthropic(
+    api_key=ANTHROPIC_API_KEY,
+    timeout=httpx.Timeout(ANTHROPIC_TIMEOUT, connect=10.0),
+    max_retries=2,
+    http_client=anthropic.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=ANTHROPIC_MAX_CONNECTIONS, max_keepalive_connections=20)
+    )
+)
 openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
+async def close_api_clients():
+    await anthropic_client.close()
+    await openai_client.close()
+
 async def periodic_cache_update(context):
     logger.info("Performing periodic model cache update")
     await update_model_cache()
@@ -0,0 +1,171 @@
+# webhook_server.py
+
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import aiohttp
+from aiohttp import web
+from telegram import Bot, Update
+from config import (TELEGRAM_BOT_TOKEN, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH,
+                    WEBHOOK_SECRET_TOKEN, WEBHOOK_REGISTER, WEBHOOK_MAX_CONNECTIONS, WEBHOOK_FANOUT_TARGETS,
+                    ALLOWED_UPDATES)
+
+logger = logging.getLogger(__name__)
+
+# Webhook ingress on an embedded aiohttp server, as an alternative to polling.
+#
+# In the bot process (BOT_MODE=webhook) POSTed updates are checked against the
+# secret token and ALLOWED_UPDATES and put on the Application's update queue.
+#
+# Run on its own (python webhook_server.py), this is a fan-out ingress for
+# several bot processes: it does the same checks and forwards each update to
+# one of WEBHOOK_FANOUT_TARGETS chosen by chat id, so a chat always lands on
+# the same process and its in-memory conversation state. The bot processes run
+# in webhook mode with WEBHOOK_REGISTER off, listening on local ports.
+#
+# Recorded updates can be replayed locally with
+#   python webhook_server.py post update.json --url http://localhost:8443/telegram
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+def update_type(data: dict):
+    return next((key for key in data if key != "update_id"), None)
+
+def routing_key(data: dict) -> int:
+    """Chat id of a raw update, or the sender's id for updates without a chat."""
+    body = data.get(update_type(data)) or {}
+    chat = body.get("chat") or (body.get("message") or {}).get("chat")
+    if chat:
+        return chat["id"]
+    return (body.get("from") or {}).get("id", data["update_id"])
+
+def _authorized(request: web.Request) -> bool:
+    return hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), WEBHOOK_SECRET_TOKEN or "")
+
+async def _read_update(request: web.Request):
+    """(update JSON, None) for an update to handle, otherwise (None, response to send)."""
+    if not _authorized(request):
+        logger.warning(f"Rejected webhook request from {request.remote}: bad secret token")
+        return None, web.Response(status=403)
+    try:
+        data = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None, web.Response(status=400)
+    if not isinstance(data, dict) or "update_id" not in data:
+        return None, web.Response(status=400)
+    if update_type(data) not in ALLOWED_UPDATES:
+        # Acknowledge so Telegram doesn't redeliver it
+        logger.debug(f"Ignoring {update_type(data)} update {data['update_id']}")
+        return None, web.Response()
+    return data, None
+
+async def _health(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+def create_webhook_app(application) -> web.Application:
+    async def receive(request: web.Request) -> web.Response:
+        data, response = await _read_update(request)
+        if response is not None:
+            return response
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    app.router.add_get("/healthz", _health)
+    return app
+
+def create_fanout_app(targets: list) -> web.Application:
+    async def open_session(app):
+        app["session"] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+
+    async def close_session(app):
+        await app["session"].close()
+
+    async def forward(request: web.Request) -> web.Response:
+        data, response = await _read_update(request)
+        if response is not None:
+            return response
+        target = targets[routing_key(data) % len(targets)]
+        try:
+            async with request.app["session"].post(target, json=data, headers={SECRET_HEADER: WEBHOOK_SECRET_TOKEN}) as forwarded:
+                if forwarded.status != 200:
+                    logger.warning(f"Worker {target} answered {forwarded.status} for update {data['update_id']}")
+                    return web.Response(status=502)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # A non-2xx answer makes Telegram deliver the update again later
+            logger.error(f"Error forwarding update {data['update_id']} to {target}: {str(e)}")
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.on_startup.append(open_session)
+    app.on_cleanup.append(close_session)
+    app.router.add_post(WEBHOOK_PATH, forward)
+    app.router.add_get("/healthz", _health)
+    return app
+
+async def register_webhook(bot: Bot):
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL must be set to register the webhook")
+    await bot.set_webhook(
+        url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET_TOKEN,
+        allowed_updates=ALLOWED_UPDATES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS
+    )
+    logger.info(f"Webhook registered at {WEBHOOK_URL} for {', '.join(ALLOWED_UPDATES)}")
+
+async def start_webhook(application) -> web.AppRunner:
+    """Serve the webhook for `application` and register it with Telegram; returns the runner to clean up."""
+    if not WEBHOOK_SECRET_TOKEN:
+        raise ValueError("WEBHOOK_SECRET_TOKEN must be set in webhook mode")
+    runner = web.AppRunner(create_webhook_app(application))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    logger.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    if WEBHOOK_REGISTER:
+        await register_webhook(application.bot)
+    return runner
+
+async def run_fanout():
+    if not WEBHOOK_SECRET_TOKEN or not WEBHOOK_FANOUT_TARGETS:
+        raise ValueError("WEBHOOK_SECRET_TOKEN and WEBHOOK_FANOUT_TARGETS must be set to run the fan-out ingress")
+    runner = web.AppRunner(create_fanout_app(WEBHOOK_FANOUT_TARGETS))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    logger.info(f"Fan-out ingress on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH} -> {', '.join(WEBHOOK_FANOUT_TARGETS)}")
+    try:
+        if WEBHOOK_REGISTER:
+            async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+                await register_webhook(bot)
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await runner.cleanup()
+
+async def post_updates(path: str, url: str):
+    """POST recorded update JSON (one update or a list) to a local webhook endpoint."""
+    with open(path) as f:
+        data = json.load(f)
+    updates = data if isinstance(data, list) else [data]
+    async with aiohttp.ClientSession() as session:
+        for update in updates:
+            async with session.post(url, json=update, headers={SECRET_HEADER: WEBHOOK_SECRET_TOKEN or ""}) as response:
+                print(f"update {update.get('update_id')}: HTTP {response.status}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Telegram webhook fan-out ingress")
+    subcommands = parser.add_subparsers(dest="command")
+    post = subcommands.add_parser("post", help="replay recorded update JSON against a webhook endpoint")
+    post.add_argument("path")
+    post.add_argument("--url", default=f"http://localhost:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    args = parser.parse_args()
+
+    if args.command == "post":
+        asyncio.run(post_updates(args.path, args.url))
+    else:
+        asyncio.run(run_fanout())